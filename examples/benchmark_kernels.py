@@ -0,0 +1,216 @@
+#!/usr/bin/python
+"""
+Benchmark the compiled kernels: fortran (f2py, see the Makefile)
+versus numba (JIT). For each kernel, we check that both languages agree
+and print the best time out of a few runs (the first call of numba kernels
+includes the compilation, and it is not timed).
+
+Launch it using:
+python examples/benchmark_kernels.py --nsamples 1000000
+
+Author: Julien Peloton, j.peloton@sussex.ac.uk
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from s4cmb import detector_pointing as dp
+from s4cmb import numba_kernels
+from s4cmb.scanning_strategy_f import scanning_strategy_f
+from s4cmb.systematics_f import systematics_f
+from s4cmb.tod_f import tod_f
+
+def addargs(parser):
+    """ Parse command line arguments for benchmark_kernels """
+    parser.add_argument(
+        '--nsamples', dest='nsamples', type=int, default=1000000,
+        help='Number of time samples.')
+    parser.add_argument(
+        '--ndet', dest='ndet', type=int, default=16,
+        help='Number of detectors for the multi-detector kernels.')
+    parser.add_argument(
+        '--nrepeat', dest='nrepeat', type=int, default=5,
+        help='Number of runs per kernel (best time is reported).')
+    parser.add_argument(
+        '--nthreads', dest='nthreads', type=int, default=4,
+        help='Number of threads for the threaded kernels.')
+
+def best_time(func, nrepeat):
+    """ Best execution time (in second) of func out of nrepeat runs """
+    return min(timeit.repeat(func, number=1, repeat=nrepeat))
+
+def report(name, func_fortran, func_numba, nrepeat):
+    """ Time both versions of a kernel, and print the result """
+    ## JIT compilation
+    func_numba()
+    t_f = best_time(func_fortran, nrepeat)
+    t_n = best_time(func_numba, nrepeat)
+    print('{:<20} fortran: {:8.4f} s  numba: {:8.4f} s  '.format(
+        name, t_f, t_n) + 'numba/fortran: {:5.2f}'.format(t_n / t_f))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark fortran and numba kernels')
+    addargs(parser)
+    args = parser.parse_args(None)
+
+    n = args.nsamples
+    state = np.random.RandomState(0)
+
+    ## Detector pointing: quaternions
+    q = dp.euler_quatz(state.uniform(0, 2 * np.pi, n))
+    qpix = dp.euler_quaty(np.array([0.01]))[0]
+    assert np.allclose(dp.mult_fortran(q, qpix), dp.mult_numba(q, qpix))
+    report('mult',
+           lambda: dp.mult_fortran(q, qpix),
+           lambda: dp.mult_numba(q, qpix), args.nrepeat)
+
+    assert np.allclose(dp.quat_to_radecpa_fortran(q),
+                       dp.quat_to_radecpa_numba(q))
+    report('quat_to_radecpa',
+           lambda: dp.quat_to_radecpa_fortran(q),
+           lambda: dp.quat_to_radecpa_numba(q), args.nrepeat)
+
+    qpixs = dp.mult(
+        dp.euler_quatz(state.uniform(-0.02, 0.02, args.ndet)),
+        dp.euler_quaty(state.uniform(-0.02, 0.02, args.ndet)))
+    nsub = n // args.ndet
+    assert np.allclose(dp.offset_detectors_fortran(q[:nsub], qpixs),
+                       dp.offset_detectors_numba(q[:nsub], qpixs))
+    report('offset_detectors',
+           lambda: dp.offset_detectors_fortran(q[:nsub], qpixs),
+           lambda: dp.offset_detectors_numba(q[:nsub], qpixs), args.nrepeat)
+
+    ## Detector pointing: astrometry
+    converter = dp.Azel2Radec(56293., 0.277)
+    mjd = 56293. + np.arange(n) / 30. / 86400.
+    az = np.abs(np.mod(np.arange(n) / 30., 40.) - 20.) * dp.d2r
+    el = np.ones(n) * 50. * dp.d2r
+    mjd0, dmjd, amprms = dp.get_amprms_knots(2000.0, mjd)
+    out_f = dp.azel2radecpa_fortran(
+        mjd, az, el, amprms, converter.aoprms, mjd0, dmjd)
+    out_n = dp.azel2radecpa_numba(
+        mjd, az, el, amprms, converter.aoprms, mjd0, dmjd)
+    assert np.allclose(out_f[0], out_n[0], rtol=0., atol=1e-12)
+    report('azel2radecpa',
+           lambda: dp.azel2radecpa_fortran(
+               mjd, az, el, amprms, converter.aoprms, mjd0, dmjd),
+           lambda: dp.azel2radecpa_numba(
+               mjd, az, el, amprms, converter.aoprms, mjd0, dmjd),
+           args.nrepeat)
+
+    ## Scanning strategy
+    second = 1. / 24. / 3600.
+    az_f = np.zeros(n)
+    mjd_f = np.zeros(n)
+    az_n = np.zeros(n)
+    mjd_n = np.zeros(n)
+
+    def run_f():
+        scanning_strategy_f.run_one_scan_f(
+            az_f, mjd_f, 10., 30., 10., 0.4, 1., second, 30., n)
+
+    def run_n():
+        numba_kernels.run_one_scan_numba(
+            az_n, mjd_n, 10., 30., 10., 0.4, 1., second, 30.)
+
+    run_f()
+    run_n()
+    assert np.allclose(az_f, az_n) and np.allclose(mjd_f, mjd_n)
+    report('run_one_scan', run_f, run_n, args.nrepeat)
+
+    npix = 12 * 256**2
+    pix = state.randint(0, npix, n).astype(np.int32)
+    nhit_f = np.zeros(npix, dtype=np.int32)
+    nhit_n = np.zeros(npix, dtype=np.int32)
+    scanning_strategy_f.mapmaking(pix, nhit_f, npix, n)
+    numba_kernels.mapmaking_numba(pix, nhit_n)
+    assert np.all(nhit_f == nhit_n)
+    report('mapmaking',
+           lambda: scanning_strategy_f.mapmaking(pix, nhit_f, npix, n),
+           lambda: numba_kernels.mapmaking_numba(pix, nhit_n), args.nrepeat)
+
+    ## TOD -> maps
+    npair = args.ndet
+    nt = n // npair
+    point_matrix = state.randint(1, npix, npair * nt).astype(np.int32)
+    pa = state.uniform(0, np.pi, npair * nt)
+    cos2pa = np.cos(2 * pa)
+    sin2pa = np.sin(2 * pa)
+    ang = state.uniform(0, np.pi, npair)
+    hwp = state.uniform(0, np.pi, nt)
+    factors = [cos2pa, sin2pa, np.cos(2 * ang), np.sin(2 * ang),
+               np.cos(4 * hwp), np.sin(4 * hwp)]
+    waferts = state.normal(0, 1, 2 * npair * nt)
+    weights = np.ones(npair)
+    mask = np.ones(npair * nt, dtype=np.int32)
+
+    def maps():
+        return [np.zeros(npix) for i in range(7)] + \
+            [np.zeros(npix, dtype=np.int32)]
+
+    def tod2map_f(maps_f):
+        tod_f.tod2map_alldet_f(
+            *(maps_f + [point_matrix] + factors +
+              [waferts, weights, weights]),
+            npix=npair, nt=nt, wafermask_pixel=mask, nskypix=npix)
+
+    def tod2map_n(maps_n):
+        numba_kernels.tod2map_alldet_numba(
+            *(maps_n + [point_matrix] + factors +
+              [waferts, weights, weights, npair, nt, mask]))
+
+    maps_f = maps()
+    maps_n = maps()
+    tod2map_f(maps_f)
+    tod2map_n(maps_n)
+    for m_f, m_n in zip(maps_f, maps_n):
+        assert np.allclose(m_f, m_n)
+    report('tod2map', lambda: tod2map_f(maps_f),
+           lambda: tod2map_n(maps_n), args.nrepeat)
+
+    def tod2map_threads_f(maps_f):
+        tod_f.tod2map_alldet_threads_f(
+            *(maps_f + [point_matrix] + factors +
+              [waferts, weights, weights]),
+            npix=npair, nt=nt, wafermask_pixel=mask, nskypix=npix,
+            nthreads=args.nthreads)
+
+    def tod2map_threads_n(maps_n):
+        numba_kernels.tod2map_alldet_threads_numba(
+            *(maps_n + [point_matrix] + factors +
+              [waferts, weights, weights, npair, nt, mask, args.nthreads]))
+
+    maps_f = maps()
+    maps_n = maps()
+    tod2map_threads_f(maps_f)
+    tod2map_threads_n(maps_n)
+    for m_f, m_n in zip(maps_f, maps_n):
+        assert np.allclose(m_f, m_n)
+    report('tod2map (threads)', lambda: tod2map_threads_f(maps_f),
+           lambda: tod2map_threads_n(maps_n), args.nrepeat)
+
+    ## Systematics
+    nchan = 2 * args.ndet
+    ts = state.normal(0, 1, (nchan, n // nchan))
+    local_indices = np.arange(nchan, dtype=np.int32)
+    global_indices = np.arange(nchan, dtype=np.int32)
+    cross_amp = state.normal(0, 0.01, nchan)
+    ts_f = np.array(ts, order='F')
+    ts_n = ts.copy()
+    systematics_f.inject_crosstalk_inside_squid_f(
+        ts_f, local_indices, global_indices, 1, cross_amp, 2,
+        nchan, nchan, ts.shape[1])
+    numba_kernels.inject_crosstalk_inside_squid_numba(
+        ts_n, local_indices, global_indices, 1, cross_amp, 2)
+    assert np.allclose(ts_f, ts_n)
+    report('crosstalk',
+           lambda: systematics_f.inject_crosstalk_inside_squid_f(
+               ts_f, local_indices, global_indices, 1, cross_amp, 2,
+               nchan, nchan, ts.shape[1]),
+           lambda: numba_kernels.inject_crosstalk_inside_squid_numba(
+               ts_n, local_indices, global_indices, 1, cross_amp, 2),
+           args.nrepeat)
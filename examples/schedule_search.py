@@ -0,0 +1,72 @@
+#!/usr/bin/python
+"""
+Random search around the deep_patch scanning strategy: the elevation and
+the azimuth range of each CES are perturbed, and candidates are ranked
+according to their coverage metrics (see s4cmb/schedule_search.py).
+Evaluations are cached on disk, so that running again the script
+(or a refined search) only evaluates new candidates.
+
+Launch it using:
+python examples/schedule_search.py --ncandidates 32 --nproc 4
+
+Author: Julien Peloton, j.peloton@sussex.ac.uk
+"""
+from __future__ import division, absolute_import, print_function
+
+import argparse
+
+import numpy as np
+
+from s4cmb.scanning_strategy import ScanningStrategy
+from s4cmb.schedule_search import ScheduleSearch
+
+def addargs(parser):
+    """ Parse command line arguments for schedule_search """
+    parser.add_argument(
+        '--ncandidates', dest='ncandidates', type=int, default=32,
+        help='Number of candidates to evaluate.')
+    parser.add_argument(
+        '--nside', dest='nside', type=int, default=128,
+        help='Resolution of the hit maps.')
+    parser.add_argument(
+        '--nproc', dest='nproc', type=int, default=1,
+        help='Number of processes.')
+    parser.add_argument(
+        '--cache_dir', dest='cache_dir', default='schedule_search_cache',
+        help='Folder to store the metrics of the candidates.')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=0,
+        help='Seed for the random perturbations.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Search for scanning strategies')
+    addargs(parser)
+    args = parser.parse_args(None)
+
+    ## Reference strategy
+    scan = ScanningStrategy(name_strategy='deep_patch')
+    reference = list(zip(scan.elevation, scan.az_min, scan.az_max,
+                         scan.begin_LST, scan.end_LST))
+
+    ## Random perturbations of the elevation and the azimuth range
+    state = np.random.RandomState(args.seed)
+    candidates = [reference]
+    for i in range(args.ncandidates - 1):
+        candidates.append([
+            (el + state.uniform(-5, 5), az_min - shift, az_max + shift,
+             begin_LST, end_LST)
+            for (el, az_min, az_max, begin_LST, end_LST), shift in zip(
+                reference, state.uniform(-5, 5, len(reference)))])
+
+    search = ScheduleSearch(nside=args.nside, nproc=args.nproc,
+                            cache_dir=args.cache_dir)
+    metrics = search.evaluate_many(candidates)
+
+    ## Large, uniform, and well cross-linked coverage first
+    scores = [m['fsky'] * m['uniformity'] * (1 - m['crosslinking'])
+              for m in metrics]
+    for index in np.argsort(scores)[::-1][:5]:
+        print('candidate {:3d}: fsky={:.4f} uniformity={:.3f} '.format(
+            index, metrics[index]['fsky'], metrics[index]['uniformity']) +
+            'crosslinking={:.3f}'.format(metrics[index]['crosslinking']))
@@ -161,7 +161,8 @@ if __name__ == "__main__":
                             sky_speed=params.sky_speed,
                             ut1utc_fn=params.ut1utc_fn,
                             language=params.language)
-    scan.run()
+    ## Each processor generates only the CES it will use
+    scan.run(ces=range(rank, params.nces, size))
 
     ## Let's now generate our TOD from our input sky, instrument,
     ## and scanning strategy.
@@ -1,8 +1,10 @@
+import backends
 import instrument
 import scanning_strategy
 import input_sky
 import detector_pointing
 import tod
 import systematics
+import schedule_search
 import config_s4cmb
 import xpure
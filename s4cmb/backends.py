@@ -0,0 +1,228 @@
+#!/usr/bin/python
+"""
+Module to handle the (optional) backends used by the compiled kernels:
+weave (C codes compiled on-the-fly), f2py modules (fortran codes, see
+the Makefile), numba (JIT) kernels, and pyslalib.
+
+Backends are imported only on first use, so that importing s4cmb is fast
+and does not fail when one of them is missing. When a kernel is requested
+in a language whose backend is not available, we fall back on the next
+available language (fortran -> numba -> C -> python).
+
+Author: Julien Peloton, j.peloton@sussex.ac.uk
+"""
+from __future__ import division, absolute_import, print_function
+
+import importlib
+import warnings
+
+## Name of the backend: (module to import, attribute of the module).
+BACKENDS = {
+    'weave': ('weave', None),
+    'slalib': ('pyslalib.slalib', None),
+    'detector_pointing_f': ('s4cmb.detector_pointing_f',
+                            'detector_pointing_f'),
+    'scanning_strategy_f': ('s4cmb.scanning_strategy_f',
+                            'scanning_strategy_f'),
+    'tod_f': ('s4cmb.tod_f', 'tod_f'),
+    'systematics_f': ('s4cmb.systematics_f', 'systematics_f'),
+    'numba_kernels': ('s4cmb.numba_kernels', None),
+}
+
+## Hot functions: {language: backend required (None for pure python)}.
+KERNELS = {
+    'mult': {'python': None, 'C': 'weave',
+             'fortran': 'detector_pointing_f', 'numba': 'numba_kernels'},
+    'quat_to_radecpa': {'python': None, 'C': 'weave',
+                        'fortran': 'detector_pointing_f',
+                        'numba': 'numba_kernels'},
+    'azel2radecpa': {'python': None, 'fortran': 'detector_pointing_f',
+                     'numba': 'numba_kernels'},
+    'offset_detectors': {'python': None, 'fortran': 'detector_pointing_f',
+                         'numba': 'numba_kernels'},
+    'run_one_scan': {'python': None, 'C': 'weave',
+                     'fortran': 'scanning_strategy_f',
+                     'numba': 'numba_kernels'},
+    'mapmaking': {'C': 'weave', 'fortran': 'scanning_strategy_f',
+                  'numba': 'numba_kernels'},
+    'tod2map': {'fortran': 'tod_f', 'numba': 'numba_kernels'},
+    'map2tod': {'python': None, 'fortran': 'tod_f',
+                'numba': 'numba_kernels'},
+    'crosstalk': {'python': None, 'fortran': 'systematics_f',
+                  'numba': 'numba_kernels'},
+}
+
+## Order used to find a replacement for a missing backend.
+FALLBACK_ORDER = ['fortran', 'numba', 'C', 'python']
+
+_LOADED = {}
+_MISSING = {}
+_RESOLVED = {}
+
+def import_backend(name):
+    """
+    Import (once) and return the backend `name`.
+
+    Parameters
+    ----------
+    name : string
+        Name of the backend (key of BACKENDS).
+
+    Returns
+    ----------
+    module : module
+        The imported backend.
+
+    Raises
+    ----------
+    ImportError if the backend cannot be imported.
+
+    Examples
+    ----------
+    >>> slalib = import_backend('slalib')
+    >>> hasattr(slalib, 'sla_mappa')
+    True
+    """
+    if name in _LOADED:
+        return _LOADED[name]
+    if name in _MISSING:
+        raise ImportError(_MISSING[name])
+    if name not in BACKENDS:
+        raise ImportError("Backend {} is unknown.".format(name))
+
+    module_name, attribute = BACKENDS[name]
+    try:
+        module = importlib.import_module(module_name)
+        if attribute is not None:
+            module = getattr(module, attribute)
+    except (ImportError, AttributeError) as e:
+        _MISSING[name] = "Backend {} ({}) is not available: {}".format(
+            name, module_name, e)
+        raise ImportError(_MISSING[name])
+
+    _LOADED[name] = module
+    return module
+
+def is_available(name):
+    """
+    Check whether the backend `name` can be imported.
+
+    Parameters
+    ----------
+    name : string
+        Name of the backend (key of BACKENDS), or None for pure python.
+
+    Returns
+    ----------
+    available : bool
+
+    Examples
+    ----------
+    >>> is_available(None)
+    True
+    >>> is_available('a_backend_which_does_not_exist')
+    False
+    """
+    if name is None:
+        return True
+    try:
+        import_backend(name)
+        return True
+    except ImportError:
+        return False
+
+class LazyModule(object):
+    """ Placeholder for a backend, imported on first attribute access """
+    def __init__(self, name):
+        """
+        Parameters
+        ----------
+        name : string
+            Name of the backend (key of BACKENDS).
+
+        Examples
+        ----------
+        >>> slalib = LazyModule('slalib')
+        >>> fracday, status = slalib.sla_dtf2d(12, 0, 0)
+        >>> print(fracday)
+        0.5
+        """
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(import_backend(self._name), attr)
+
+def resolve_language(kernel, language):
+    """
+    Return the language actually used to run `kernel`. If the backend
+    required for `language` is not available (or the kernel has no
+    implementation in this language), the first available language in
+    FALLBACK_ORDER is used instead.
+
+    Parameters
+    ----------
+    kernel : string
+        Name of the kernel (key of KERNELS).
+    language : string
+        Requested language: python, C, fortran, or numba.
+
+    Returns
+    ----------
+    language : string
+        The language used.
+
+    Raises
+    ----------
+    ImportError if no implementation of the kernel can be used.
+
+    Examples
+    ----------
+    >>> resolve_language('crosstalk', 'python')
+    'python'
+    >>> KERNELS['fake'] = {'python': None, 'fortran': 'not_compiled'}
+    >>> with warnings.catch_warnings(record=True) as w:
+    ...     warnings.simplefilter('always')
+    ...     language = resolve_language('fake', 'fortran')
+    >>> print(language)
+    python
+    >>> print(w[0].message)
+    Backend for fake in fortran not available. Use python instead.
+    >>> resolved_kernels()['fake']
+    'python'
+    >>> _ = KERNELS.pop('fake'), _RESOLVED.pop('fake')
+    """
+    implementations = KERNELS[kernel]
+    if language in implementations and \
+            is_available(implementations[language]):
+        resolved = language
+    else:
+        candidates = [lang for lang in FALLBACK_ORDER
+                      if lang in implementations and
+                      is_available(implementations[lang])]
+        if len(candidates) == 0:
+            raise ImportError(
+                "No backend available for {} ".format(kernel) +
+                "(requested language={}).".format(language))
+        resolved = candidates[0]
+        if _RESOLVED.get(kernel) != resolved:
+            warnings.warn("Backend for {} in {} not available. ".format(
+                kernel, language) + "Use {} instead.".format(resolved))
+
+    _RESOLVED[kernel] = resolved
+    return resolved
+
+def resolved_kernels():
+    """
+    Return the language to which each kernel has been resolved so far.
+
+    Returns
+    ----------
+    resolved : dictionary
+        {kernel: language}. Kernels not yet used are not listed.
+    """
+    return dict(_RESOLVED)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
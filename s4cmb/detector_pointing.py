@@ -12,15 +12,24 @@ Author: Julien Peloton, j.peloton@sussex.ac.uk
 """
 from __future__ import division, absolute_import, print_function
 
+import os
+import hashlib
+import tempfile
+
 import healpy as hp
 import numpy as np
 from numpy import cos
 from numpy import sin
 from numpy import tan
-from pyslalib import slalib
-import weave
 
-from s4cmb.detector_pointing_f import detector_pointing_f
+from s4cmb.backends import LazyModule
+from s4cmb.backends import resolve_language
+
+## Backends are imported on first use (see backends.py)
+slalib = LazyModule('slalib')
+weave = LazyModule('weave')
+detector_pointing_f = LazyModule('detector_pointing_f')
+numba_kernels = LazyModule('numba_kernels')
 
 sec2deg = 360.0/86400.0
 d2r = np.pi / 180.0
@@ -28,7 +37,85 @@ ASTROMETRIC_GEOCENTRIC = 0
 APPARENT_GEOCENTRIC = 1
 APPARENT_TOPOCENTRIC = 2
 
-def get_ut1utc(ut1utc_fn, mjd):
+## UT1-UTC tables already loaded, keyed by filename (shared by all
+## Pointing instances of the process).
+_UT1UTC_TABLES = {}
+
+def load_ut1utc_table(ut1utc_fn):
+    """
+    Load the UT1-UTC table (MJD, UT1-UTC) stored in `ut1utc_fn`.
+    The table is parsed only once per process. A binary copy (.npy) is
+    also stored next to the text file (if possible), and used
+    instead of the text file for the next processes.
+
+    Parameters
+    ----------
+    ut1utc_fn : string
+        Filename where ut1utc are stored.
+
+    Returns
+    ----------
+    umjds : 1d array
+        Dates (MJD) of the table.
+    ut1utcs : 1d array
+        Time corrections (UT1-UTC) of the table in second.
+
+    Examples
+    ----------
+    >>> umjds, ut1utcs = load_ut1utc_table('s4cmb/data/ut1utc.ephem')
+    >>> print(umjds[0], round(ut1utcs[0], 3))
+    55927.0 -0.419
+    """
+    if ut1utc_fn in _UT1UTC_TABLES:
+        return _UT1UTC_TABLES[ut1utc_fn]
+
+    binary_fn = ut1utc_fn + '.npy'
+    table = None
+    if (os.path.isfile(binary_fn) and
+            os.path.getmtime(binary_fn) >= os.path.getmtime(ut1utc_fn)):
+        try:
+            table = np.load(binary_fn)
+        except (IOError, OSError, ValueError):
+            ## Unreadable binary copy, use the text file instead.
+            table = None
+
+    if table is None:
+        table = np.loadtxt(ut1utc_fn, usecols=(1, 2)).T
+        save_ut1utc_binary(binary_fn, table)
+
+    _UT1UTC_TABLES[ut1utc_fn] = (table[0], table[1])
+    return _UT1UTC_TABLES[ut1utc_fn]
+
+def save_ut1utc_binary(binary_fn, table):
+    """
+    Store the binary copy of the UT1-UTC table. The table is first written
+    in a temporary file (in the same folder) which is then renamed, so
+    that concurrent processes never see a partial file. Nothing is done
+    if the folder is read-only.
+
+    Parameters
+    ----------
+    binary_fn : string
+        Name of the binary (.npy) file.
+    table : 2d array
+        The table (MJD, UT1-UTC) of size (2, n).
+    """
+    try:
+        fd, tmp = tempfile.mkstemp(
+            suffix='.npy', dir=os.path.dirname(os.path.abspath(binary_fn)))
+    except (IOError, OSError):
+        ## Read-only location, we will parse the text file next time.
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.rename(tmp, binary_fn)
+    except (IOError, OSError):
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+def get_ut1utc(ut1utc_fn, mjd, interpolate=False):
     """
     Return the time correction to UTC.
 
@@ -36,21 +123,34 @@ def get_ut1utc(ut1utc_fn, mjd):
     ----------
     ut1utc_fn : string
         Filename where ut1utc are stored.
-    mjd : float
-        Date (in MJD) to correct for.
+    mjd : float or 1d array
+        Date(s) (in MJD) to correct for.
+    interpolate : bool, optional
+        If True, linearly interpolate the table. Otherwise (default),
+        take the first entry of the table at or after `mjd`.
 
     Returns
     ----------
-    ut1utc : float
+    ut1utc : float or 1d array
         Contain the time correction to apply to MJD values.
 
     Examples
     ----------
     >>> round(get_ut1utc('s4cmb/data/ut1utc.ephem', 56293), 3)
     0.277
+
+    Vectorised and interpolated lookup
+    >>> mjds = np.array([56293., 56293.5, 56294.])
+    >>> print(np.round(get_ut1utc('s4cmb/data/ut1utc.ephem', mjds,
+    ...     interpolate=True), 4))
+    [ 0.2771  0.2766  0.2761]
     """
-    umjds, ut1utcs = np.loadtxt(ut1utc_fn, usecols=(1, 2)).T
-    uindex = np.searchsorted(umjds, mjd)
+    umjds, ut1utcs = load_ut1utc_table(ut1utc_fn)
+
+    if interpolate:
+        return np.interp(mjd, umjds, ut1utcs)
+
+    uindex = np.minimum(np.searchsorted(umjds, mjd), len(umjds) - 1)
     ut1utc = ut1utcs[uindex]
 
     return ut1utc
@@ -60,7 +160,9 @@ class Pointing():
     def __init__(self, az_enc, el_enc, time, value_params,
                  allowed_params='ia ie ca an aw',
                  ra_src=0.0, dec_src=0.0, lat=-22.958,
-                 ut1utc_fn='s4cmb/data/ut1utc.ephem'):
+                 ut1utc_fn='s4cmb/data/ut1utc.ephem', language='python',
+                 knot_cadence=None, max_interp_error=1., cache_dir=None,
+                 coord='C', boresight_angle=0.):
         """
         Apply pointing model with parameters `value_params` and
         names `allowed_params` to encoder az,el. Order of terms is
@@ -96,7 +198,10 @@ class Pointing():
             Encoder time (UTC) in mjd
         value_params : 1d array
             Value of the pointing model parameters (see instrument.py).
-            In degrees (see below for full description)
+            In degrees (see below for full description). The boresight
+            pointing is computed for one set of parameters. Several sets
+            can be evaluated afterwards on the same encoder timeline
+            with `apply_pointing_model`.
         allowed_params : list of string, optional
             Name of the pointing model parameters used in `value_params`.
         ra_src : float, optional
@@ -115,6 +220,47 @@ class Pointing():
             is the same quantity, but converted from solar to sidereal
             seconds and expressed in radians.
             WTF?
+        language : string, optional
+            Language used to go from az/el to RA/Dec/PA. Default is python,
+            that is slalib is called sample-by-sample (slow but it is the
+            reference). With language=fortran, the whole timeline is
+            processed in one call by a compiled kernel (you need first
+            to compile it, see the Makefile), or JIT-compiled with
+            language=numba. There is no weave version of this kernel,
+            so language=C uses a vectorised numpy version.
+        knot_cadence : float, optional
+            If not None, the full astrometry (az/el -> RA/Dec/PA) is only
+            computed at knots: the scan turnarounds, the first and last
+            samples, and every `knot_cadence` seconds. The boresight
+            quaternions are then interpolated (SLERP) between knots.
+            Default is None, that is the astrometry is computed for all
+            samples.
+        max_interp_error : float, optional
+            Maximum angular error (in arcsecond) allowed for the interpolated
+            quaternions if `knot_cadence` is not None. Intervals between
+            knots are split until the error measured at their mid-points
+            is below this value. Default is 1 arcsecond.
+        cache_dir : string, optional
+            If not None, folder where the boresight quaternions (and
+            RA/Dec/PA) are cached on disk. Entries are keyed by a hash of
+            the inputs (encoder az/el/time, pointing model, time correction,
+            source center, latitude and interpolation parameters), and
+            are loaded memory-mapped when available. Default is None
+            (no cache).
+        coord : string, optional
+            Coordinate system of the output detector pointing (i.e. of the
+            input sky map): C (equatorial, default), G (galactic) or E
+            (ecliptic). The rotation from equatorial coordinates is
+            included in the boresight quaternions, so that detector
+            RA/Dec/PA come out directly in this frame.
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight (deck angle),
+            in degree. It enters as a fixed quaternion between the boresight
+            quaternions and the detector offsets, so it is not part of the
+            astrometry: it can be changed afterwards (attribute
+            `boresight_angle`, in radian) without recomputing the
+            boresight quaternions, and it is not part of the cache key.
+            Default is 0.
 
         Examples
         ----------
@@ -135,89 +281,191 @@ class Pointing():
         self.ut1utc_fn = ut1utc_fn
         self.ra_src = ra_src
         self.dec_src = dec_src
+        self.language = language
+        self.knot_cadence = knot_cadence
+        self.max_interp_error = max_interp_error
+        self.cache_dir = cache_dir
+        self.coord = coord
+        self.qframe = get_frame_quaternion(self.coord)
+        self.boresight_angle = boresight_angle * d2r
 
         self.ut1utc = get_ut1utc(self.ut1utc_fn, self.time[0])
 
+        if np.ndim(self.value_params) != 1:
+            raise ValueError(
+                "Pointing takes one set of pointing model parameters " +
+                "(1d value_params). Use apply_pointing_model to evaluate " +
+                "several sets at once.")
+
+        ## Trigonometric basis of the pointing model, computed on first use
+        self.azbasis = None
+        self.elbasis = None
+
         ## Initialise the object
         self.az, self.el = self.apply_pointing_model()
-        self.azel2radec()
+        if self.cache_dir is None or not self.load_from_cache():
+            self.azel2radec()
+            if self.cache_dir is not None:
+                self.save_to_cache()
 
-    def apply_pointing_model(self):
+    def cache_key(self):
         """
-        Apply pointing corrections specified by the pointing model.
+        Hash of all inputs defining the boresight quaternions.
 
         Returns
         ----------
-        az : 1d array
-            The corrected azimuth in arcminutes.
-        el : 1d array
-            The corrected elevation in arcminutes.
-        """
-        assert len(self.value_params) == len(self.allowed_params.split()), \
-            AssertionError("Vector containing parameters " +
-                           "(value_params) has to have the same " +
-                           "length than the vector containing names " +
-                           "(allowed_params).")
-
-        ## Here are many parameters defining a pointing model.
-        ## Of course, we do not use all of them. They are zero by default,
-        ## and only those specified by the user will be used.
-        params = {p: 0.0 for p in ['an', 'aw', 'an2', 'aw2', 'an4',
-                                   'aw4', 'npae', 'ca', 'ia', 'ie', 'tf',
-                                   'tfs', 'ref', 'dt', 'elt', 'ta1',
-                                   'te1', 'sa', 'se', 'sa2',
-                                   'se2', 'sta', 'ste', 'sta2', 'ste2']}
-
-        for param in params:
-            if param in self.allowed_params.split():
-                index = self.allowed_params.split().index(param)
-                params[param] = self.value_params[index]
-
-        params['dt'] *= sec2deg
-
-        ## Azimuth
-        azd = -params['an'] * sin(self.az_enc) * sin(self.el_enc)
-        azd -= params['aw'] * cos(self.az_enc) * sin(self.el_enc)
-
-        azd -= -params['an2'] * sin(2 * self.az_enc) * sin(self.el_enc)
-        azd -= params['aw2'] * cos(2 * self.az_enc) * sin(self.el_enc)
+        key : string
+            Hexadecimal digest identifying the pointing.
 
-        azd -= -params['an4'] * sin(4 * self.az_enc) * sin(self.el_enc)
-        azd -= params['aw4'] * cos(4 * self.az_enc) * sin(self.el_enc)
-
-        azd += params['npae'] * sin(self.el_enc)
-        azd -= params['ca']
-        azd += params['ia'] * cos(self.el_enc)
+        Examples
+        ----------
+        >>> allowed_params, value_params, az_enc, el_enc, time = \
+            load_fake_pointing()
+        >>> p1 = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22.)
+        >>> p2 = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22.5)
+        >>> p1.cache_key() == p2.cache_key()
+        False
+        """
+        h = hashlib.sha1()
+        for arr in [self.az_enc, self.el_enc, self.time,
+                    np.asarray(self.value_params, dtype=float)]:
+            h.update(np.ascontiguousarray(arr, dtype=float).tobytes())
+        h.update(repr((self.allowed_params, float(self.ut1utc),
+                       self.ra_src, self.dec_src, self.lat,
+                       self.knot_cadence, self.max_interp_error,
+                       self.coord)).encode())
+        return h.hexdigest()
+
+    def load_from_cache(self):
+        """
+        Load the boresight quaternions, RA/Dec/PA and mean parallactic angle
+        from `self.cache_dir` if they have been stored before. Arrays are
+        memory-mapped (read-only).
 
-        azd += params['dt'] * (
-            -sin(self.lat) + cos(self.az_enc) *
-            cos(self.lat) * tan(self.el_enc))
+        Returns
+        ----------
+        found : bool
+            True if the pointing was found in the cache.
 
-        ## Elevation
-        eld = params['an'] * cos(self.az_enc)
-        eld -= params['aw'] * sin(self.az_enc)
-        eld -= params['an2'] * cos(2 * self.az_enc)
-        eld -= params['aw2'] * sin(2 * self.az_enc)
-        eld -= params['an4'] * cos(4 * self.az_enc)
-        eld -= params['aw4'] * sin(4 * self.az_enc)
+        Examples
+        ----------
+        >>> import shutil
+        >>> allowed_params, value_params, az_enc, el_enc, time = \
+            load_fake_pointing()
+        >>> cache = tempfile.mkdtemp()
+        >>> p1 = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22., cache_dir=cache)
+        >>> p2 = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22., cache_dir=cache)
+        >>> print(isinstance(p2.q, np.memmap), np.all(p1.q == p2.q))
+        True True
+        >>> shutil.rmtree(cache)
+        """
+        path = os.path.join(self.cache_dir, self.cache_key())
+        fns = [os.path.join(path, '{}.npy'.format(name))
+               for name in ['q', 'ra', 'dec', 'pa', 'meanpa']]
+        if not all([os.path.isfile(fn) for fn in fns]):
+            return False
+
+        self.q, self.ra, self.dec, self.pa = [
+            np.load(fn, mmap_mode='r') for fn in fns[:-1]]
+        self.meanpa = float(np.load(fns[-1]))
+
+        self.quaternion = Quaternion(self.ra, self.dec, self.pa,
+                                     self.ra_src, self.dec_src,
+                                     qframe=self.qframe)
+        return True
+
+    def save_to_cache(self):
+        """
+        Store the boresight quaternions, RA/Dec/PA and mean parallactic
+        angle in `self.cache_dir` as .npy files. Files are first written
+        in a temporary folder which is then renamed, so that concurrent
+        processes never see partial entries.
+        """
+        path = os.path.join(self.cache_dir, self.cache_key())
+        if os.path.isdir(path):
+            return
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                ## Someone else created it in the meantime
+                pass
+
+        tmp = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, arr in zip(['q', 'ra', 'dec', 'pa', 'meanpa'],
+                             [self.q, self.ra, self.dec, self.pa,
+                              self.meanpa]):
+            np.save(os.path.join(tmp, '{}.npy'.format(name)), arr)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            ## Another process stored the same entry first
+            for fn in os.listdir(tmp):
+                os.remove(os.path.join(tmp, fn))
+            os.rmdir(tmp)
+
+    def apply_pointing_model(self, value_params=None):
+        """
+        Apply pointing corrections specified by the pointing model.
+        The trigonometric basis of the model is computed on the first call
+        and kept (attributes `azbasis` and `elbasis`), and each set of
+        parameters is then applied as a matrix product. Hence several sets
+        of parameters (e.g. Monte Carlo of pointing errors) can be
+        evaluated at once on the encoder timeline.
 
-        eld -= params['ie']
-        eld += params['tf'] * cos(self.el_enc)
-        eld += params['tfs'] * sin(self.el_enc)
-        eld -= params['ref'] / tan(self.el_enc)
+        Parameters
+        ----------
+        value_params : 1d or 2d array, optional
+            Value of the pointing model parameters. Either one set of size
+            nparams, or K sets in an array of size (K, nparams).
+            Default is self.value_params.
 
-        eld += -params['dt'] * cos(self.lat) * sin(self.az_enc)
+        Returns
+        ----------
+        az : 1d or 2d array
+            The corrected azimuth in radian (nsamples or (K, nsamples)).
+        el : 1d or 2d array
+            The corrected elevation in radian (nsamples or (K, nsamples)).
 
-        eld += params['elt'] * (self.time - np.min(self.time))
+        Examples
+        ----------
+        >>> allowed_params, value_params, az_enc, el_enc, time = \
+            load_fake_pointing()
+        >>> pointing = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22.)
+        >>> state = np.random.RandomState(0)
+        >>> values_mc = value_params + state.normal(
+        ...     0, 1, (3, len(value_params)))
+        >>> az, el = pointing.apply_pointing_model(values_mc)
+        >>> print(az.shape)
+        (3, 100)
+        >>> az1, el1 = pointing.apply_pointing_model(values_mc[1])
+        >>> assert np.allclose(az[1], az1) and np.allclose(el[1], el1)
+        >>> print(pointing.azbasis.shape)
+        (5, 100)
+        """
+        if value_params is None:
+            value_params = self.value_params
+        value_params = np.asarray(value_params, dtype=float)
 
-        ## Convert back in radian and apply to the encoder values.
-        azd *= np.pi / (180.0 * 60.)
-        eld *= np.pi / (180.0 * 60.)
+        names = self.allowed_params.split()
+        assert value_params.shape[-1] == len(names), \
+            AssertionError("Vector containing parameters " +
+                           "(value_params) has to have the same " +
+                           "length than the vector containing names " +
+                           "(allowed_params).")
 
-        azd /= np.cos(self.el_enc)
+        if self.azbasis is None:
+            self.azbasis, self.elbasis = pointing_model_basis(
+                self.az_enc, self.el_enc, self.time, self.lat, names)
 
-        az = self.az_enc - azd
-        el = self.el_enc - eld
+        az = self.az_enc - np.dot(value_params, self.azbasis)
+        el = self.el_enc - np.dot(value_params, self.elbasis)
 
         return az, el
 
@@ -235,31 +483,52 @@ class Pointing():
         ...     allowed_params, lat=-22.)
         >>> print(round(pointing.ra[2], 2), round(pointing.dec[2], 2))
         0.7 0.66
+
+        Compute the astrometry only at a few knots, and interpolate
+        the quaternions in between (1 arcsecond accuracy).
+        >>> pointing_knots = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22., knot_cadence=30.,
+        ...     max_interp_error=1.)
+        >>> err = quat_angular_distance(pointing_knots.q, pointing.q)
+        >>> assert np.max(err) < 1. / 3600. * d2r
+        >>> print(round(pointing_knots.ra[2], 2),
+        ...     round(pointing_knots.dec[2], 2))
+        0.7 0.66
         """
-        self.ra, self.dec, self.pa = self.azel2radecpa()
-        v_ra = self.ra
-        v_dec = self.dec
-        v_pa = self.pa
-        v_ra_src = self.ra_src
-        v_dec_src = self.dec_src
+        if self.knot_cadence is None:
+            self.ra, self.dec, self.pa = self.azel2radecpa()
+            v_ra = self.ra
+            v_dec = self.dec
+            v_pa = self.pa
+            v_ra_src = self.ra_src
+            v_dec_src = self.dec_src
 
-        self.meanpa = np.median(v_pa)
+            self.quaternion = Quaternion(v_ra, v_dec, v_pa,
+                                         v_ra_src, v_dec_src,
+                                         qframe=self.qframe)
 
-        self.quaternion = Quaternion(v_ra, v_dec, v_pa,
-                                     v_ra_src, v_dec_src)
+            q = self.quaternion.offset_radecpa_makequat()
+        else:
+            q = self.interpolate_boresight()
 
-        q = self.quaternion.offset_radecpa_makequat()
+        self.meanpa = np.median(self.pa)
 
         assert q.shape == (self.az.size, 4), \
             AssertionError("Wrong size for the quaternions!")
 
         self.q = q
 
-    def azel2radecpa(self):
+    def azel2radecpa(self, index=None):
         """
         Given Az/El, time, and time correction returns RA/Dec and parallactic
         angles.
 
+        Parameters
+        ----------
+        index : 1d array of int, optional
+            If not None, compute RA/Dec/PA only for those samples.
+            Default is None (all samples).
+
         Examples
         ----------
         Go from az/el -> ra/dec/pa
@@ -270,13 +539,105 @@ class Pointing():
         >>> ra, dec, pa = pointing.azel2radecpa()
         >>> print(round(ra[0], 2), round(dec[0], 2), round(pa[0], 2))
         0.56 0.67 3.13
+
+        Same thing, but processing the whole timeline at once in fortran.
+        Results agree with slalib up to numerical noise.
+        >>> pointing_f = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22., language='fortran')
+        >>> ra_f, dec_f, pa_f = pointing_f.azel2radecpa()
+        >>> assert np.allclose(ra_f, ra, rtol=0., atol=1e-10)
+        >>> assert np.allclose(dec_f, dec, rtol=0., atol=1e-10)
+        >>> assert np.allclose(pa_f, pa, rtol=0., atol=1e-6)
         """
+        time, az, el = self.time, self.az, self.el
+        if index is not None:
+            time, az, el = time[index], az[index], el[index]
+
         ## TODO pass lon, lat, etc from the ScanningStrategy module!
         converter = Azel2Radec(self.time[0], self.ut1utc)
-        vconv = np.vectorize(converter.azel2radecpa)
-        ra, dec, pa = vconv(self.time, self.az, self.el)
+        if self.language == 'python':
+            vconv = np.vectorize(converter.azel2radecpa)
+            ra, dec, pa = vconv(time, az, el)
+        else:
+            ra, dec, pa = converter.azel2radecpa_batch(
+                time, az, el, language=self.language)
         return ra, dec, pa
 
+    def interpolate_boresight(self):
+        """
+        Compute RA/Dec/PA only at knots (turnarounds, first and last
+        samples, and every `knot_cadence` seconds), and interpolate the
+        boresight quaternions in between using SLERP. Intervals are split
+        until the angular error at their mid-points is below
+        `max_interp_error`. RA/Dec/PA are linearly interpolated.
+
+        Returns
+        ----------
+        q : array
+            Quaternions array (interpolated), of size (nsamples, 4).
+        """
+        n = self.time.size
+        tol = self.max_interp_error / 3600. * d2r
+
+        knots = get_pointing_knots(
+            self.az, (self.time - self.time[0]) * 86400., self.knot_cadence)
+
+        ## Exact astrometry at knots
+        ra, dec, pa = self.azel2radecpa(index=knots)
+        quaternion = Quaternion(ra, dec, pa, self.ra_src, self.dec_src,
+                                qframe=self.qframe)
+        qknots = quaternion.offset_radecpa_makequat().reshape((-1, 4))
+
+        ## Check the interpolation at the middle of each interval, and add
+        ## the mid-points as new knots where it is not accurate enough.
+        ## Only the intervals split at the previous pass are checked again.
+        left, right = knots[:-1], knots[1:]
+        while True:
+            mid = (left + right) // 2
+            tocheck = (mid > left)
+            if not np.any(tocheck):
+                break
+            left, mid, right = left[tocheck], mid[tocheck], right[tocheck]
+
+            ra_mid, dec_mid, pa_mid = self.azel2radecpa(index=mid)
+            q_mid = Quaternion(ra_mid, dec_mid, pa_mid, self.ra_src,
+                               self.dec_src, qframe=self.qframe)
+            q_mid = q_mid.offset_radecpa_makequat()
+            q_mid = q_mid.reshape((-1, 4))
+
+            err = quat_angular_distance(
+                interpolate_quaternions(knots, qknots, mid), q_mid)
+            bad = err > tol
+            if not np.any(bad):
+                break
+
+            ## Insert the new knots
+            knots = np.concatenate((knots, mid[bad]))
+            order = np.argsort(knots)
+            knots = knots[order]
+            qknots = np.concatenate((qknots, q_mid[bad]))[order]
+            ra = np.concatenate((ra, ra_mid[bad]))[order]
+            dec = np.concatenate((dec, dec_mid[bad]))[order]
+            pa = np.concatenate((pa, pa_mid[bad]))[order]
+
+            ## The two halves of each split interval are checked next
+            left = np.concatenate((left[bad], mid[bad]))
+            right = np.concatenate((mid[bad], right[bad]))
+
+        self.knots = knots
+
+        index = np.arange(n)
+        self.ra = np.mod(np.interp(index, knots, np.unwrap(ra)), 2 * np.pi)
+        self.dec = np.interp(index, knots, dec)
+        self.pa = np.interp(index, knots, np.unwrap(pa))
+        self.pa = np.mod(self.pa + np.pi, 2 * np.pi) - np.pi
+
+        self.quaternion = Quaternion(self.ra, self.dec, self.pa,
+                                     self.ra_src, self.dec_src,
+                                     qframe=self.qframe)
+
+        return interpolate_quaternions(knots, qknots, index)
+
     def radec2azel(self):
         """
         Given RA/Dec, time, and time correction returns Az/El.
@@ -320,9 +681,85 @@ class Pointing():
             Parallactic angle in radian.
         """
         ra, dec, pa = self.quaternion.offset_radecpa_applyquat(
-            self.q, -azd, -eld)
+            self.q, -azd, -eld, boresight_angle=self.boresight_angle)
         return ra, dec, pa
 
+    def offset_detectors(self, azd, eld):
+        """
+        Same as offset_detector but for many detectors at once.
+        The boresight quaternions are read only once for all detectors,
+        and the computation is done in one call (fortran if
+        `self.language` is fortran, numpy otherwise).
+
+        Parameters
+        ----------
+        azd : 1d array
+            The azimuth offsets of the detectors in radian (size ndet).
+        eld : 1d array
+            The elevation offsets of the detectors in radian (size ndet).
+
+        Returns
+        ----------
+        ra : ndarray
+            Right ascension in radian (ndet, nsamples).
+        dec : ndarray
+            Declination in radian (ndet, nsamples).
+        pa : ndarray
+            Parallactic angle in radian (ndet, nsamples).
+
+        Examples
+        ----------
+        >>> allowed_params, value_params, az_enc, el_enc, time = \
+            load_fake_pointing()
+        >>> pointing = Pointing(az_enc, el_enc, time, value_params,
+        ...     allowed_params, lat=-22.)
+        >>> azd = np.array([0.01, -0.02]); eld = np.array([0.005, 0.01])
+        >>> ra, dec, pa = pointing.offset_detectors(azd, eld)
+        >>> print(ra.shape)
+        (2, 100)
+        >>> ra1, dec1, pa1 = pointing.offset_detector(azd[1], eld[1])
+        >>> assert np.allclose(ra[1], ra1) and np.allclose(dec[1], dec1)
+        >>> assert np.allclose(pa[1], pa1)
+
+        Rotating the focal plane around the boresight reuses the
+        boresight quaternions: the polarisation angle of the boresight
+        changes by the same amount, and offsets are rotated.
+        >>> pointing.boresight_angle = 30. * d2r
+        >>> ra0, dec0, pa0 = pointing.offset_detector(0., 0.)
+        >>> print(round((pa0[0] - pointing.pa[0]) / d2r % 360., 6))
+        30.0
+        >>> pointing.boresight_angle = np.pi / 2.
+        >>> ra2, dec2, pa2 = pointing.offset_detectors(
+        ...     np.array([0.01]), np.array([0.]))
+        >>> pointing.boresight_angle = 0.
+        >>> ra3, dec3, pa3 = pointing.offset_detector(0., 0.01)
+        >>> assert np.allclose(ra2[0], ra3) and np.allclose(dec2[0], dec3)
+        """
+        return self.quaternion.offset_radecpa_applyquat_alldet(
+            self.q, -np.asarray(azd), -np.asarray(eld),
+            language=self.language, boresight_angle=self.boresight_angle)
+
+    def detector_quaternions(self, azd, eld):
+        """
+        Quaternions of the detector offsets, such that the pointing of
+        the detectors is given by the products self.q * qpix
+        (see offset_detectors).
+
+        Parameters
+        ----------
+        azd : 1d array
+            The azimuth offsets of the detectors in radian (size ndet).
+        eld : 1d array
+            The elevation offsets of the detectors in radian (size ndet).
+
+        Returns
+        ----------
+        qpix : ndarray
+            Quaternions of size (ndet, 4).
+        """
+        return self.quaternion.offset_quaternions(
+            -np.asarray(azd), -np.asarray(eld), self.boresight_angle)
+
 class Azel2Radec(object):
     """ Class to handle az/el <-> ra/dec conversion """
     def __init__(self, mjd, ut1utc,
@@ -426,6 +863,84 @@ class Azel2Radec(object):
 
         return ra, dec, pa
 
+    def azel2radecpa_batch(self, mjd, az, el, language='fortran',
+                           amprms_cadence=60.):
+        """
+        Given Az/El and time returns RA/Dec and parallactic angle
+        for a whole timeline at once. This is the array version of
+        `azel2radecpa`: slalib is only used to compute the mean-to-apparent
+        parameters on a coarse time grid (they vary on time scales of days),
+        and the rest of the computation (observed to apparent place,
+        apparent to mean place, and bearing) is done for all samples in a
+        single call.
+
+        Parameters
+        ----------
+        mjd : 1d array
+            Dates in MJD.
+        az : 1d array
+            Azimuth in radian.
+        el : 1d array
+            Elevation in radian.
+        language : string, optional
+            Language used for the core computation: fortran (compiled
+            kernel, see the Makefile), numba (JIT), or python (vectorised
+            numpy). Any other value uses the numpy version.
+        amprms_cadence : float, optional
+            Time interval in seconds between two evaluations of the
+            mean-to-apparent parameters. They are linearly interpolated
+            in between. Default is 60 seconds.
+
+        Returns
+        ----------
+        ra : 1d array
+            Right ascension in radian.
+        dec : 1d array
+            Declination in radian.
+        pa : 1d array
+            Parallactic angle in radian.
+
+        Examples
+        ----------
+        >>> converter = Azel2Radec(56293., 0.277)
+        >>> mjd = 56293. + np.arange(10) / 86400.
+        >>> az = np.linspace(0.1, 0.2, 10)
+        >>> el = np.ones(10) * 0.8
+        >>> ra, dec, pa = converter.azel2radecpa_batch(mjd, az, el,
+        ...     language='python')
+        >>> ra0, dec0, pa0 = converter.azel2radecpa(mjd[3], az[3], el[3])
+        >>> assert np.allclose([ra[3], dec[3]], [ra0, dec0],
+        ...     rtol=0., atol=1e-10)
+        >>> assert abs(pa[3] - pa0) < 1e-6
+        """
+        mjd = np.asarray(mjd, dtype=np.float64)
+        az = np.asarray(az, dtype=np.float64)
+        el = np.asarray(el, dtype=np.float64)
+
+        ## Mean-to-apparent parameters on a coarse grid.
+        mjd0, dmjd, amprms = get_amprms_knots(
+            self.epequi, mjd, amprms_cadence)
+
+        if language in ['fortran', 'numba']:
+            language = resolve_language('azel2radecpa', language)
+
+        if language == 'fortran':
+            ra, dec, pa, slow = azel2radecpa_fortran(
+                mjd, az, el, amprms, self.aoprms, mjd0, dmjd)
+        elif language == 'numba':
+            ra, dec, pa, slow = azel2radecpa_numba(
+                mjd, az, el, amprms, self.aoprms, mjd0, dmjd)
+        else:
+            ra, dec, pa, slow = azel2radecpa_python(
+                mjd, az, el, amprms, self.aoprms, mjd0, dmjd)
+
+        ## The kernels use the fast two-constant refraction model,
+        ## valid above ~14 degrees elevation. Fall back to slalib below.
+        for i in np.where(slow)[0]:
+            ra[i], dec[i], pa[i] = self.azel2radecpa(mjd[i], az[i], el[i])
+
+        return ra, dec, pa
+
     def radec2azel(self, mjd, ra, dec):
         """
         Given RA/Dec and time returns Az/El.
@@ -455,7 +970,7 @@ class Azel2Radec(object):
 
 class Quaternion():
     """ Class to handle quaternions """
-    def __init__(self, ra, dec, pa, v_ra_src, v_dec_src):
+    def __init__(self, ra, dec, pa, v_ra_src, v_dec_src, qframe=None):
         """
         Once you have RA/Dec coordinates of the reference detector, one
         can efficiently use quaternions to compute each detector pointing in
@@ -474,6 +989,10 @@ class Quaternion():
             RA of the source (center of the patch for example).
         v_dec_src : float
             Dec of the source (center of the patch for example).
+        qframe : 1d array, optional
+            Quaternion of the rotation from equatorial coordinates to the
+            output frame (see get_frame_quaternion), applied before the
+            recentering on the source. Default is None (equatorial).
 
         """
         self.ra = ra
@@ -481,6 +1000,7 @@ class Quaternion():
         self.pa = pa
         self.v_ra_src = v_ra_src
         self.v_dec_src = v_dec_src
+        self.qframe = qframe
 
     def offset_radecpa_makequat(self):
         """
@@ -501,12 +1021,15 @@ class Quaternion():
 
         q = mult(qdec, qpa)
         q = mult(qra, q)
+        if self.qframe is not None:
+            q = mult(self.qframe, q)
         q = mult(qracen, q)
         q = mult(qdeccen, q)
 
         return q
 
-    def offset_radecpa_applyquat(self, q, azd, eld):
+    def offset_radecpa_applyquat(self, q, azd, eld, language='fortran',
+                                 boresight_angle=0.):
         """
         Apply pre-computed quaternions to obtain
         desired RA/Dec and parallactic angle from az/el of the detector.
@@ -519,6 +1042,14 @@ class Quaternion():
             Azimuth of the detector.
         eld : 1d array
             Elevation of the detector.
+        language : string, optional
+            Language used for the quaternion products and the conversion
+            to angles: fortran (default), numba, C or python. If the backend is
+            not available, another language is used (see backends.py).
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight in radian.
+            It is combined with the detector offset quaternion
+            (q * qrot * qpix), so that it costs nothing per sample.
 
         Returns
         ----------
@@ -537,17 +1068,807 @@ class Quaternion():
         qeld = euler_quaty(-eld)
 
         qpix = mult(qazd, qeld)[0]
+        if boresight_angle != 0.:
+            qpix = mult(euler_quatx(-boresight_angle), qpix)[0]
 
         # Inlining this is a 30x speed up
-        seq = mult_fortran(q, qpix)
+        mult_kernel = {'fortran': mult_fortran, 'numba': mult_numba,
+                       'C': mult_inline,
+                       'python': mult}[resolve_language('mult', language)]
+        seq = mult_kernel(q, qpix)
 
         assert seq.shape[1] == 4, AssertionError("Wrong size!")
 
         n = seq.shape[0]
-        phi, theta, psi = quat_to_radecpa_fortran(seq)
+        quat_to_radecpa = {
+            'fortran': quat_to_radecpa_fortran,
+            'numba': quat_to_radecpa_numba,
+            'C': quat_to_radecpa_c,
+            'python': quat_to_radecpa_python}[
+                resolve_language('quat_to_radecpa', language)]
+        phi, theta, psi = quat_to_radecpa(seq)
 
         return psi, -theta, -phi
 
+    def offset_radecpa_applyquat_alldet(self, q, azd, eld, language='fortran',
+                                        boresight_angle=0.):
+        """
+        Apply pre-computed quaternions to obtain desired RA/Dec and
+        parallactic angle for many detectors at once.
+
+        Parameters
+        ----------
+        q : array
+            Quaternions array of size (nsamples, 4).
+        azd : 1d array
+            Azimuth of the detectors (size ndet).
+        eld : 1d array
+            Elevation of the detectors (size ndet).
+        language : string, optional
+            If fortran or numba, use the compiled kernel.
+            Otherwise use numpy.
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight in radian
+            (see offset_radecpa_applyquat).
+
+        Returns
+        ----------
+        ra : ndarray
+            RA (if input -azd, -eld) of size (ndet, nsamples).
+        dec : ndarray
+            Dec (if input -azd, -eld) of size (ndet, nsamples).
+        pa : ndarray
+            PA (if input -azd, -eld) of size (ndet, nsamples).
+        """
+        assert len(q.shape) == 2, AssertionError("Wrong quaternion size!")
+        assert q.shape[1] == 4, AssertionError("Wrong quaternion size!")
+        azd = np.atleast_1d(azd)
+        eld = np.atleast_1d(eld)
+        assert azd.shape == eld.shape, AssertionError("Wrong offset size!")
+
+        qpix = self.offset_quaternions(azd, eld, boresight_angle)
+
+        if language in ['fortran', 'numba']:
+            language = resolve_language('offset_detectors', language)
+
+        if language == 'fortran':
+            return offset_detectors_fortran(q, qpix)
+        elif language == 'numba':
+            return offset_detectors_numba(q, qpix)
+        else:
+            return offset_detectors_python(q, qpix)
+
+    def offset_quaternions(self, azd, eld, boresight_angle=0.):
+        """
+        Quaternions of the detector offsets (including the rotation of
+        the focal plane around the boresight), to be multiplied on the
+        right of the boresight quaternions.
+
+        Parameters
+        ----------
+        azd : 1d array
+            Azimuth of the detectors (size ndet).
+        eld : 1d array
+            Elevation of the detectors (size ndet).
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight in radian.
+
+        Returns
+        ----------
+        qpix : ndarray
+            Quaternions of size (ndet, 4).
+        """
+        qpix = mult(euler_quatz(-np.atleast_1d(azd)),
+                    euler_quaty(-np.atleast_1d(eld)))
+        if boresight_angle != 0.:
+            qpix = mult(euler_quatx(-boresight_angle), qpix)
+        return qpix
+
+def offset_detectors_fortran(q, qpix):
+    """
+    Compute RA/Dec/PA for all detectors from boresight quaternions `q`
+    and detector offset quaternions `qpix` in one fortran call.
+
+    Parameters
+    ----------
+    q : ndarray
+        Boresight quaternions of size (nt, 4).
+    qpix : ndarray
+        Detector offset quaternions of size (ndet, 4).
+
+    Returns
+    ----------
+    ra, dec, pa : ndarray
+        Arrays of size (ndet, nt).
+
+    Examples
+    ----------
+    >>> q = euler_quatz(np.array([0.1, 0.2, 0.3]))
+    >>> qpix = euler_quaty(np.array([0., 0.1]))
+    >>> ra, dec, pa = offset_detectors_fortran(q, qpix)
+    >>> ra2, dec2, pa2 = offset_detectors_python(q, qpix)
+    >>> assert np.allclose(ra, ra2) and np.allclose(dec, dec2)
+    >>> assert np.allclose(pa, pa2)
+    """
+    nt = q.shape[0]
+    ndet = qpix.shape[0]
+    ra = np.zeros(ndet * nt)
+    dec = np.zeros(ndet * nt)
+    pa = np.zeros(ndet * nt)
+
+    detector_pointing_f.offset_detectors_f(
+        np.ascontiguousarray(q).flatten(), qpix.flatten(),
+        ra, dec, pa, nt, ndet)
+
+    return (ra.reshape((ndet, nt)), dec.reshape((ndet, nt)),
+            pa.reshape((ndet, nt)))
+
+def offset_detectors_numba(q, qpix):
+    """
+    Same as offset_detectors_fortran, but the computation is done
+    with numba.
+
+    Parameters
+    ----------
+    q : ndarray
+        Boresight quaternions of size (nt, 4).
+    qpix : ndarray
+        Detector offset quaternions of size (ndet, 4).
+
+    Returns
+    ----------
+    ra, dec, pa : ndarray
+        Arrays of size (ndet, nt).
+
+    Examples
+    ----------
+    >>> q = euler_quatz(np.array([0.1, 0.2, 0.3]))
+    >>> qpix = euler_quaty(np.array([0., 0.1]))
+    >>> ra, dec, pa = offset_detectors_numba(q, qpix)
+    >>> ra2, dec2, pa2 = offset_detectors_python(q, qpix)
+    >>> assert np.allclose(ra, ra2) and np.allclose(dec, dec2)
+    >>> assert np.allclose(pa, pa2)
+    """
+    nt = q.shape[0]
+    ndet = qpix.shape[0]
+    ra = np.zeros((ndet, nt))
+    dec = np.zeros((ndet, nt))
+    pa = np.zeros((ndet, nt))
+
+    numba_kernels.offset_detectors_numba(
+        np.ascontiguousarray(q), np.ascontiguousarray(qpix), ra, dec, pa)
+
+    return ra, dec, pa
+
+def offset_detectors_python(q, qpix, chunk=65536):
+    """
+    Numpy version of offset_detectors_fortran. The timeline is processed
+    by chunks of `chunk` samples to limit the memory footprint.
+
+    Parameters
+    ----------
+    q : ndarray
+        Boresight quaternions of size (nt, 4).
+    qpix : ndarray
+        Detector offset quaternions of size (ndet, 4).
+    chunk : int, optional
+        Number of samples processed at once.
+
+    Returns
+    ----------
+    ra, dec, pa : ndarray
+        Arrays of size (ndet, nt).
+    """
+    nt = q.shape[0]
+    ndet = qpix.shape[0]
+    ra = np.zeros((ndet, nt))
+    dec = np.zeros((ndet, nt))
+    pa = np.zeros((ndet, nt))
+
+    qx, qy, qz, qw = [c[:, np.newaxis] for c in qpix.T]
+    for start in range(0, nt, chunk):
+        sl = slice(start, start + chunk)
+        px, py, pz, pw = [c[np.newaxis, :] for c in q[sl].T]
+
+        sw = pw * qw - (px * qx + py * qy + pz * qz)
+        sx = pw * qx + px * qw + py * qz - pz * qy
+        sy = pw * qy + py * qw + pz * qx - px * qz
+        sz = pw * qz + pz * qw + px * qy - py * qx
+
+        pa[:, sl] = -np.arctan2(2. * (sw * sx + sy * sz),
+                                1. - 2. * (sx * sx + sy * sy))
+        dec[:, sl] = -np.arcsin(2. * (sw * sy - sz * sx))
+        ra[:, sl] = np.arctan2(2. * (sw * sz + sx * sy),
+                               1. - 2. * (sy * sy + sz * sz))
+
+    return ra, dec, pa
+
+def get_amprms_knots(epequi, mjd, cadence=60.):
+    """
+    Compute the mean-to-apparent parameters (slalib sla_mappa) on a regular
+    time grid covering the dates `mjd`.
+
+    Parameters
+    ----------
+    epequi : float
+        Epoch of mean equinox to be used (Julian).
+    mjd : 1d array
+        Dates in MJD.
+    cadence : float, optional
+        Time interval between two knots in second.
+
+    Returns
+    ----------
+    mjd0 : float
+        Date of the first knot (MJD).
+    dmjd : float
+        Time interval between two knots (MJD).
+    amprms : ndarray
+        Array of size (nknots, 21) containing the parameters at each knot.
+
+    Examples
+    ----------
+    >>> mjd = 56293. + np.arange(100) / 86400.
+    >>> mjd0, dmjd, amprms = get_amprms_knots(2000.0, mjd, cadence=60.)
+    >>> print(amprms.shape)
+    (3, 21)
+    """
+    mjd0 = np.min(mjd)
+    dmjd = cadence / 86400.
+    nknots = max(int(np.ceil((np.max(mjd) - mjd0) / dmjd)) + 1, 2)
+    amprms = np.array(
+        [slalib.sla_mappa(epequi, mjd0 + k * dmjd) for k in range(nknots)])
+    return mjd0, dmjd, amprms
+
+def gmst(ut1):
+    """
+    Greenwich mean sidereal time (vectorised version of slalib sla_gmst).
+
+    Parameters
+    ----------
+    ut1 : float or 1d array
+        Universal time (UT1) in MJD.
+
+    Returns
+    ----------
+    gmst : float or 1d array
+        Greenwich mean sidereal time in radian.
+
+    Examples
+    ----------
+    >>> assert abs(gmst(56293.5) - slalib.sla_gmst(56293.5)) < 1e-12
+    """
+    tu = (ut1 - 51544.5) / 36525.
+    return np.mod(
+        np.mod(ut1, 1.) * 2 * np.pi +
+        (24110.54841 + (8640184.812866 + (0.093104 - 6.2e-6 * tu) * tu) *
+         tu) * 7.272205216643039903848711535369e-5, 2 * np.pi)
+
+def azel2radecpa_python(mjd, az, el, amprms, aoprms, mjd0, dmjd):
+    """
+    Vectorised version of the slalib chain used in Azel2Radec.azel2radecpa:
+    sla_oapqk (observed to apparent place) + sla_ampqk (apparent to mean
+    place) at zenith distance zd +/- 1e-8, and sla_dbear to get the
+    parallactic angle. Computation is done in Python (numpy).
+
+    Parameters
+    ----------
+    mjd : 1d array
+        Dates in MJD.
+    az : 1d array
+        Azimuth in radian.
+    el : 1d array
+        Elevation in radian.
+    amprms : ndarray
+        Mean-to-apparent parameters at each knot, size (nknots, 21).
+    aoprms : 1d array
+        Apparent-to-observed parameters (sla_aoppa).
+    mjd0 : float
+        Date of the first knot (MJD).
+    dmjd : float
+        Time interval between two knots (MJD).
+
+    Returns
+    ----------
+    ra : 1d array
+        Right ascension in radian.
+    dec : 1d array
+        Declination in radian.
+    pa : 1d array
+        Parallactic angle in radian.
+    slow : 1d array of bool
+        True for samples too close to the horizon for the fast refraction
+        model. They must be recomputed with slalib.
+    """
+    ## Interpolate the mean-to-apparent parameters
+    nknots = amprms.shape[0]
+    x = (mjd - mjd0) / dmjd
+    k = np.clip(np.floor(x).astype(int), 0, nknots - 2)
+    w = x - k
+    amp = amprms[k].T * (1. - w) + amprms[k + 1].T * w
+
+    ## Local apparent sidereal time (sla_aoppat)
+    st = gmst(mjd) + aoprms[12]
+
+    zd = np.pi / 2 - el
+    ra1, dec1, slow1 = _ampqk_python(*_oapqk_python(
+        az, zd + 1e-8, aoprms, st), amprms=amp)
+    ra2, dec2, slow2 = _ampqk_python(*_oapqk_python(
+        az, zd - 1e-8, aoprms, st), amprms=amp)
+
+    ## sla_dbear
+    da = ra2 - ra1
+    y = np.sin(da) * np.cos(dec2)
+    x = np.sin(dec2) * np.cos(dec1) - np.cos(dec2) * np.sin(dec1) * np.cos(da)
+    pa = np.arctan2(y, x)
+
+    ra = 0.5 * (ra1 + ra2)
+    dec = 0.5 * (dec1 + dec2)
+
+    return ra, dec, pa, slow1 | slow2
+
+def _oapqk_python(az, zd, aoprms, st):
+    """
+    Vectorised sla_oapqk for observed az/zd. Returns apparent RA/Dec,
+    and a mask flagging samples outside the fast refraction model.
+    """
+    sphi = aoprms[1]
+    cphi = aoprms[2]
+
+    ce = np.sin(zd)
+    xaeo = -np.cos(az) * ce
+    yaeo = np.sin(az) * ce
+    zaeo = np.cos(zd)
+
+    azo = np.arctan2(yaeo, xaeo)
+    sz = np.sqrt(xaeo * xaeo + yaeo * yaeo)
+    zdo = np.arctan2(sz, zaeo)
+
+    ## Remove refraction (two-constant model)
+    slow = zaeo < 0.242535625
+    tz = sz / zaeo
+    zdt = zdo + (aoprms[10] + aoprms[11] * tz * tz) * tz
+
+    ## To HA/Dec, and remove diurnal aberration
+    ce = np.sin(zdt)
+    xaet = np.cos(azo) * ce
+    yaet = np.sin(azo) * ce
+    zaet = np.cos(zdt)
+    xmhda = sphi * xaet + cphi * zaet
+    ymhda = yaet
+    zmhda = -cphi * xaet + sphi * zaet
+    diurab = -aoprms[3]
+    f = 1. - diurab * ymhda
+    hma, dap = _dcc2s_python(f * xmhda, f * (ymhda + diurab), f * zmhda)
+
+    return np.mod(st + hma, 2 * np.pi), dap, slow
+
+def _ampqk_python(ra, dec, slow, amprms):
+    """
+    Vectorised sla_ampqk. `amprms` has size (21, nsamples).
+    """
+    gr2e = amprms[7]
+    ab1 = amprms[11]
+    ehn = amprms[4:7]
+    abv = amprms[8:11]
+    rmat = amprms[12:21]
+
+    cd = np.cos(dec)
+    p3 = np.array([np.cos(ra) * cd, np.sin(ra) * cd, np.sin(dec)])
+
+    ## Apparent RA/Dec to mean: inverse of the precession-nutation matrix
+    p2 = np.array([rmat[3 * i] * p3[0] + rmat[3 * i + 1] * p3[1] +
+                   rmat[3 * i + 2] * p3[2] for i in range(3)])
+
+    ## Aberration
+    ab1p1 = ab1 + 1.
+    p1 = p2
+    for j in range(2):
+        p1dv = np.sum(p1 * abv, axis=0)
+        p1dvp1 = 1. + p1dv
+        w = 1. + p1dv / ab1p1
+        p1 = (p1dvp1 * p2 - w * abv) / ab1
+        p1 = p1 / np.sqrt(np.sum(p1 * p1, axis=0))
+
+    ## Light deflection
+    p = p1
+    for j in range(5):
+        pde = np.sum(p * ehn, axis=0)
+        pdep1 = 1. + pde
+        w = pdep1 - gr2e * pde
+        p = (pdep1 * p1 - gr2e * ehn) / w
+        p = p / np.sqrt(np.sum(p * p, axis=0))
+
+    rm, dm = _dcc2s_python(p[0], p[1], p[2])
+    return np.mod(rm, 2 * np.pi), dm, slow
+
+def _dcc2s_python(x, y, z):
+    """ Vectorised sla_dcc2s. """
+    return np.arctan2(y, x), np.arctan2(z, np.sqrt(x * x + y * y))
+
+def azel2radecpa_fortran(mjd, az, el, amprms, aoprms, mjd0, dmjd):
+    """
+    Same as azel2radecpa_python, but the computation is done in fortran.
+    See azel2radecpa_python for the documentation.
+
+    Examples
+    ----------
+    >>> converter = Azel2Radec(56293., 0.277)
+    >>> mjd = 56293. + np.arange(100) / 86400.
+    >>> az = np.linspace(0.1, 0.2, 100)
+    >>> el = np.ones(100) * 0.8
+    >>> mjd0, dmjd, amprms = get_amprms_knots(2000.0, mjd)
+    >>> out_f = azel2radecpa_fortran(mjd, az, el, amprms,
+    ...     converter.aoprms, mjd0, dmjd)
+    >>> out_p = azel2radecpa_python(mjd, az, el, amprms,
+    ...     converter.aoprms, mjd0, dmjd)
+    >>> assert np.allclose(out_f[0], out_p[0], rtol=0., atol=1e-12)
+    >>> assert np.allclose(out_f[1], out_p[1], rtol=0., atol=1e-12)
+    """
+    n = mjd.size
+    nknots = amprms.shape[0]
+    ra = np.zeros(n)
+    dec = np.zeros(n)
+    pa = np.zeros(n)
+    slow = np.zeros(n, dtype=np.int32)
+
+    detector_pointing_f.azel2radecpa_f(
+        mjd, az, el, amprms.flatten(), np.asarray(aoprms, dtype=np.float64),
+        mjd0, dmjd, ra, dec, pa, slow, n, nknots)
+
+    return ra, dec, pa, slow > 0
+
+def azel2radecpa_numba(mjd, az, el, amprms, aoprms, mjd0, dmjd):
+    """
+    Same as azel2radecpa_python, but the computation is done with numba.
+    See azel2radecpa_python for the documentation.
+
+    Examples
+    ----------
+    >>> converter = Azel2Radec(56293., 0.277)
+    >>> mjd = 56293. + np.arange(100) / 86400.
+    >>> az = np.linspace(0.1, 0.2, 100)
+    >>> el = np.ones(100) * 0.8
+    >>> mjd0, dmjd, amprms = get_amprms_knots(2000.0, mjd)
+    >>> out_n = azel2radecpa_numba(mjd, az, el, amprms,
+    ...     converter.aoprms, mjd0, dmjd)
+    >>> out_p = azel2radecpa_python(mjd, az, el, amprms,
+    ...     converter.aoprms, mjd0, dmjd)
+    >>> assert np.allclose(out_n[0], out_p[0], rtol=0., atol=1e-12)
+    >>> assert np.allclose(out_n[1], out_p[1], rtol=0., atol=1e-12)
+    """
+    n = mjd.size
+    ra = np.zeros(n)
+    dec = np.zeros(n)
+    pa = np.zeros(n)
+    slow = np.zeros(n, dtype=np.int32)
+
+    numba_kernels.azel2radecpa_numba(
+        np.asarray(mjd, dtype=np.float64), np.asarray(az, dtype=np.float64),
+        np.asarray(el, dtype=np.float64), amprms,
+        np.asarray(aoprms, dtype=np.float64), mjd0, dmjd,
+        ra, dec, pa, slow)
+
+    return ra, dec, pa, slow > 0
+
+def pointing_model_basis(az_enc, el_enc, time, lat, names):
+    """
+    Compute the contribution of each pointing model parameter to the
+    azimuth and elevation corrections, for a unit value of the parameter.
+    Corrections are linear in the parameters, so for a set of parameter
+    values p, the corrections are p.azbasis and p.elbasis.
+    See Pointing for the meaning of the parameters. Parameters without
+    implementation (thermal and solar terms) have zero contribution.
+
+    Parameters
+    ----------
+    az_enc : 1d array
+        Encoder azimuth in radians.
+    el_enc : 1d array
+        Encoder elevation in radians.
+    time : 1d array
+        Encoder time (UTC) in mjd
+    lat : float
+        Latitude of the telescope, in radian.
+    names : list of string
+        Name of the pointing model parameters.
+
+    Returns
+    ----------
+    azbasis : ndarray
+        Azimuth correction in radian for each parameter (in degree), of
+        size (len(names), nsamples).
+    elbasis : ndarray
+        Elevation correction in radian for each parameter (in degree), of
+        size (len(names), nsamples).
+
+    Examples
+    ----------
+    >>> az_enc = np.array([0., np.pi / 2.])
+    >>> el_enc = np.array([np.pi / 4., np.pi / 4.])
+    >>> azbasis, elbasis = pointing_model_basis(
+    ...     az_enc, el_enc, np.zeros(2), 0., ['ie', 'ca'])
+    >>> print(np.round(elbasis / (np.pi / (180.0 * 60.)), 2))
+    [[-1. -1.]
+     [ 0.  0.]]
+    """
+    ## Elevation is constant during a CES: compute its trigonometry once.
+    if np.all(el_enc == el_enc[0]):
+        el_enc = el_enc[0]
+
+    sin_el = sin(el_enc)
+    cos_el = cos(el_enc)
+    tan_el = tan(el_enc)
+
+    sin_az = sin(az_enc)
+    cos_az = cos(az_enc)
+    if any([n in names for n in ['an2', 'aw2']]):
+        sin_2az = sin(2 * az_enc)
+        cos_2az = cos(2 * az_enc)
+    if any([n in names for n in ['an4', 'aw4']]):
+        sin_4az = sin(4 * az_enc)
+        cos_4az = cos(4 * az_enc)
+
+    nt = len(az_enc)
+    azbasis = np.zeros((len(names), nt))
+    elbasis = np.zeros((len(names), nt))
+    for index, name in enumerate(names):
+        if name == 'an':
+            azbasis[index] = -sin_az * sin_el
+            elbasis[index] = cos_az
+        elif name == 'aw':
+            azbasis[index] = -cos_az * sin_el
+            elbasis[index] = -sin_az
+        elif name == 'an2':
+            azbasis[index] = sin_2az * sin_el
+            elbasis[index] = -cos_2az
+        elif name == 'aw2':
+            azbasis[index] = -cos_2az * sin_el
+            elbasis[index] = -sin_2az
+        elif name == 'an4':
+            azbasis[index] = sin_4az * sin_el
+            elbasis[index] = -cos_4az
+        elif name == 'aw4':
+            azbasis[index] = -cos_4az * sin_el
+            elbasis[index] = -sin_4az
+        elif name == 'npae':
+            azbasis[index] = sin_el
+        elif name == 'ca':
+            azbasis[index] = -1.
+        elif name == 'ia':
+            azbasis[index] = cos_el
+        elif name == 'ie':
+            elbasis[index] = -1.
+        elif name == 'tf':
+            elbasis[index] = cos_el
+        elif name == 'tfs':
+            elbasis[index] = sin_el
+        elif name == 'ref':
+            elbasis[index] = -1. / tan_el
+        elif name == 'dt':
+            azbasis[index] = sec2deg * (
+                -sin(lat) + cos_az * cos(lat) * tan_el)
+            elbasis[index] = -sec2deg * cos(lat) * sin_az
+        elif name == 'elt':
+            elbasis[index] = time - np.min(time)
+
+    ## Convert back in radian.
+    azbasis *= np.pi / (180.0 * 60.) / cos_el
+    elbasis *= np.pi / (180.0 * 60.)
+
+    return azbasis, elbasis
+
+def get_pointing_knots(az, seconds, cadence):
+    """
+    Select the samples used as knots for the interpolation of the
+    boresight pointing: first and last samples, turnarounds of the scan
+    (change of direction in azimuth), and one sample every `cadence`
+    seconds.
+
+    Parameters
+    ----------
+    az : 1d array
+        Azimuth of the boresight.
+    seconds : 1d array
+        Time of the samples in second (increasing).
+    cadence : float
+        Maximum time between two knots in second.
+
+    Returns
+    ----------
+    knots : 1d array of int
+        Sorted indices of the knots.
+
+    Examples
+    ----------
+    >>> az = np.array([0., 1., 2., 3., 2., 1., 0., 1., 2.])
+    >>> get_pointing_knots(az, np.arange(9.), cadence=100.)
+    array([0, 3, 6, 8])
+    >>> get_pointing_knots(az, np.arange(9.), cadence=2.)
+    array([0, 2, 3, 4, 6, 8])
+    """
+    n = len(az)
+    daz = np.diff(az)
+    turnarounds = np.where(daz[1:] * daz[:-1] < 0)[0] + 1
+
+    regular = np.searchsorted(
+        seconds, np.arange(seconds[0], seconds[-1], cadence))
+
+    knots = np.unique(np.concatenate(([0, n - 1], turnarounds, regular)))
+    return knots.astype(int)
+
+def slerp(q0, q1, t):
+    """
+    Spherical linear interpolation between arrays of quaternions.
+
+    Parameters
+    ----------
+    q0 : ndarray
+        Array of quaternions of size (n, 4) at t = 0.
+    q1 : ndarray
+        Array of quaternions of size (n, 4) at t = 1.
+    t : 1d array
+        Interpolation parameters between 0 and 1 (size n).
+
+    Returns
+    ----------
+    q : ndarray
+        Array of interpolated quaternions of size (n, 4).
+
+    Examples
+    ----------
+    >>> q0 = euler_quatz(np.array([0.]))
+    >>> q1 = euler_quatz(np.array([np.pi / 2.]))
+    >>> q = slerp(q0, q1, np.array([0.5]))
+    >>> assert np.allclose(q, euler_quatz(np.array([np.pi / 4.])))
+    """
+    dot = np.sum(q0 * q1, axis=1)
+
+    ## Take the shortest path (q and -q are the same rotation)
+    sign = np.where(dot < 0, -1., 1.)
+    q1 = q1 * sign[:, np.newaxis]
+    dot = np.clip(dot * sign, -1., 1.)
+
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+
+    ## Fall back to linear interpolation for very close quaternions
+    close = sin_theta < 1e-10
+    sin_theta[close] = 1.
+    w0 = np.where(close, 1. - t, np.sin((1. - t) * theta) / sin_theta)
+    w1 = np.where(close, t, np.sin(t * theta) / sin_theta)
+
+    q = w0[:, np.newaxis] * q0 + w1[:, np.newaxis] * q1
+    return q / np.sqrt(np.sum(q * q, axis=1))[:, np.newaxis]
+
+def interpolate_quaternions(knots, qknots, index):
+    """
+    Interpolate quaternions known at `knots` to samples `index` (SLERP).
+
+    Parameters
+    ----------
+    knots : 1d array of int
+        Sorted indices of the samples where quaternions are known.
+    qknots : ndarray
+        Array of quaternions at knots of size (nknots, 4).
+    index : 1d array of int
+        Samples for which we want the quaternions.
+
+    Returns
+    ----------
+    q : ndarray
+        Array of quaternions of size (len(index), 4).
+
+    Examples
+    ----------
+    >>> qknots = euler_quatz(np.array([0., np.pi / 2.]))
+    >>> q = interpolate_quaternions(np.array([0, 10]), qknots, np.arange(11))
+    >>> assert np.allclose(q[5], euler_quatz(np.pi / 4.))
+    """
+    k = np.clip(np.searchsorted(knots, index, side='right') - 1,
+                0, len(knots) - 2)
+    t = (index - knots[k]) / (knots[k + 1] - knots[k]).astype(float)
+    return slerp(qknots[k], qknots[k + 1], t)
+
+def quat_angular_distance(p, q):
+    """
+    Angle of the rotation between two arrays of (unit) quaternions.
+
+    Parameters
+    ----------
+    p : ndarray
+        Array of quaternions of size (n, 4).
+    q : ndarray
+        Array of quaternions of size (n, 4).
+
+    Returns
+    ----------
+    angle : 1d array
+        Angle in radian.
+
+    Examples
+    ----------
+    >>> p = euler_quatx(np.array([0., 0.1]))
+    >>> q = euler_quatx(np.array([0.2, 0.1]))
+    >>> print(np.round(quat_angular_distance(p, q), 3))
+    [ 0.2  0. ]
+    """
+    dot = np.abs(np.sum(p * q, axis=1))
+    return 2 * np.arccos(np.clip(dot, 0., 1.))
+
+def mat2quat(mat):
+    """
+    Quaternion of a rotation matrix.
+
+    Parameters
+    ----------
+    mat : ndarray
+        Rotation matrix of size (3, 3).
+
+    Returns
+    ----------
+    q : 1d array
+        Quaternion [x, y, z, w] of the rotation.
+
+    Examples
+    ----------
+    >>> alpha = 0.3
+    >>> mat = np.array([[np.cos(alpha), -np.sin(alpha), 0.],
+    ...     [np.sin(alpha), np.cos(alpha), 0.], [0., 0., 1.]])
+    >>> assert np.allclose(mat2quat(mat), euler_quatz(alpha))
+    """
+    ## Take the largest of the four components for numerical stability
+    trace = np.trace(mat)
+    diag = np.diag(mat)
+    i = np.argmax(diag)
+    if trace > diag[i]:
+        w = np.sqrt(1. + trace) / 2.
+        q = np.array([mat[2, 1] - mat[1, 2],
+                      mat[0, 2] - mat[2, 0],
+                      mat[1, 0] - mat[0, 1],
+                      4 * w * w]) / (4 * w)
+    else:
+        j = (i + 1) % 3
+        k = (i + 2) % 3
+        v = np.sqrt(1. + mat[i, i] - mat[j, j] - mat[k, k]) / 2.
+        q = np.zeros(4)
+        q[i] = v
+        q[j] = (mat[j, i] + mat[i, j]) / (4 * v)
+        q[k] = (mat[k, i] + mat[i, k]) / (4 * v)
+        q[3] = (mat[k, j] - mat[j, k]) / (4 * v)
+    return q / np.sqrt(np.sum(q * q))
+
+def get_frame_quaternion(coord):
+    """
+    Quaternion of the rotation from equatorial coordinates to `coord`.
+
+    Parameters
+    ----------
+    coord : string
+        C (equatorial), G (galactic) or E (ecliptic).
+
+    Returns
+    ----------
+    qframe : 1d array or None
+        Quaternion of the rotation. None if coord is C.
+
+    Examples
+    ----------
+    Compare with healpy, for the boresight pointing in galactic coordinates
+    >>> ra, dec = np.array([0.3, 1.2]), np.array([-0.5, 0.2])
+    >>> quaternion = Quaternion(ra, dec, np.zeros(2), 0., 0.,
+    ...     qframe=get_frame_quaternion('G'))
+    >>> phi, theta, psi = quat_to_radecpa_python(
+    ...     quaternion.offset_radecpa_makequat())
+    >>> r = hp.Rotator(coord=['C', 'G'])
+    >>> theta_gal, phi_gal = r(*radec2thetaphi(ra, dec))
+    >>> assert np.allclose(np.pi / 2. + theta, theta_gal)
+    >>> assert np.allclose(np.mod(psi, 2 * np.pi), np.mod(phi_gal, 2 * np.pi))
+    """
+    if coord == 'C':
+        return None
+    return mat2quat(hp.Rotator(coord=['C', coord]).mat)
+
 def radec2thetaphi(ra, dec):
     """
     Correspondance between RA/Dec and theta/phi coordinate systems.
@@ -723,6 +2044,38 @@ def mult_fortran(p, q):
     pq = pq.reshape(shape)
     return pq
 
+def mult_numba(p, q):
+    """
+    Same as mult_fortran, but the computation is done with numba.
+
+    Parameters
+    ----------
+    p : ndarray
+        Array of quaternions of size (np, 4)
+    q : ndarray
+        Array of quaternions of size (1, 4)
+
+    Returns
+    ----------
+    pq : ndarray
+        Array of size (np, 4)
+
+    Examples
+    ----------
+    >>> mult_numba(np.array([[3., 4., 5., 2.],
+    ...     [2., 2., 2., 2.]]), np.array([1., 2., 3., 4.]))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    array([[ 16.,  16.,  28., -18.],
+           [ 12.,   8.,  16.,  -4.]])
+    """
+    assert p.ndim == 2, AssertionError("Wrong size!")
+    assert p.shape[1] == 4, AssertionError("Wrong size!")
+    assert q.size == 4, AssertionError("Wrong size!")
+    pq = np.zeros_like(p)
+    numba_kernels.mult_numba(
+        np.ascontiguousarray(p, dtype=np.float64), q.flatten(), pq)
+    return pq
+
 def arraylist_dot(a, b):
     """
     Dot product of ndarrays.
@@ -840,6 +2193,39 @@ def quat_to_radecpa_fortran(seq):
         q0, q1, q2, q3, phi, theta, psi, n)
     return phi, theta, psi
 
+def quat_to_radecpa_numba(seq):
+    """
+    Routine to compute phi/theta/psi from a sequence
+    of quaternions. Computation is done with numba.
+
+    WARNING: you still need to convert phi/theta/psi to get to RA/Dec/PA.
+
+    Parameters
+    ----------
+    seq : array of arrays
+        Array of quaternions.
+
+    Returns
+    ----------
+    phi : 1d array
+    theta : 1d array
+    psi : 1d array
+
+    Examples
+    ----------
+    >>> seq = euler_quatz(np.array([0.1, 0.2]))
+    >>> out_n = quat_to_radecpa_numba(seq)
+    >>> out_p = quat_to_radecpa_python(seq)
+    >>> assert np.allclose(out_n, out_p)
+    """
+    q1, q2, q3, q0 = [np.ascontiguousarray(q) for q in seq.T]
+    phi = np.zeros_like(q0)
+    theta = np.zeros_like(q0)
+    psi = np.zeros_like(q0)
+
+    numba_kernels.quat_to_radecpa_numba(q0, q1, q2, q3, phi, theta, psi)
+    return phi, theta, psi
+
 def quat_to_radecpa_c(seq):
     """
     Routine to compute phi/theta/psi from a sequence
@@ -86,4 +86,291 @@ contains
 
     end subroutine
 
+    subroutine offset_detectors_f(q, qpix, ra, dec, pa, nt, ndet)
+        implicit none
+        ! Compute RA/Dec/PA for many detectors at once, from the boresight
+        ! quaternions q and the detector offset quaternions qpix.
+        ! The loop over time is the outer one, so that each boresight
+        ! quaternion is read once and stays in cache while looping
+        ! over detectors.
+        !
+        ! Parameters
+        ! ----------
+        ! q : 1d array
+        !     Boresight quaternions (flattened array of size 4 * nt).
+        ! qpix : 1d array
+        !     Detector offset quaternions (flattened array of size 4 * ndet).
+        !
+        ! Returns
+        ! ----------
+        ! ra, dec, pa : 1d array
+        !     Flattened arrays of size ndet * nt (detector major).
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        ! F2PY params
+        integer(I4B), intent(in) :: nt, ndet
+        real(DP), intent(in)     :: q(0 : 4 * nt - 1)
+        real(DP), intent(in)     :: qpix(0 : 4 * ndet - 1)
+        real(DP), intent(inout)  :: ra(0 : ndet * nt - 1)
+        real(DP), intent(inout)  :: dec(0 : ndet * nt - 1)
+        real(DP), intent(inout)  :: pa(0 : ndet * nt - 1)
+
+        ! LOCAL
+        integer(I4B)             :: t, det, i
+        real(DP)                 :: px, py, pz, pw, qx, qy, qz, qw
+        real(DP)                 :: sx, sy, sz, sw
+
+        do t=0, nt - 1
+            px = q(4 * t)
+            py = q(4 * t + 1)
+            pz = q(4 * t + 2)
+            pw = q(4 * t + 3)
+            do det=0, ndet - 1
+                qx = qpix(4 * det)
+                qy = qpix(4 * det + 1)
+                qz = qpix(4 * det + 2)
+                qw = qpix(4 * det + 3)
+
+                ! Same product as mult_fortran_f
+                sw = pw * qw - (px * qx + py * qy + pz * qz)
+                sx = pw * qx + px * qw + py * qz - pz * qy
+                sy = pw * qy + py * qw + pz * qx - px * qz
+                sz = pw * qz + pz * qw + px * qy - py * qx
+
+                ! Same conversion as quat_to_radecpa_fortran_f,
+                ! including the signs (ra = psi, dec = -theta, pa = -phi)
+                i = det * nt + t
+                pa(i) = -atan2(2.0 * (sw * sx + sy * sz), &
+                    1.0 - 2.0 * (sx * sx + sy * sy))
+                dec(i) = -asin(2.0 * (sw * sy - sz * sx))
+                ra(i) = atan2(2.0 * (sw * sz + sx * sy), &
+                    1.0 - 2.0 * (sy * sy + sz * sz))
+            enddo
+        enddo
+
+    end subroutine
+
+    subroutine azel2radecpa_f(mjd, az, el, amprms, aoprms, mjd0, dmjd, &
+        ra, dec, pa, slow, n, nknots)
+        implicit none
+        ! Given Az/El and time returns RA/Dec and parallactic angle
+        ! for a whole timeline. This is the slalib chain
+        ! sla_oapqk + sla_ampqk (at zd +/- 1e-8) + sla_dbear
+        ! used in Azel2Radec.azel2radecpa, where the mean-to-apparent
+        ! parameters are linearly interpolated between knots.
+        ! Samples outside the fast refraction model are flagged in `slow`.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        real(DP), parameter      :: pi = 3.141592653589793238462643d0
+
+        ! F2PY params
+        integer(I4B), intent(in) :: n, nknots
+        real(DP), intent(in)     :: mjd(0 : n - 1), az(0 : n - 1), el(0 : n - 1)
+        real(DP), intent(in)     :: amprms(0 : 21 * nknots - 1)
+        real(DP), intent(in)     :: aoprms(0 : 13)
+        real(DP), intent(in)     :: mjd0, dmjd
+        real(DP), intent(inout)  :: ra(0 : n - 1), dec(0 : n - 1), pa(0 : n - 1)
+        integer(I4B), intent(inout) :: slow(0 : n - 1)
+
+        ! LOCAL
+        integer(I4B)             :: i, j, k
+        real(DP)                 :: amp(0 : 20), x, w, st, tu, zd
+        real(DP)                 :: rap1, dap1, rap2, dap2
+        real(DP)                 :: ra1, dec1, ra2, dec2, da, xb, yb
+        integer(I4B)             :: slow1, slow2
+
+        do i=0, n - 1
+            ! Interpolate the mean-to-apparent parameters
+            x = (mjd(i) - mjd0) / dmjd
+            k = min(max(int(floor(x)), 0), nknots - 2)
+            w = x - k
+            do j=0, 20
+                amp(j) = amprms(21 * k + j) * (1.0d0 - w) + amprms(21 * (k + 1) + j) * w
+            enddo
+
+            ! Local apparent sidereal time (sla_gmst + sla_aoppat)
+            tu = (mjd(i) - 51544.5d0) / 36525.0d0
+            st = modulo(mod(mjd(i), 1.0d0) * 2.0d0 * pi + &
+                (24110.54841d0 + (8640184.812866d0 + (0.093104d0 - 6.2d-6 * tu) * tu) * tu) * &
+                7.272205216643039903848711535369d-5, 2.0d0 * pi) + aoprms(12)
+
+            zd = pi / 2.0d0 - el(i)
+            call oapqk_azzd_f(az(i), zd + 1.0d-8, aoprms, st, rap1, dap1, slow1)
+            call ampqk_f(rap1, dap1, amp, ra1, dec1)
+            call oapqk_azzd_f(az(i), zd - 1.0d-8, aoprms, st, rap2, dap2, slow2)
+            call ampqk_f(rap2, dap2, amp, ra2, dec2)
+
+            ! sla_dbear
+            da = ra2 - ra1
+            yb = sin(da) * cos(dec2)
+            xb = sin(dec2) * cos(dec1) - cos(dec2) * sin(dec1) * cos(da)
+            if (xb .ne. 0.0d0 .or. yb .ne. 0.0d0) then
+                pa(i) = atan2(yb, xb)
+            else
+                pa(i) = 0.0d0
+            endif
+
+            ra(i) = 0.5d0 * (ra1 + ra2)
+            dec(i) = 0.5d0 * (dec1 + dec2)
+            slow(i) = max(slow1, slow2)
+        enddo
+
+    end subroutine
+
+    subroutine oapqk_azzd_f(az, zd, aoprms, st, rap, dap, slow)
+        implicit none
+        ! sla_oapqk for observed az/zd (type 'A'), using the fast
+        ! two-constant refraction model. `slow` is set to 1 if the
+        ! sample is too close to the horizon for this model.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        real(DP), parameter      :: pi = 3.141592653589793238462643d0
+        real(DP), parameter      :: zbreak = 0.242535625d0
+
+        ! F2PY params
+        real(DP), intent(in)     :: az, zd, st
+        real(DP), intent(in)     :: aoprms(0 : 13)
+        real(DP), intent(out)    :: rap, dap
+        integer(I4B), intent(out) :: slow
+
+        ! LOCAL
+        real(DP)                 :: ce, xaeo, yaeo, zaeo, azo, sz, zdo, tz, zdt
+        real(DP)                 :: xaet, yaet, zaet, xmhda, ymhda, zmhda
+        real(DP)                 :: diurab, f, v1, v2, v3, hma
+
+        ce = sin(zd)
+        xaeo = -cos(az) * ce
+        yaeo = sin(az) * ce
+        zaeo = cos(zd)
+
+        if (xaeo .ne. 0.0d0 .or. yaeo .ne. 0.0d0) then
+            azo = atan2(yaeo, xaeo)
+        else
+            azo = 0.0d0
+        endif
+        sz = sqrt(xaeo * xaeo + yaeo * yaeo)
+        zdo = atan2(sz, zaeo)
+
+        if (zaeo .ge. zbreak) then
+            slow = 0
+        else
+            slow = 1
+        endif
+        tz = sz / zaeo
+        zdt = zdo + (aoprms(10) + aoprms(11) * tz * tz) * tz
+
+        ce = sin(zdt)
+        xaet = cos(azo) * ce
+        yaet = sin(azo) * ce
+        zaet = cos(zdt)
+        xmhda = aoprms(1) * xaet + aoprms(2) * zaet
+        ymhda = yaet
+        zmhda = -aoprms(2) * xaet + aoprms(1) * zaet
+        diurab = -aoprms(3)
+        f = 1.0d0 - diurab * ymhda
+        v1 = f * xmhda
+        v2 = f * (ymhda + diurab)
+        v3 = f * zmhda
+
+        call dcc2s_f(v1, v2, v3, hma, dap)
+        rap = modulo(st + hma, 2.0d0 * pi)
+
+    end subroutine
+
+    subroutine ampqk_f(ra, da, amprms, rm, dm)
+        implicit none
+        ! sla_ampqk: apparent to mean place.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        real(DP), parameter      :: pi = 3.141592653589793238462643d0
+
+        ! F2PY params
+        real(DP), intent(in)     :: ra, da
+        real(DP), intent(in)     :: amprms(0 : 20)
+        real(DP), intent(out)    :: rm, dm
+
+        ! LOCAL
+        integer(I4B)             :: i, j
+        real(DP)                 :: gr2e, ab1, ab1p1, p1dv, p1dvp1, w, pde, pdep1
+        real(DP)                 :: p1(0 : 2), p2(0 : 2), p3(0 : 2), p(0 : 2)
+
+        gr2e = amprms(7)
+        ab1 = amprms(11)
+
+        p3(0) = cos(ra) * cos(da)
+        p3(1) = sin(ra) * cos(da)
+        p3(2) = sin(da)
+
+        ! Inverse of the precession-nutation matrix
+        do i=0, 2
+            p2(i) = amprms(12 + 3 * i) * p3(0) + amprms(13 + 3 * i) * p3(1) + &
+                amprms(14 + 3 * i) * p3(2)
+        enddo
+
+        ! Aberration
+        ab1p1 = ab1 + 1.0d0
+        p1 = p2
+        do j=1, 2
+            p1dv = p1(0) * amprms(8) + p1(1) * amprms(9) + p1(2) * amprms(10)
+            p1dvp1 = 1.0d0 + p1dv
+            w = 1.0d0 + p1dv / ab1p1
+            do i=0, 2
+                p1(i) = (p1dvp1 * p2(i) - w * amprms(8 + i)) / ab1
+            enddo
+            w = sqrt(p1(0) * p1(0) + p1(1) * p1(1) + p1(2) * p1(2))
+            if (w .le. 0.0d0) w = 1.0d0
+            p1 = p1 / w
+        enddo
+
+        ! Light deflection
+        p = p1
+        do j=1, 5
+            pde = p(0) * amprms(4) + p(1) * amprms(5) + p(2) * amprms(6)
+            pdep1 = 1.0d0 + pde
+            w = pdep1 - gr2e * pde
+            do i=0, 2
+                p(i) = (pdep1 * p1(i) - gr2e * amprms(4 + i)) / w
+            enddo
+            w = sqrt(p(0) * p(0) + p(1) * p(1) + p(2) * p(2))
+            if (w .le. 0.0d0) w = 1.0d0
+            p = p / w
+        enddo
+
+        call dcc2s_f(p(0), p(1), p(2), rm, dm)
+        rm = modulo(rm, 2.0d0 * pi)
+
+    end subroutine
+
+    subroutine dcc2s_f(x, y, z, a, b)
+        implicit none
+        ! sla_dcc2s: cartesian to spherical coordinates.
+
+        integer, parameter       :: DP = 8
+
+        ! F2PY params
+        real(DP), intent(in)     :: x, y, z
+        real(DP), intent(out)    :: a, b
+
+        ! LOCAL
+        real(DP)                 :: r
+
+        r = sqrt(x * x + y * y)
+        if (r .eq. 0.0d0) then
+            a = 0.0d0
+        else
+            a = atan2(y, x)
+        endif
+        if (z .eq. 0.0d0) then
+            b = 0.0d0
+        else
+            b = atan2(z, r)
+        endif
+
+    end subroutine
+
 end module
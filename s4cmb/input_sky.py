@@ -11,6 +11,7 @@ from __future__ import division, absolute_import, print_function
 
 import glob
 import os
+from collections import OrderedDict
 
 import healpy as hp
 import numpy as np
@@ -21,7 +22,7 @@ class HealpixFitsMap():
     def __init__(self, input_filename,
                  do_pol=True, verbose=False, fwhm_in=0.0, nside_in=16,
                  map_seed=53543, no_ileak=False, no_quleak=False,
-                 ext_map_gal=False):
+                 ext_map_gal=False, rotation_cache_size=2):
         """
 
         Parameters
@@ -57,6 +58,11 @@ class HealpixFitsMap():
         ext_map_gal : bool, optional
             Set it to True if you are reading a map in Galactic coordinate.
             (Planck maps for example).
+        rotation_cache_size : int, optional
+            Maximum number of pixel permutations (one array of 12*nside**2
+            integers each) kept in memory to rotate the maps, see
+            get_rotation_pixels. The least recently used is dropped first.
+            Default is 2.
 
         """
         self.input_filename = input_filename
@@ -73,6 +79,11 @@ class HealpixFitsMap():
         self.Q = None
         self.U = None
 
+        ## Rotation of the maps (see rotate_maps)
+        self.rotation_cache_size = rotation_cache_size
+        self.rotation_cache = OrderedDict()
+        self.reset_rotation()
+
         if type(self.input_filename) == list:
             if self.verbose:
                 print("Reading sky maps from alms file...")
@@ -131,6 +142,7 @@ class HealpixFitsMap():
                 self.I = hp.read_map(
                     self.input_filename, field=0, verbose=self.verbose)
             self.nside = hp.npix2nside(len(self.I))
+            self.reset_rotation()
         else:
             print("External data already present in memory")
 
@@ -189,6 +201,7 @@ class HealpixFitsMap():
                     fwhm=self.fwhm_in / 60. * np.pi / 180.,
                     sigma=None, pol=False, inplace=False, verbose=self.verbose)
             self.nside = hp.npix2nside(len(self.I))
+            self.reset_rotation()
         else:
             print("External data already present in memory")
 
@@ -231,6 +244,7 @@ class HealpixFitsMap():
                                         FWHM=self.fwhm_in,
                                         seed=self.map_seed)
             self.nside = hp.npix2nside(len(self.I))
+            self.reset_rotation()
         else:
             print("External data already present in memory")
 
@@ -263,6 +277,121 @@ class HealpixFitsMap():
             if self.U is not None:
                 self.U[:] = 0.0
 
+    def get_rotation_pixels(self, rot):
+        """
+        Return the pixel permutation such that map[pix] is the map
+        rotated by `rot`. The permutation is computed once for each
+        (nside, rot), and the `rotation_cache_size` most recently used are
+        kept in `rotation_cache`.
+
+        Parameters
+        ----------
+        rot : list of 2 floats
+            Rotation (longitude, latitude) in degree, see hp.Rotator.
+
+        Returns
+        ----------
+        pix : 1d array of int
+            Pixel permutation.
+
+        Examples
+        ----------
+        >>> write_dummy_map('myfits_to_test_.fits')
+        >>> hpmap = HealpixFitsMap('myfits_to_test_.fits',
+        ...     rotation_cache_size=1)
+        >>> pix = hpmap.get_rotation_pixels([10., -30.])
+        >>> pix is hpmap.get_rotation_pixels([10., -30.])
+        True
+        >>> pix2 = hpmap.get_rotation_pixels([0., -30.])
+        >>> print(len(hpmap.rotation_cache))
+        1
+        """
+        key = (self.nside, tuple([float(angle) for angle in rot]))
+        if key in self.rotation_cache:
+            pix = self.rotation_cache.pop(key)
+        else:
+            r = hp.Rotator(rot=list(key[1]))
+            theta, phi = hp.pix2ang(self.nside,
+                                    np.arange(12 * self.nside**2))
+            t, p = r(theta, phi, inv=True)
+            pix = hp.ang2pix(self.nside, t, p)
+
+        ## Drop the least recently used permutations
+        self.rotation_cache[key] = pix
+        while len(self.rotation_cache) > max(self.rotation_cache_size, 1):
+            self.rotation_cache.popitem(last=False)
+
+        return pix
+
+    def reset_rotation(self):
+        """
+        Declare the current maps (self.I, self.Q, self.U) as unrotated.
+        This is done by the loaders, and it has to be done if you assign
+        new maps after a call to rotate_maps.
+        """
+        self.rotation = None
+        self._unrotated = None
+        self._rotated = None
+
+    def rotate_maps(self, rot):
+        """
+        Rotate the sky maps by `rot` (e.g. to put the center of a patch at
+        (0, 0)). The rotation is always applied to the unrotated maps
+        (kept in memory), so successive calls do not compound.
+        Nothing is done if the maps are already rotated by `rot`, and the
+        rotated maps are written into the same buffers otherwise.
+        The rotated maps are read-only: they would be overwritten by the
+        next rotation. To change the maps, assign new ones and call
+        reset_rotation (or reload them).
+
+        Parameters
+        ----------
+        rot : list of 2 floats
+            Rotation (longitude, latitude) in degree, see hp.Rotator.
+
+        Examples
+        ----------
+        >>> write_dummy_map('myfits_to_test_.fits')
+        >>> hpmap = HealpixFitsMap('myfits_to_test_.fits')
+        >>> I0 = hpmap.I.copy()
+        >>> hpmap.rotate_maps([10., -30.])
+        >>> I1 = hpmap.I.copy()
+        >>> hpmap.rotate_maps([10., -30.])
+        >>> assert np.all(hpmap.I == I1)
+        >>> hpmap.rotate_maps([0., 0.])
+        >>> assert np.all(hpmap.I == I0)
+        >>> hpmap.I.flags.writeable
+        False
+
+        New maps are rotated once declared as such
+        >>> hpmap.I = I0 * 2.
+        >>> hpmap.reset_rotation()
+        >>> hpmap.rotate_maps([10., -30.])
+        >>> assert np.all(hpmap.I == I1 * 2.)
+        """
+        rot = tuple([float(angle) for angle in rot])
+
+        ## First rotation since the maps have been (re)loaded.
+        if self.rotation is None:
+            self._unrotated = (self.I, self.Q, self.U)
+            self._rotated = None
+
+        if self.rotation == rot:
+            return
+
+        pix = self.get_rotation_pixels(rot)
+        if self._rotated is None:
+            self._rotated = [None if m is None else np.empty_like(m)
+                             for m in self._unrotated]
+        for m0, m in zip(self._unrotated, self._rotated):
+            if m0 is not None:
+                m.flags.writeable = True
+                np.take(m0, pix, out=m)
+                m.flags.writeable = False
+
+        self.I, self.Q, self.U = self._rotated
+        self.rotation = rot
+
 def add_hierarch(lis):
     """
     Convert in correct format for fits header.
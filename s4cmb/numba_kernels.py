@@ -0,0 +1,520 @@
+#!/usr/bin/python
+"""
+Numba (JIT) versions of the low level routines written in C (weave) or
+fortran (see *_f.f90). They are used with language='numba', and
+they have the same interface as the fortran routines: outputs are
+arrays modified in-place.
+
+Kernels are compiled on first call, and the result of the compilation is
+cached on disk (next to this file) to be reused by the next processes.
+
+Author: Julien Peloton, j.peloton@sussex.ac.uk
+"""
+from __future__ import division, absolute_import, print_function
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+## Detector pointing
+
+@njit(cache=True)
+def mult_numba(p, q, pq):
+    """
+    Multiply arrays of quaternions, when p is an array of quaternions
+    of size (n, 4) and q is a single quaternion. See mult_fortran_f.
+
+    Examples
+    ----------
+    >>> pq = np.zeros((2, 4))
+    >>> mult_numba(np.array([[3., 4., 5., 2.], [2., 2., 2., 2.]]),
+    ...     np.array([1., 2., 3., 4.]), pq)
+    >>> print(pq)
+    [[ 16.  16.  28. -18.]
+     [ 12.   8.  16.  -4.]]
+    """
+    for i in range(p.shape[0]):
+        pq[i, 3] = p[i, 3] * q[3] - (
+            p[i, 0] * q[0] + p[i, 1] * q[1] + p[i, 2] * q[2])
+        pq[i, 0] = p[i, 3] * q[0] + p[i, 0] * q[3] + \
+            p[i, 1] * q[2] - p[i, 2] * q[1]
+        pq[i, 1] = p[i, 3] * q[1] + p[i, 1] * q[3] + \
+            p[i, 2] * q[0] - p[i, 0] * q[2]
+        pq[i, 2] = p[i, 3] * q[2] + p[i, 2] * q[3] + \
+            p[i, 0] * q[1] - p[i, 1] * q[0]
+
+@njit(cache=True)
+def quat_to_radecpa_numba(q0, q1, q2, q3, phi, theta, psi):
+    """
+    Compute phi/theta/psi from a sequence of quaternions.
+    See quat_to_radecpa_fortran_f.
+    """
+    for i in range(q0.shape[0]):
+        phi[i] = math.atan2(2.0 * (q0[i] * q1[i] + q2[i] * q3[i]),
+                            1.0 - 2.0 * (q1[i] * q1[i] + q2[i] * q2[i]))
+        theta[i] = math.asin(2.0 * (q0[i] * q2[i] - q3[i] * q1[i]))
+        psi[i] = math.atan2(2.0 * (q0[i] * q3[i] + q1[i] * q2[i]),
+                            1.0 - 2.0 * (q2[i] * q2[i] + q3[i] * q3[i]))
+
+@njit(cache=True)
+def offset_detectors_numba(q, qpix, ra, dec, pa):
+    """
+    Compute RA/Dec/PA (ndet, nt) for many detectors at once from the
+    boresight quaternions q (nt, 4) and the detector offset
+    quaternions qpix (ndet, 4). See offset_detectors_f.
+    """
+    for t in range(q.shape[0]):
+        px = q[t, 0]
+        py = q[t, 1]
+        pz = q[t, 2]
+        pw = q[t, 3]
+        for det in range(qpix.shape[0]):
+            qx = qpix[det, 0]
+            qy = qpix[det, 1]
+            qz = qpix[det, 2]
+            qw = qpix[det, 3]
+
+            sw = pw * qw - (px * qx + py * qy + pz * qz)
+            sx = pw * qx + px * qw + py * qz - pz * qy
+            sy = pw * qy + py * qw + pz * qx - px * qz
+            sz = pw * qz + pz * qw + px * qy - py * qx
+
+            pa[det, t] = -math.atan2(2.0 * (sw * sx + sy * sz),
+                                     1.0 - 2.0 * (sx * sx + sy * sy))
+            dec[det, t] = -math.asin(2.0 * (sw * sy - sz * sx))
+            ra[det, t] = math.atan2(2.0 * (sw * sz + sx * sy),
+                                    1.0 - 2.0 * (sy * sy + sz * sz))
+
+@njit(cache=True)
+def _dcc2s(x, y, z):
+    """ sla_dcc2s: cartesian to spherical coordinates. """
+    r = math.sqrt(x * x + y * y)
+    a = 0.0 if r == 0.0 else math.atan2(y, x)
+    b = 0.0 if z == 0.0 else math.atan2(z, r)
+    return a, b
+
+@njit(cache=True)
+def _oapqk_azzd(az, zd, aoprms, st):
+    """
+    sla_oapqk for observed az/zd using the two-constant refraction model.
+    See oapqk_azzd_f.
+    """
+    ce = math.sin(zd)
+    xaeo = -math.cos(az) * ce
+    yaeo = math.sin(az) * ce
+    zaeo = math.cos(zd)
+
+    azo = 0.0
+    if xaeo != 0.0 or yaeo != 0.0:
+        azo = math.atan2(yaeo, xaeo)
+    sz = math.sqrt(xaeo * xaeo + yaeo * yaeo)
+    zdo = math.atan2(sz, zaeo)
+
+    slow = 0 if zaeo >= 0.242535625 else 1
+    tz = sz / zaeo
+    zdt = zdo + (aoprms[10] + aoprms[11] * tz * tz) * tz
+
+    ce = math.sin(zdt)
+    xaet = math.cos(azo) * ce
+    yaet = math.sin(azo) * ce
+    zaet = math.cos(zdt)
+    xmhda = aoprms[1] * xaet + aoprms[2] * zaet
+    ymhda = yaet
+    zmhda = -aoprms[2] * xaet + aoprms[1] * zaet
+    diurab = -aoprms[3]
+    f = 1.0 - diurab * ymhda
+
+    hma, dap = _dcc2s(f * xmhda, f * (ymhda + diurab), f * zmhda)
+    rap = (st + hma) % (2.0 * math.pi)
+    return rap, dap, slow
+
+@njit(cache=True)
+def _ampqk(ra, da, amp):
+    """ sla_ampqk: apparent to mean place. See ampqk_f. """
+    gr2e = amp[7]
+    ab1 = amp[11]
+
+    p3 = np.empty(3)
+    p3[0] = math.cos(ra) * math.cos(da)
+    p3[1] = math.sin(ra) * math.cos(da)
+    p3[2] = math.sin(da)
+
+    ## Inverse of the precession-nutation matrix
+    p2 = np.empty(3)
+    for i in range(3):
+        p2[i] = amp[12 + 3 * i] * p3[0] + amp[13 + 3 * i] * p3[1] + \
+            amp[14 + 3 * i] * p3[2]
+
+    ## Aberration
+    ab1p1 = ab1 + 1.0
+    p1 = p2.copy()
+    for j in range(2):
+        p1dv = p1[0] * amp[8] + p1[1] * amp[9] + p1[2] * amp[10]
+        p1dvp1 = 1.0 + p1dv
+        w = 1.0 + p1dv / ab1p1
+        for i in range(3):
+            p1[i] = (p1dvp1 * p2[i] - w * amp[8 + i]) / ab1
+        w = math.sqrt(p1[0] * p1[0] + p1[1] * p1[1] + p1[2] * p1[2])
+        if w <= 0.0:
+            w = 1.0
+        for i in range(3):
+            p1[i] /= w
+
+    ## Light deflection
+    p = p1.copy()
+    for j in range(5):
+        pde = p[0] * amp[4] + p[1] * amp[5] + p[2] * amp[6]
+        pdep1 = 1.0 + pde
+        w = pdep1 - gr2e * pde
+        for i in range(3):
+            p[i] = (pdep1 * p1[i] - gr2e * amp[4 + i]) / w
+        w = math.sqrt(p[0] * p[0] + p[1] * p[1] + p[2] * p[2])
+        if w <= 0.0:
+            w = 1.0
+        for i in range(3):
+            p[i] /= w
+
+    rm, dm = _dcc2s(p[0], p[1], p[2])
+    return rm % (2.0 * math.pi), dm
+
+@njit(cache=True)
+def azel2radecpa_numba(mjd, az, el, amprms, aoprms, mjd0, dmjd,
+                       ra, dec, pa, slow):
+    """
+    Given Az/El and time returns RA/Dec and parallactic angle for
+    a whole timeline. amprms is of size (nknots, 21).
+    See azel2radecpa_f.
+    """
+    nknots = amprms.shape[0]
+    amp = np.empty(21)
+    for i in range(mjd.shape[0]):
+        ## Interpolate the mean-to-apparent parameters
+        x = (mjd[i] - mjd0) / dmjd
+        k = min(max(int(math.floor(x)), 0), nknots - 2)
+        w = x - k
+        for j in range(21):
+            amp[j] = amprms[k, j] * (1.0 - w) + amprms[k + 1, j] * w
+
+        ## Local apparent sidereal time (sla_gmst + sla_aoppat)
+        tu = (mjd[i] - 51544.5) / 36525.0
+        st = ((mjd[i] % 1.0) * 2.0 * math.pi + (
+            24110.54841 + (8640184.812866 + (
+                0.093104 - 6.2e-6 * tu) * tu) * tu) *
+            7.272205216643039903848711535369e-5) % (2.0 * math.pi) + \
+            aoprms[12]
+
+        zd = math.pi / 2.0 - el[i]
+        rap1, dap1, slow1 = _oapqk_azzd(az[i], zd + 1.0e-8, aoprms, st)
+        ra1, dec1 = _ampqk(rap1, dap1, amp)
+        rap2, dap2, slow2 = _oapqk_azzd(az[i], zd - 1.0e-8, aoprms, st)
+        ra2, dec2 = _ampqk(rap2, dap2, amp)
+
+        ## sla_dbear
+        da = ra2 - ra1
+        yb = math.sin(da) * math.cos(dec2)
+        xb = math.sin(dec2) * math.cos(dec1) - \
+            math.cos(dec2) * math.sin(dec1) * math.cos(da)
+        pa[i] = 0.0
+        if xb != 0.0 or yb != 0.0:
+            pa[i] = math.atan2(yb, xb)
+
+        ra[i] = 0.5 * (ra1 + ra2)
+        dec[i] = 0.5 * (dec1 + dec2)
+        slow[i] = max(slow1, slow2)
+
+## Scanning strategy
+
+@njit(cache=True)
+def run_one_scan_numba(pb_az_array, pb_mjd_array, running_az,
+                       upper_az, lower_az, az_speed, pb_az_dir,
+                       second, sampling_freq):
+    """
+    Generate one observation (i.e. one CES) of the telescope.
+    See run_one_scan_f. Since scalars cannot be modified in-place,
+    the final running_az and pb_az_dir are returned.
+
+    Examples
+    ----------
+    >>> az = np.zeros(6); mjd = np.zeros(6)
+    >>> running_az, az_dir = run_one_scan_numba(
+    ...     az, mjd, 1., 2., 0., 1., 1., 1., 1.)
+    >>> print(az)
+    [ 0.  1.  2.  3.  2.  1.]
+    """
+    for t in range(1, pb_az_array.shape[0]):
+        ## Set the Azimuth and time
+        pb_az_array[t] = running_az
+
+        ## Case to change the direction of the scan
+        if running_az > upper_az:
+            pb_az_dir = -1.
+        elif running_az < lower_az:
+            pb_az_dir = 1.
+
+        running_az += az_speed * pb_az_dir / sampling_freq
+
+        ## Increment the time by one second / sampling rate
+        pb_mjd_array[t] = pb_mjd_array[t - 1] + second / sampling_freq
+
+    return running_az, pb_az_dir
+
+@njit(cache=True)
+def mapmaking_numba(pix_global, nhit_loc):
+    """
+    Simple map-making: number of hits per pixel. See mapmaking.
+    """
+    for i in range(pix_global.shape[0]):
+        nhit_loc[pix_global[i]] += 1
+
+## TOD
+
+@njit(cache=True)
+def ang2pix_ring_numba(nside, theta, phi):
+    """
+    Index of the healpix pixel (RING scheme) containing the direction
+    (theta, phi). Same algorithm as healpy. See ang2pix_ring_f.
+    """
+    nl4 = 4 * nside
+    ncap = 2 * nside * (nside - 1)
+    npix = 12 * nside * nside
+
+    z = math.cos(theta)
+    za = abs(z)
+
+    ## fmodulo(phi / (pi / 2), 4)
+    tt = phi * 0.6366197723675813430755350534900574
+    if tt >= 0.0:
+        if tt >= 4.0:
+            tt = np.fmod(tt, 4.0)
+    else:
+        tt = np.fmod(tt, 4.0) + 4.0
+        if tt == 4.0:
+            tt = 0.0
+
+    if za <= 2.0 / 3.0:
+        ## Equatorial region
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * z * 0.75
+        jp = int(temp1 - temp2)
+        jm = int(temp1 + temp2)
+        ir = nside + 1 + jp - jm
+        kshift = 1 - (ir & 1)
+        t1 = jp + jm - nside + kshift + 1 + nl4 + nl4
+        ip = (t1 // 2) % nl4
+        return ncap + (ir - 1) * nl4 + ip
+
+    ## Polar caps
+    tp = tt - int(tt)
+    if (theta < 0.01 or theta > math.pi - 0.01) and za >= 0.99:
+        tmp = nside * math.sin(theta) / math.sqrt((1.0 + za) / 3.0)
+    else:
+        tmp = nside * math.sqrt(3.0 * (1.0 - za))
+    jp = int(tp * tmp)
+    jm = int((1.0 - tp) * tmp)
+    ir = jp + jm + 1
+    ip = int(tt * ir)
+    if ip >= 4 * ir:
+        ip -= 4 * ir
+    if z > 0.0:
+        return 2 * ir * (ir - 1) + ip
+    return npix - 2 * ir * (ir + 1) + ip
+
+@njit(cache=True)
+def map2tod_alldet_numba(q, qpix, cos2ang, sin2ang, cos4hwp, sin4hwp, norm,
+                         mapi, mapq, mapu, obspix, store, shared, nside, flat,
+                         xmin, ymin, pixel_size, npix_per_row, do_pol, out,
+                         point_matrix, cos2pa, sin2pa):
+    """
+    Scan the sky maps for many detectors, in one pass per sample.
+    out (ndet, nt) contains the noise on input (or zeros), and the
+    timestreams on output. The pointing of detector det is used for
+    det + 1 if shared[det]. See map2tod_alldet_f.
+    """
+    nobspix = obspix.shape[0]
+    det = 0
+    while det < qpix.shape[0]:
+        ## Number of detectors with this pointing
+        ng = 2 if shared[det] else 1
+        qx = qpix[det, 0]
+        qy = qpix[det, 1]
+        qz = qpix[det, 2]
+        qw = qpix[det, 3]
+        for t in range(q.shape[0]):
+            px = q[t, 0]
+            py = q[t, 1]
+            pz = q[t, 2]
+            pw = q[t, 3]
+
+            ## Detector pointing (see offset_detectors_numba)
+            sw = pw * qw - (px * qx + py * qy + pz * qz)
+            sx = pw * qx + px * qw + py * qz - pz * qy
+            sy = pw * qy + py * qw + pz * qx - px * qz
+            sz = pw * qz + pz * qw + px * qy - py * qx
+
+            dec = -math.asin(2.0 * (sw * sy - sz * sx))
+            ra = math.atan2(2.0 * (sw * sz + sx * sy),
+                            1.0 - 2.0 * (sy * sy + sz * sz))
+
+            ## Pixel in the input map, and in the output patch
+            ipix = ang2pix_ring_numba(nside, math.pi / 2 - dec, ra)
+            if flat:
+                ix = int((ra - (xmin - pixel_size / 2.0)) / pixel_size)
+                iy = int((math.sin(dec) - (ymin - pixel_size / 2.0)) /
+                         pixel_size)
+                if ix < 0 or ix >= npix_per_row or \
+                        iy < 0 or iy >= npix_per_row:
+                    ilocal = -1
+                else:
+                    ilocal = ix * npix_per_row + iy
+            else:
+                ilocal = np.searchsorted(obspix, ipix)
+                if ilocal >= nobspix:
+                    ilocal = -1
+                elif obspix[ilocal] != ipix:
+                    ilocal = -1
+
+            if do_pol:
+                ## PA = -atan2(pa_y, pa_x)
+                pa_y = 2.0 * (sw * sx + sy * sz)
+                pa_x = 1.0 - 2.0 * (sx * sx + sy * sy)
+                r2 = pa_x * pa_x + pa_y * pa_y
+                if r2 > 0.0:
+                    c2pa = (pa_x * pa_x - pa_y * pa_y) / r2
+                    s2pa = -2.0 * pa_x * pa_y / r2
+                else:
+                    c2pa = 1.0
+                    s2pa = 0.0
+            else:
+                c2pa = 1.0
+                s2pa = 0.0
+
+            for k in range(det, det + ng):
+                if do_pol:
+                    ## cos/sin(2 intrinsic + 4 HWP)
+                    c = cos2ang[k] * cos4hwp[t] - sin2ang[k] * sin4hwp[t]
+                    s = sin2ang[k] * cos4hwp[t] + cos2ang[k] * sin4hwp[t]
+
+                    out[k, t] = (mapi[ipix] +
+                                 mapq[ipix] * (c2pa * c - s2pa * s) +
+                                 mapu[ipix] * (s2pa * c + c2pa * s) +
+                                 out[k, t]) * norm[k]
+                else:
+                    out[k, t] = norm[k] * (mapi[ipix] + out[k, t])
+
+                if store[k] >= 0:
+                    point_matrix[store[k], t] = ilocal
+                    if do_pol:
+                        cos2pa[store[k], t] = c2pa
+                        sin2pa[store[k], t] = s2pa
+        det += ng
+
+@njit(cache=True)
+def tod2map_alldet_numba(d, w, dc, ds, cc, cs, ss, nhit, waferi1d,
+                         wafercos2pa, wafersin2pa, cos2ang, sin2ang,
+                         cos4hwp, sin4hwp, waferts, diff_weight, sum_weight,
+                         npix, nt, wafermask_pixel):
+    """
+    Project the timestreams of all pairs into the output sky maps.
+    See tod2map_alldet_f.
+    """
+    for j in range(npix):
+        for i in range(nt):
+            ipix = i + j * nt
+            if wafermask_pixel[ipix] > 0 and waferi1d[ipix] > 0:
+                ict = i + 2 * j * nt
+                icb = i + (2 * j + 1) * nt
+
+                pixel = waferi1d[ipix]
+
+                tsum = 0.5 * (waferts[ict] + waferts[icb])
+                tdiff = 0.5 * (waferts[ict] - waferts[icb])
+                c0 = cos2ang[j] * cos4hwp[i] - sin2ang[j] * sin4hwp[i]
+                s0 = sin2ang[j] * cos4hwp[i] + cos2ang[j] * sin4hwp[i]
+                c = wafercos2pa[ipix] * c0 - wafersin2pa[ipix] * s0
+                s = wafersin2pa[ipix] * c0 + wafercos2pa[ipix] * s0
+
+                nhit[pixel] += 1
+                w[pixel] += sum_weight[j]
+                d[pixel] += tsum * sum_weight[j]
+
+                dc[pixel] += c * tdiff * diff_weight[j]
+                ds[pixel] += s * tdiff * diff_weight[j]
+                cc[pixel] += c * c * diff_weight[j]
+                cs[pixel] += c * s * diff_weight[j]
+                ss[pixel] += s * s * diff_weight[j]
+
+@njit(parallel=True, cache=True)
+def tod2map_alldet_threads_numba(d, w, dc, ds, cc, cs, ss, nhit, waferi1d,
+                                 wafercos2pa, wafersin2pa, cos2ang, sin2ang,
+                                 cos4hwp, sin4hwp, waferts, diff_weight,
+                                 sum_weight, npix, nt, wafermask_pixel,
+                                 nthreads):
+    """
+    Same as tod2map_alldet_numba, with the pairs split in nthreads blocks
+    projected in parallel into private maps, added to the output maps in
+    the order of the blocks. See tod2map_alldet_threads_f.
+    Both parallel loops have nthreads iterations (blocks of pairs, then
+    blocks of pixels for the reduction), so that at most nthreads threads
+    of the pool of numba (NUMBA_NUM_THREADS) are used.
+    """
+    nskypix = d.shape[0]
+    maps = np.zeros((nthreads, 7, nskypix))
+    hits = np.zeros((nthreads, nskypix), dtype=nhit.dtype)
+    for b in prange(nthreads):
+        ## Pairs j0 to j1 - 1
+        j0 = (b * npix) // nthreads
+        j1 = ((b + 1) * npix) // nthreads
+        if j1 > j0:
+            tod2map_alldet_numba(
+                maps[b, 0], maps[b, 1], maps[b, 2], maps[b, 3],
+                maps[b, 4], maps[b, 5], maps[b, 6], hits[b],
+                waferi1d[j0 * nt: j1 * nt], wafercos2pa[j0 * nt: j1 * nt],
+                wafersin2pa[j0 * nt: j1 * nt], cos2ang[j0: j1],
+                sin2ang[j0: j1], cos4hwp, sin4hwp,
+                waferts[2 * j0 * nt: 2 * j1 * nt], diff_weight[j0: j1],
+                sum_weight[j0: j1], j1 - j0, nt,
+                wafermask_pixel[j0 * nt: j1 * nt])
+
+    ## Reduction, always in the order of the blocks,
+    ## with the pixels split in nthreads blocks
+    for p in prange(nthreads):
+        i0 = (p * nskypix) // nthreads
+        i1 = ((p + 1) * nskypix) // nthreads
+        for i in range(i0, i1):
+            for b in range(nthreads):
+                d[i] += maps[b, 0, i]
+                w[i] += maps[b, 1, i]
+                dc[i] += maps[b, 2, i]
+                ds[i] += maps[b, 3, i]
+                cc[i] += maps[b, 4, i]
+                cs[i] += maps[b, 5, i]
+                ss[i] += maps[b, 6, i]
+                nhit[i] += hits[b, i]
+
+## Systematics
+
+@njit(cache=True)
+def inject_crosstalk_inside_squid_numba(tsout, local_indices,
+                                        global_indices, radius,
+                                        cross_amp, beta):
+    """
+    Introduce leakage between neighboring bolometers within a SQUID.
+    tsout is of size (nchan, nts). See inject_crosstalk_inside_squid_f.
+    """
+    nlocal = local_indices.shape[0]
+    for i in range(nlocal):
+        local_index = local_indices[i]
+        global_index = global_indices[i]
+        for i2 in range(nlocal):
+            global_index2 = global_indices[i2]
+            separation_length = abs(local_index - local_indices[i2])
+            if separation_length > 0 and separation_length <= radius:
+                amp = cross_amp[global_index2] / separation_length**beta
+                for t in range(tsout.shape[1]):
+                    tsout[global_index, t] += amp * tsout[global_index2, t]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -8,13 +8,30 @@ from __future__ import division, absolute_import, print_function
 
 import os
 import ephem
+import bisect
+import hashlib
+import tempfile
+import multiprocessing
+import cPickle as pickle
+from collections import OrderedDict
 import numpy as np
 import healpy as hp
-import weave
 
-from s4cmb.scanning_strategy_f import scanning_strategy_f
+from s4cmb.backends import LazyModule
+from s4cmb.backends import resolve_language
 
-from pyslalib import slalib
+## Backends are imported on first use (see backends.py)
+weave = LazyModule('weave')
+scanning_strategy_f = LazyModule('scanning_strategy_f')
+numba_kernels = LazyModule('numba_kernels')
+slalib = LazyModule('slalib')
+
+## Arrays of a scan stored as .npy files (see save_scan)
+SCAN_ARRAYS = ['azimuth', 'elevation', 'clock-utc', 'RA', 'Dec']
+
+## Columns of the schedule tables (see ScheduleTable)
+SCHEDULE_COLUMNS = ['patch', 'elevation', 'az_min', 'az_max',
+                    'begin_LST', 'end_LST', 'date', 'boresight_angle']
 
 ## numerical constants
 radToDeg = 180. / np.pi
@@ -26,7 +43,9 @@ class ScanningStrategy():
                  telescope_longitude='-67:46.816',
                  telescope_latitude='-22:56.396', telescope_elevation=5200.,
                  name_strategy='deep_patch', sampling_freq=30., sky_speed=0.4,
-                 ut1utc_fn='s4cmb/data/ut1utc.ephem', language='python'):
+                 ut1utc_fn='s4cmb/data/ut1utc.ephem', language='python',
+                 scan_cache_size=2, store_dir=None, schedule_table=None,
+                 boresight_angle=0.):
         """
         A scanning strategy consists in defining the site of observation
         on earth for which we will make the observation, the region
@@ -60,11 +79,43 @@ class ScanningStrategy():
             computational time can be big, and some part of the code can be
             speeded up by interfacing python with C or Fortran.
             Default is python (i.e. no interfacing and can be slow).
-            Choose language=C or language=fortran otherwise. Note that C codes
-            are compiled on-the-fly (weave), but for fortran codes you need
-            first to compile it. See the setup.py or the provided Makefile.
+            Choose language=C, language=fortran or language=numba
+            otherwise. Note that C codes are compiled on-the-fly (weave),
+            numba codes are compiled on first call (JIT), but for fortran
+            codes you need first to compile it. See the setup.py or
+            the provided Makefile.
+        scan_cache_size : int, optional
+            Maximum number of CES kept in memory by get_scan (the least
+            recently used CES are dropped). CES generated by run are always
+            kept. Default is 2.
+        store_dir : string, optional
+            Folder where the CES are stored on disk once generated, and
+            loaded from (memory-mapped, read-only) instead of being
+            generated again. Entries are identified by a hash of the
+            parameters of the scanning strategy (see store_key).
+            Several processes can share the same folder.
+            Default is None (no storage).
+        schedule_table : ScheduleTable, optional
+            Schedule of the CES (see ScheduleTable, read_schedule and
+            load_schedule), used instead of name_strategy. nces is then
+            the number of CES in the table, and the site of the table
+            (if defined) is used instead of the telescope coordinates.
+            Default is None.
+        boresight_angle : float or list of float, optional
+            Rotation of the focal plane around the boresight (deck angle)
+            in degree, for all CES or one value per CES. It does not change
+            the boresight pointing, and it is applied to the detector
+            offsets (see Pointing). With a schedule_table, the angles are
+            read from its boresight_angle column. Default is 0.
 
         """
+        self.schedule_table = schedule_table
+        if schedule_table is not None:
+            nces = len(schedule_table)
+            if schedule_table.site is not None:
+                telescope_longitude, telescope_latitude, \
+                    telescope_elevation = schedule_table.site
+
         self.nces = nces
         self.start_date = start_date
         self.name_strategy = name_strategy
@@ -72,6 +123,13 @@ class ScanningStrategy():
         self.sky_speed = sky_speed
         self.language = language
         self.ut1utc_fn = ut1utc_fn
+        self.telescope_longitude = telescope_longitude
+        self.telescope_latitude = telescope_latitude
+        self.telescope_elevation = telescope_elevation
+        self.scan_cache_size = scan_cache_size
+        self.scan_cache = OrderedDict()
+        self.store_dir = store_dir
+        self.boresight_angle = boresight_angle
 
         self.telescope_location = self.define_telescope_location(
             telescope_longitude, telescope_latitude, telescope_elevation)
@@ -121,7 +179,8 @@ class ScanningStrategy():
         """
         Given a pre-defined scanning strategy,
         define the boundaries of the scan: elevation, azimuth, and time.
-        For a custom usage (advanced users), modify this routine.
+        For a custom usage (advanced users), modify this routine, or
+        provide a schedule_table (see ScheduleTable).
 
         Examples
         ----------
@@ -142,10 +201,35 @@ class ScanningStrategy():
 
         >>> scan.allowed_scanning_strategies
         ['deep_patch']
+
+        Any schedule can be given as a table (see ScheduleTable)
+        >>> table = ScheduleTable({'elevation': [30., 50.],
+        ...     'az_min': [134., 162.], 'az_max': [154., 197.],
+        ...     'begin_LST': ['17:07:54.84', '22:00:21.76'],
+        ...     'end_LST': ['22:00:21.76', '02:01:01.19']})
+        >>> scan = ScanningStrategy(schedule_table=table)
+        >>> print(scan.nces, scan.elevation.tolist())
+        2 [30.0, 50.0]
         """
         self.allowed_scanning_strategies = ['deep_patch']
 
-        if self.name_strategy == 'deep_patch':
+        ## Date of the CES (MJD), if any
+        self.ces_date = None
+
+        if self.schedule_table is not None:
+            self.elevation = self.schedule_table['elevation']
+            self.az_min = self.schedule_table['az_min']
+            self.az_max = self.schedule_table['az_max']
+            self.begin_LST = self.schedule_table['begin_LST']
+            self.end_LST = self.schedule_table['end_LST']
+            self.ces_date = self.schedule_table['date']
+            self.ces_boresight_angle = self.schedule_table['boresight_angle']
+
+            ## Center of the patch in RA/Dec
+            self.ra_mid, self.dec_mid = 0., -57.5
+            if self.schedule_table.center is not None:
+                self.ra_mid, self.dec_mid = self.schedule_table.center
+        elif self.name_strategy == 'deep_patch':
             self.elevation = [30.0, 45.5226, 47.7448, 49.967,
                               52.1892, 54.4114, 56.6336, 58.8558,
                               61.078, 63.3002, 65.5226, 35.2126]
@@ -171,61 +255,235 @@ class ScanningStrategy():
             ## Center of the patch in RA/Dec
             self.ra_mid = 0.
             self.dec_mid = -57.5
+
+            ## Rotation of the focal plane for each CES
+            self.ces_boresight_angle = np.ones(self.nces) * \
+                np.asarray(self.boresight_angle, dtype=np.float64)
         else:
             raise ValueError("Only name_strategy = deep_patch is " +
                              "currently available. For a custom usage " +
                              "(advanced users), modify this routine.")
 
-    def run_one_scan(self, scan_file, scan_number, silent=True):
+    def scan_geometry(self, scan_number):
         """
-        Generate one observation (i.e. one CES) of the telescope.
+        Elevation, azimuth bounds and azimuth speed of one CES.
 
         Parameters
         ----------
-        scan_file : dictionary
-            Empty dictionary which will contain the outputs of the scan.
         scan_number : int
             Index of the scan (between 0 and nces - 1).
-        silent : bool
-            If False, print out messages about the scan. Default is True.
 
         Returns
         ----------
-        bool : bool
-            Returns True if the scan has been generated, and False if the scan
-            already exists on the disk.
+        el : float
+            Elevation of the scan (degree).
+        az_mean : float
+            Azimuth at the beginning of the scan (degree).
+        lower_az : float
+            Lower bound of the sweep (degree).
+        upper_az : float
+            Upper bound of the sweep (degree).
+        az_speed : float
+            Azimuth speed (degree/s).
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy()
+        >>> el, az_mean, lower_az, upper_az, az_speed = scan.scan_geometry(0)
+        >>> print(round(lower_az, 4), round(upper_az, 4))
+        132.6793 155.7733
         """
         ## Figure out the elevation to run the scan!
         el = self.elevation[scan_number]
 
-        ## Define the sampling rate in Hz
-        sampling_freq = self.sampling_freq
-
         ## Define geometry of the scan by figuring out the azimuth bounds
         az_mean = (self.az_min[scan_number] + self.az_max[scan_number]) * 0.5
         az_throw = (self.az_max[scan_number] -
                     self.az_min[scan_number]) / np.cos(el / radToDeg)
 
+        upper_az = az_mean + az_throw / 2.
+        lower_az = az_mean - az_throw / 2.
+        az_speed = self.sky_speed / np.cos(el / radToDeg)
+
+        return el, az_mean, lower_az, upper_az, az_speed
+
+    def scan_start(self, scan_number, start_date=None, forward=False):
+        """
+        Set the date of the telescope to the beginning of one CES, and
+        compute its number of samples.
+
+        Parameters
+        ----------
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+        start_date : float, optional
+            Starting date of the scan (ephem format), as computed by
+            `schedule`. If None (default), the scan starts when the local
+            sidereal time is equal to begin_LST, on the sidereal day of
+            the current date of the telescope.
+        forward : bool, optional
+            If True and start_date is None, the scan starts at the first
+            date at or after the current date of the telescope when the
+            local sidereal time is equal to begin_LST. Default is False.
+
+        Returns
+        ----------
+        num_pts : int
+            Number of time samples of the scan.
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1.)
+        >>> scan.telescope_location.date = scan.start_date
+        >>> scan.scan_start(0)
+        17499
+        >>> print(scan.telescope_location.sidereal_time())
+        17:07:54.84
+        """
         ## Define the timing bounds!
-        LST_now = float(self.telescope_location.sidereal_time()) / (2 * np.pi)
         begin_LST = float(
             ephem.hours(self.begin_LST[scan_number])) / (2 * np.pi)
         end_LST = float(ephem.hours(self.end_LST[scan_number])) / (2 * np.pi)
         if (begin_LST > end_LST):
             begin_LST -= 1.
 
-        ## Reset the date to correspond to the sidereal time to start
-        self.telescope_location.date -= (
-            (LST_now - begin_LST) * sidDayToSec) * ephem.second
+        if start_date is None:
+            ## Reset the date to correspond to the sidereal time to start
+            LST_now = float(
+                self.telescope_location.sidereal_time()) / (2 * np.pi)
+            shift = begin_LST - LST_now
+            if forward:
+                shift = np.mod(shift, 1.)
+            self.telescope_location.date += (
+                shift * sidDayToSec) * ephem.second
+        else:
+            self.telescope_location.date = start_date
 
         ## Figure out how long to run the scan for
-        num_pts = int((end_LST - begin_LST) * sidDayToSec * sampling_freq)
+        return int((end_LST - begin_LST) * sidDayToSec * self.sampling_freq)
+
+    def scan_end_date(self, start_date, num_pts):
+        """
+        Date of the telescope once a CES is done. This is the date from
+        which the next CES is searched (see scan_start).
+
+        Parameters
+        ----------
+        start_date : float
+            Starting date of the scan (ephem format).
+        num_pts : int
+            Number of time samples of the scan.
+
+        Returns
+        ----------
+        date : float
+            Date in ephem format.
+        """
+        step = ephem.second / self.sampling_freq
+        date = float(start_date) + step
+
+        ## The python version follows the date of each sample
+        if resolve_language('run_one_scan', self.language) == 'python':
+            date = np.cumsum(np.append(date, np.ones(num_pts - 1) * step))[-1]
+
+        ## Do not use that for precision - it truncates values
+        date += num_pts * ephem.second / self.sampling_freq
+
+        ## Add one day before the next CES (to avoid conflict of time)
+        date += 24 * ephem.second * 3600
+
+        return date
+
+    def schedule(self):
+        """
+        Compute the starting date and the number of samples of all CES,
+        without generating them. The starting date of a CES depends on the
+        previous ones only through the date of the telescope (unless its
+        date is given in the schedule table), and this pass is cheap.
+        The results are stored in ces_start_date (ephem format) and
+        ces_num_pts.
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1., nces=2)
+        >>> scan.schedule()
+        >>> print(scan.ces_num_pts)
+        [17499, 14400]
+        >>> date = ephem.Date(scan.ces_start_date[0])
+        >>> mjd = date_to_mjd(date) - 10. / 86400.
+        >>> print(round(mjd, 7))
+        56293.6202546
+
+        CES with a date start within one sidereal day after that date
+        >>> table = ScheduleTable({'elevation': [30., 50.],
+        ...     'az_min': [134., 162.], 'az_max': [154., 197.],
+        ...     'begin_LST': ['17:07:54.84', '22:00:21.76'],
+        ...     'end_LST': ['22:00:21.76', '02:01:01.19'],
+        ...     'date': [56300., 56400.]})
+        >>> scan = ScanningStrategy(sampling_freq=1., schedule_table=table)
+        >>> scan.schedule()
+        >>> mjd = np.array([date_to_mjd(ephem.Date(date))
+        ...     for date in scan.ces_start_date])
+        >>> assert np.all(mjd >= table['date'])
+        >>> assert np.all(mjd < table['date'] + sidDayToSec / 86400.)
+        """
+        self.telescope_location.date = self.start_date
+        self.ces_start_date = []
+        self.ces_num_pts = []
+        for CES_position in range(self.nces):
+            ## CES with a date in the schedule table start at the first
+            ## begin_LST after that date
+            dated = self.ces_date is not None and \
+                np.isfinite(self.ces_date[CES_position])
+            if dated:
+                self.telescope_location.date = ephem.Date(
+                    self.ces_date[CES_position] - 15019.5)
+
+            num_pts = self.scan_start(CES_position, forward=dated)
+            self.ces_start_date.append(float(self.telescope_location.date))
+            self.ces_num_pts.append(num_pts)
+
+            self.telescope_location.date = self.scan_end_date(
+                self.ces_start_date[-1], num_pts)
+
+    def run_one_scan(self, scan_file, scan_number, silent=True,
+                     start_date=None):
+        """
+        Generate one observation (i.e. one CES) of the telescope.
+
+        Parameters
+        ----------
+        scan_file : dictionary
+            Empty dictionary which will contain the outputs of the scan.
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+        silent : bool
+            If False, print out messages about the scan. Default is True.
+        start_date : float, optional
+            Starting date of the scan (ephem format), as computed by
+            `schedule`. If None (default), the scan starts at the next
+            begin_LST from the current date of the telescope.
+
+        Returns
+        ----------
+        bool : bool
+            Returns True if the scan has been generated, and False if the scan
+            already exists on the disk.
+        """
+        ## Define the sampling rate in Hz
+        sampling_freq = self.sampling_freq
+
+        ## Define geometry of the scan
+        el, az_mean, lower_az, upper_az, az_speed = self.scan_geometry(
+            scan_number)
+
+        ## Set the date to the beginning of the scan,
+        ## and figure out how long to run the scan for
+        num_pts = self.scan_start(scan_number, start_date)
+        start_date = float(self.telescope_location.date)
 
         ## Run the scan!
         pb_az_dir = 1.
-        upper_az = az_mean + az_throw / 2.
-        lower_az = az_mean - az_throw / 2.
-        az_speed = self.sky_speed / np.cos(el / radToDeg)
         running_az = az_mean
 
         ## Initialize arrays
@@ -251,32 +509,30 @@ class ScanningStrategy():
         running_az += az_speed * pb_az_dir / sampling_freq
         self.telescope_location.date += ephem.second / sampling_freq
 
-        if self.language == 'python':
-            for t in range(1, num_pts):
-                ## Set the Azimuth and time
-                pb_az_array[t] = running_az
-
-                pb_ra_array[t], pb_dec_array[t] = \
-                    self.telescope_location.radec_of(
-                    pb_az_array[t] * np.pi / 180.,
-                    pb_el_array[t] * np.pi / 180.)
-
-                ## Case to change the direction of the scan
-                if(running_az > upper_az):
-                    pb_az_dir = -1.
-                elif(running_az < lower_az):
-                    pb_az_dir = 1.
-
-                running_az += az_speed * pb_az_dir / sampling_freq
-
-                ## Increment the time by one second / sampling rate
-                pb_mjd_array[t] = pb_mjd_array[t-1] + \
-                    ephem.second / sampling_freq
-
-                ## Increment the time by one second / sampling rate
-                self.telescope_location.date += ephem.second / sampling_freq
-
-        elif self.language == 'C':
+        language = resolve_language('run_one_scan', self.language)
+        if language == 'python':
+            ## Whole arrays at once (no loop over samples).
+            ## Same azimuth and times as the loop of the C/fortran codes.
+            pb_az_array[1:], running_az, pb_az_dir = azimuth_sweep(
+                num_pts - 1, running_az, upper_az, lower_az,
+                az_speed, pb_az_dir, sampling_freq)
+
+            pb_mjd_array[:] = np.cumsum(np.append(
+                pb_mjd_array[0],
+                np.ones(num_pts - 1) * ephem.second / sampling_freq))
+
+            ## Date of the samples 1 to num_pts - 1 for ephem,
+            ## and date at the end of the scan.
+            dates = np.cumsum(np.append(
+                float(self.telescope_location.date),
+                np.ones(num_pts - 1) * ephem.second / sampling_freq))
+            dates = np.append(dates[0] - ephem.second / sampling_freq, dates)
+
+            pb_ra_array[:], pb_dec_array[:] = radec_of_scan(
+                self.telescope_location, dates[:-1],
+                pb_az_array * np.pi / 180., el * np.pi / 180.)
+
+        elif language == 'C':
             c_code = r'''
             int t;
             for (t=1;t<num_pts;t++)
@@ -313,15 +569,20 @@ class ScanningStrategy():
                 'lower_az', 'az_speed', 'pb_az_dir', 'pb_mjd_array',
                 'second', 'sampling_freq'], verbose=0)
 
-        elif self.language == 'fortran':
+        elif language == 'fortran':
             second = 1./24./3600.
             scanning_strategy_f.run_one_scan_f(
                 pb_az_array, pb_mjd_array,
                 running_az, upper_az, lower_az, az_speed, pb_az_dir,
                 second, sampling_freq, num_pts)
 
-        ## Do not use that for precision - it truncates values
-        self.telescope_location.date += num_pts * ephem.second / sampling_freq
+        elif language == 'numba':
+            second = 1./24./3600.
+            numba_kernels.run_one_scan_numba(
+                pb_az_array, pb_mjd_array,
+                float(running_az), float(upper_az), float(lower_az),
+                float(az_speed), float(pb_az_dir),
+                second, float(sampling_freq))
 
         ## Save in file
         scan_file['nces'] = self.nces
@@ -339,6 +600,9 @@ class ScanningStrategy():
 
         scan_file['nts'] = len(pb_mjd_array)
 
+        scan_file['boresight_angle'] = float(
+            self.ces_boresight_angle[scan_number])
+
         if not silent:
             print('+-----------------------------------+')
             print(' CES starts at %s and finishes at %s' % (
@@ -348,22 +612,31 @@ class ScanningStrategy():
                 (scan_file['lastmjd'] - scan_file['firstmjd']) * 24))
             print('+-----------------------------------+')
 
-        ## Add one day before the next CES (to avoid conflict of time)
-        self.telescope_location.date += 24 * ephem.second * 3600
+        ## Date from which the next CES is searched
+        self.telescope_location.date = self.scan_end_date(start_date, num_pts)
 
         ## Add the scan into the instance
         # self._update('scan{}'.format(scan_number), scan_file)
 
         return True
 
-    def run(self, silent=True):
+    def run(self, silent=True, ces=None, nproc=1):
         """
-        Generate all the observations (i.e. all CES) of the telescope.
+        Generate all the observations (i.e. all CES) of the telescope,
+        or only a subset of them. The starting dates of all CES are first
+        computed (see schedule), and then only the requested CES are
+        generated, sequentially or across a pool of processes.
+        The CES number i is stored in the attribute scan<i>.
 
         Parameters
         ----------
         silent : bool
             If False, print out messages about the scan. Default is True.
+        ces : list of int, optional
+            Index of the CES to generate. Default is all.
+            With MPI, use e.g. ces=range(rank, nces, size).
+        nproc : int, optional
+            Number of processes used to generate the CES. Default is 1.
 
         Examples
         ----------
@@ -373,8 +646,10 @@ class ScanningStrategy():
         56293.6202546 56293.8230093
 
         By default, the language used for the core computation is the Python.
-        It can be quite slow for heavy configuration, and one can set up
-        the language to C or fortran for speeding up the computation (x1000).
+        The scan is then generated with whole arrays (see azimuth_sweep and
+        radec_of_scan), and it includes the boresight RA and Dec.
+        If you do not need RA and Dec, one can set up
+        the language to C or fortran for speeding up the computation.
         Note that C codes are compiled on-the-fly (weave), but for fortran
         codes you need first to compile it. See the setup.py or
         the provided Makefile.
@@ -383,26 +658,390 @@ class ScanningStrategy():
         >>> scan.run()
         >>> print(scan.scan0['firstmjd'], scan.scan0['lastmjd'])
         56293.6202546 56293.8230093
+
+        Generate only the second CES (the result is the same)
+        >>> scan_sub = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran')
+        >>> scan_sub.run(ces=[1])
+        >>> 'scan0' in scan_sub.__dict__
+        False
+        >>> assert np.all(scan_sub.scan1['clock-utc'] ==
+        ...     scan.scan1['clock-utc'])
+
+        Same using 2 processes
+        >>> scan_sub = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran')
+        >>> scan_sub.run(nproc=2)
+        >>> assert np.all(scan_sub.scan1['azimuth'] == scan.scan1['azimuth'])
+
+        The processes use the same schedule table
+        >>> table = ScheduleTable({'elevation': [30., 50.],
+        ...     'az_min': [134., 162.], 'az_max': [154., 197.],
+        ...     'begin_LST': ['17:07:54.84', '22:00:21.76'],
+        ...     'end_LST': ['22:00:21.76', '02:01:01.19']})
+        >>> scan = ScanningStrategy(sampling_freq=1., language='fortran',
+        ...     schedule_table=table)
+        >>> scan.run()
+        >>> scan_sub = ScanningStrategy(sampling_freq=1., language='fortran',
+        ...     schedule_table=table)
+        >>> scan_sub.run(nproc=2)
+        >>> assert np.all(scan_sub.scan1['azimuth'] == scan.scan1['azimuth'])
+        >>> print(scan_sub.scan1['elevation'][0] * 180. / np.pi)
+        50.0
+
+        and the same rotation of the focal plane
+        >>> scan_sub = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran', boresight_angle=[0., 45.])
+        >>> scan_sub.run(nproc=2)
+        >>> print(scan_sub.scan1['boresight_angle'])
+        45.0
         """
-        ## Initialise the date and loop over CESes
-        self.telescope_location.date = self.start_date
-        for CES_position in range(self.nces):
-            ## Initialise the starting date of observation
-            ## It will be updated then automatically
-            setattr(self, 'scan{}'.format(CES_position), {})
+        if ces is None:
+            ces = range(self.nces)
+
+        ## Starting date of all CES
+        self.schedule()
+        end_date = self.telescope_location.date
+
+        ## CES already on disk
+        stored = {}
+        if self.store_dir is not None:
+            for CES_position in ces:
+                scan_file = self.load_scan(CES_position)
+                if scan_file is not None:
+                    stored[CES_position] = scan_file
+        todo = [CES_position for CES_position in ces
+                if CES_position not in stored]
+
+        if nproc > 1 and len(todo) > 0:
+            kwargs = {
+                'nces': self.nces, 'start_date': self.start_date,
+                'telescope_longitude': self.telescope_longitude,
+                'telescope_latitude': self.telescope_latitude,
+                'telescope_elevation': self.telescope_elevation,
+                'name_strategy': self.name_strategy,
+                'sampling_freq': self.sampling_freq,
+                'sky_speed': self.sky_speed, 'ut1utc_fn': self.ut1utc_fn,
+                'language': self.language,
+                'schedule_table': self.schedule_table,
+                'boresight_angle': self.boresight_angle}
+            pool = multiprocessing.Pool(nproc)
+            scan_files = pool.map(
+                _run_one_scan_worker,
+                [(kwargs, CES_position, self.ces_start_date[CES_position],
+                  silent) for CES_position in todo])
+            pool.close()
+            pool.join()
+        else:
+            scan_files = []
+            for CES_position in todo:
+                scan_files.append({})
+                self.run_one_scan(
+                    scan_files[-1], CES_position, silent=silent,
+                    start_date=self.ces_start_date[CES_position])
+
+        for CES_position, scan_file in zip(todo, scan_files):
+            if self.store_dir is not None:
+                self.save_scan(CES_position, scan_file)
+            stored[CES_position] = scan_file
+
+        for CES_position in ces:
+            setattr(self, 'scan{}'.format(CES_position),
+                    stored[CES_position])
+
+        ## Date after the last CES, as if all CES were generated
+        self.telescope_location.date = end_date
+
+    def get_scan(self, scan_number):
+        """
+        Return one CES, generating it if needed. Unlike run, CES are
+        generated on demand and only the scan_cache_size most recently
+        used are kept in memory, so that a long schedule can be processed
+        one CES at a time. CES generated by run are returned directly.
+        The attributes scan<i> use this method for CES not generated by run.
 
-            # Create the scan strategy
-            self.run_one_scan(
-                getattr(self, 'scan{}'.format(CES_position)),
-                CES_position, silent=silent)
+        Parameters
+        ----------
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+
+        Returns
+        ----------
+        scan_file : dictionary
+            The outputs of the scan (see run_one_scan).
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1., nces=4,
+        ...     language='fortran', scan_cache_size=2)
+        >>> scan_file = scan.get_scan(3)
+        >>> print(scan_file['CES'], scan_file['nts'])
+        3 14400
+        >>> for scan_file in scan.iter_scans():
+        ...     print(scan_file['CES'], list(scan.scan_cache.keys()))
+        0 [3, 0]
+        1 [0, 1]
+        2 [1, 2]
+        3 [2, 3]
+
+        Same as the full generation
+        >>> scan_ref = ScanningStrategy(sampling_freq=1., nces=4,
+        ...     language='fortran')
+        >>> scan_ref.run()
+        >>> assert np.all(scan.scan1['clock-utc'] ==
+        ...     scan_ref.scan1['clock-utc'])
+        """
+        assert 0 <= scan_number < self.nces, \
+            ValueError("The scan index must be between 0 and {}.".format(
+                self.nces - 1))
+
+        if 'scan{}'.format(scan_number) in self.__dict__:
+            return self.__dict__['scan{}'.format(scan_number)]
+
+        if scan_number in self.scan_cache:
+            scan_file = self.scan_cache.pop(scan_number)
+            self.scan_cache[scan_number] = scan_file
+            return scan_file
+
+        scan_file = None
+        if self.store_dir is not None:
+            scan_file = self.load_scan(scan_number)
+
+        if scan_file is None:
+            ## Generate the scan without changing the date of the telescope
+            date = self.telescope_location.date
+            if not hasattr(self, 'ces_start_date'):
+                self.schedule()
+
+            scan_file = {}
+            self.run_one_scan(scan_file, scan_number,
+                              start_date=self.ces_start_date[scan_number])
+            self.telescope_location.date = date
+
+            if self.store_dir is not None:
+                self.save_scan(scan_number, scan_file)
+
+        ## Drop the least recently used CES
+        self.scan_cache[scan_number] = scan_file
+        while len(self.scan_cache) > max(self.scan_cache_size, 1):
+            self.scan_cache.popitem(last=False)
+
+        return scan_file
+
+    def iter_scans(self, ces=None):
+        """
+        Iterate over CES, generated one at a time (see get_scan).
+
+        Parameters
+        ----------
+        ces : list of int, optional
+            Index of the CES. Default is all.
+
+        Returns
+        ----------
+        scan_file : dictionary
+            The outputs of the scan (see run_one_scan), one CES at a time.
+        """
+        if ces is None:
+            ces = range(self.nces)
+        for scan_number in ces:
+            yield self.get_scan(scan_number)
+
+    def describe_scan(self, scan_number):
+        """
+        Compact description of one CES (see ScanDescriptor): its samples
+        are evaluated on demand, over any range of indices.
+
+        Parameters
+        ----------
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+
+        Returns
+        ----------
+        descriptor : ScanDescriptor
+            Can be used as the scan_file dictionary of the CES.
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran')
+        >>> ces = scan.describe_scan(1)
+        >>> scan_file = scan.get_scan(1)
+        >>> assert np.all(ces.azimuth(100, 200) ==
+        ...     scan_file['azimuth'][100:200])
+        >>> assert np.all(ces['clock-utc'] == scan_file['clock-utc'])
+        >>> print(ces['nts'] == scan_file['nts'],
+        ...     ces['lastmjd'] == scan_file['lastmjd'])
+        True True
+        """
+        assert 0 <= scan_number < self.nces, \
+            ValueError("The scan index must be between 0 and {}.".format(
+                self.nces - 1))
+
+        if not hasattr(self, 'ces_start_date'):
+            date = self.telescope_location.date
+            self.schedule()
+            self.telescope_location.date = date
+
+        el, az_mean, lower_az, upper_az, az_speed = self.scan_geometry(
+            scan_number)
+
+        return ScanDescriptor(
+            scan_number, self.nces, el, az_mean, lower_az, upper_az,
+            az_speed, self.sky_speed, self.sampling_freq,
+            self.ces_start_date[scan_number], self.ces_num_pts[scan_number],
+            self.telescope_location,
+            float(self.ces_boresight_angle[scan_number]))
+
+    def store_key(self):
+        """
+        Hash of all parameters defining the CES. The language is included
+        because RA/Dec are only computed in python. The schedule table,
+        if any, is identified by its checksum.
+
+        Returns
+        ----------
+        key : string
+            Hexadecimal digest identifying the scanning strategy.
+
+        Examples
+        ----------
+        >>> scan1 = ScanningStrategy(sky_speed=0.4)
+        >>> scan2 = ScanningStrategy(sky_speed=0.5)
+        >>> scan1.store_key() == scan2.store_key()
+        False
+        """
+        h = hashlib.sha1()
+        if self.schedule_table is not None:
+            h.update(repr((
+                self.nces, self.start_date, self.telescope_longitude,
+                self.telescope_latitude, float(self.telescope_elevation),
+                float(self.sampling_freq), float(self.sky_speed),
+                resolve_language('run_one_scan', self.language),
+                self.schedule_table.checksum())).encode())
+            return h.hexdigest()
+
+        h.update(repr((
+            self.nces, self.start_date, self.telescope_longitude,
+            self.telescope_latitude, float(self.telescope_elevation),
+            self.name_strategy, float(self.sampling_freq),
+            float(self.sky_speed),
+            resolve_language('run_one_scan', self.language),
+            self.elevation, self.az_min, self.az_max,
+            self.begin_LST, self.end_LST)).encode())
+        return h.hexdigest()
+
+    def load_scan(self, scan_number):
+        """
+        Load one CES from `self.store_dir` if it has been stored before.
+        Arrays are memory-mapped (read-only).
+
+        Parameters
+        ----------
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+
+        Returns
+        ----------
+        scan_file : dictionary
+            The outputs of the scan, or None if the scan is not stored.
+
+        Examples
+        ----------
+        >>> import shutil
+        >>> store = tempfile.mkdtemp()
+        >>> scan1 = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran', store_dir=store)
+        >>> scan1.run()
+        >>> scan2 = ScanningStrategy(sampling_freq=1., nces=2,
+        ...     language='fortran', store_dir=store)
+        >>> scan_file = scan2.load_scan(1)
+        >>> print(isinstance(scan_file['azimuth'], np.memmap),
+        ...     np.all(scan_file['azimuth'] == scan1.scan1['azimuth']))
+        True True
+        >>> print(scan_file['nts'] == scan1.scan1['nts'])
+        True
+        >>> shutil.rmtree(store)
+        """
+        path = os.path.join(self.store_dir, self.store_key(),
+                            'ces{}'.format(scan_number))
+        fn = os.path.join(path, 'metadata.pkl')
+        if not os.path.isfile(fn):
+            return None
+
+        with open(fn, 'rb') as f:
+            scan_file = pickle.load(f)
+        for name in SCAN_ARRAYS:
+            scan_file[name] = np.load(
+                os.path.join(path, '{}.npy'.format(name)), mmap_mode='r')
+
+        ## Not part of the stored CES (see store_key)
+        scan_file['boresight_angle'] = float(
+            self.ces_boresight_angle[scan_number])
+        return scan_file
+
+    def save_scan(self, scan_number, scan_file):
+        """
+        Store one CES in `self.store_dir`: one .npy file per array
+        (see SCAN_ARRAYS), and the other entries in a pickle file.
+        Files are first written in a temporary folder which is then
+        renamed, so that concurrent processes never see partial entries.
+
+        Parameters
+        ----------
+        scan_number : int
+            Index of the scan (between 0 and nces - 1).
+        scan_file : dictionary
+            The outputs of the scan.
+        """
+        folder = os.path.join(self.store_dir, self.store_key())
+        path = os.path.join(folder, 'ces{}'.format(scan_number))
+        if os.path.isdir(path):
+            return
+
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                ## Someone else created it in the meantime
+                pass
+
+        tmp = tempfile.mkdtemp(dir=folder)
+        for name in SCAN_ARRAYS:
+            np.save(os.path.join(tmp, '{}.npy'.format(name)),
+                    scan_file[name])
+        metadata = {k: v for k, v in scan_file.items()
+                    if k not in SCAN_ARRAYS}
+        with open(os.path.join(tmp, 'metadata.pkl'), 'wb') as f:
+            pickle.dump(metadata, f, protocol=2)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            ## Another process stored the same entry first
+            for fn in os.listdir(tmp):
+                os.remove(os.path.join(tmp, fn))
+            os.rmdir(tmp)
+
+    def __getattr__(self, name):
+        """
+        Compatibility with the attributes scan<i>: CES not generated
+        by run are generated on demand (see get_scan).
+        """
+        if name.startswith('scan') and name[4:].isdigit() and \
+                int(name[4:]) < self.__dict__.get('nces', 0):
+            return self.get_scan(int(name[4:]))
+        raise AttributeError(name)
 
     def visualize_my_scan(self, nside, reso=6.9, xsize=900, rot=[0, -57.5],
                           nfid_bolometer=6000, fp_size=180., boost=1.,
-                          test=False):
+                          test=False, method='pixel'):
         """
         Simple map-making: project time ordered data into sky maps for
-        visualisation. It works only in pure python (i.e. if you set
-        language='python' when initialising the scanning_strategy class).
+        visualisation. In pure python (i.e. if you set language='python'
+        when initialising the scanning_strategy class), the RA and Dec of
+        the scans are used. Otherwise they are computed from the
+        compact description of the scans (see describe_scan).
 
         Parameters
         ----------
@@ -425,36 +1064,36 @@ class ScanningStrategy():
             It doesn't change the shape of the survey (just the amplitude).
         test : bool
             If True, doesn't display the result (mainly for test mode).
+        method : string, optional
+            Method for the focal plane convolution: pixel or harmonic
+            (faster at high resolution). See convolve_focalplane.
 
         Outputs
         ----------
             * nhit_loc: 1D array, sky map with cumulative hit counts
 
         """
-        if self.language != 'python':
-            raise ValueError("Visualisation is available only in pure " +
-                             "python because we do not provide (yet) " +
-                             "RA and Dec in C or fortran. Relaunch " +
-                             "using language='python' in the class " +
-                             "ScanningStrategy.")
-
         npix = hp.pixelfunc.nside2npix(nside)
         nhit = np.zeros(npix)
         for scan_number in range(self.nces):
-            scan = getattr(self, 'scan{}'.format(scan_number))
+            ## C, fortran and numba are not returning RA and Dec.
+            if self.language == 'python':
+                scan = self.get_scan(scan_number)
+                ra, dec = scan['RA'], scan['Dec']
+            else:
+                ra, dec = self.describe_scan(scan_number).radec()
 
-            num_pts = len(scan['clock-utc'])
-            pix_global = hp.pixelfunc.ang2pix(
-                nside, (np.pi/2.) - scan['Dec'], scan['RA'])
+            num_pts = len(ra)
+            pix_global = hp.pixelfunc.ang2pix(nside, (np.pi/2.) - dec, ra)
 
             ## Boresight pointing healpix maps
             nhit_loc = np.zeros(npix)
 
-            ## language = C or language = fortran are not yet supported
-            ## because they are not returning RA and Dec. So for the moment
-            ## only language == python is considered.
-            ## TODO Compute RA and Dec in C and Fortran.
-            if self.language in ['python', 'C']:
+            ## No pure python version: python means C here.
+            language = resolve_language(
+                'mapmaking',
+                'C' if self.language == 'python' else self.language)
+            if language == 'C':
                 c_code = r"""
                 int i, pix;
                 double c, s;
@@ -471,14 +1110,19 @@ class ScanningStrategy():
                     'pix_global',
                     'num_pts',
                     'nhit_loc'], verbose=0)
-            elif self.language == 'fortran':
+            elif language == 'fortran':
+                ## The fortran kernel works with 4-byte integers
+                nhit_int = np.zeros(npix, dtype=np.int32)
                 scanning_strategy_f.mapmaking(
-                    pix_global, nhit_loc, npix, num_pts)
+                    np.array(pix_global, dtype=np.int32), nhit_int,
+                    npix, num_pts)
+                nhit_loc += nhit_int
+            elif language == 'numba':
+                numba_kernels.mapmaking_numba(pix_global, nhit_loc)
 
             ## Fake large focal plane with many bolometers for visualisation.
             nhit_loc = convolve_focalplane(nhit_loc, nfid_bolometer,
-                                           fp_size, boost,
-                                           language=self.language)
+                                           fp_size, boost, method=method)
 
             nhit += nhit_loc
 
@@ -519,24 +1163,956 @@ class ScanningStrategy():
         """
         setattr(self, name, value)
 
+class ScanDescriptor():
+    """ Compact description of one CES, with samples evaluated on demand """
+    def __init__(self, CES, nces, el, az_mean, lower_az, upper_az, az_speed,
+                 sky_speed, sampling_freq, start_date, num_pts,
+                 telescope_location, boresight_angle=0.):
+        """
+        The telescope sweeps the azimuth at constant speed between
+        lower_az and upper_az, starting at az_mean, at constant elevation.
+        Each sample is on the grid az_mean + n * step (n integer), and n
+        is a triangle wave of the sample index. Azimuth and time are
+        computed in closed form, with the step actually taken by the
+        loop of run_one_scan (including its rounding): the values are
+        exactly the same as the ones generated by run_one_scan as long
+        as all the values share the same binary exponent (which is the
+        case for the default scanning strategy and MJD between
+        1948 and 2038), and agree to ~1e-12 otherwise.
+
+        Parameters
+        ----------
+        CES : int
+            Index of the scan.
+        nces : int
+            Total number of scans.
+        el : float
+            Elevation of the scan (degree).
+        az_mean : float
+            Azimuth at the beginning of the scan (degree).
+        lower_az : float
+            Lower bound of the sweep (degree).
+        upper_az : float
+            Upper bound of the sweep (degree).
+        az_speed : float
+            Azimuth speed (degree/s).
+        sky_speed : float
+            Speed on the sky (degree/s).
+        sampling_freq : float
+            Sampling frequency (Hz).
+        start_date : float
+            Date of the first sample (ephem format).
+        num_pts : int
+            Number of samples.
+        telescope_location : ephem.Observer
+            The site of observation (only its coordinates are used).
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight (degree).
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1.)
+        >>> ces = scan.describe_scan(0)
+        >>> print(ces['nts'], ces.phase, ces.period)
+        17499 26 104
+        """
+        self.CES = CES
+        self.nces = nces
+        self.el = el
+        self.az_mean = az_mean
+        self.lower_az = lower_az
+        self.upper_az = upper_az
+        self.az_speed = az_speed
+        self.sky_speed = sky_speed
+        self.sampling_freq = sampling_freq
+        self.start_date = start_date
+        self.num_pts = num_pts
+        self.boresight_angle = boresight_angle
+
+        ## Coordinates of the site (ephem objects cannot be copied)
+        self.location = (float(telescope_location.long),
+                         float(telescope_location.lat),
+                         float(telescope_location.elevation))
+
+        ## Step between two samples, as accumulated in run_one_scan
+        self.az_step = (az_mean + az_speed * 1. / sampling_freq) - az_mean
+
+        ## Azimuth grid index at which the direction changes:
+        ## first index above upper_az, last index below lower_az.
+        n_up = max(int(np.floor((upper_az - az_mean) / self.az_step)), 0)
+        while az_mean + n_up * self.az_step <= upper_az:
+            n_up += 1
+        while n_up > 0 and az_mean + (n_up - 1) * self.az_step > upper_az:
+            n_up -= 1
+        n_low = min(int(np.ceil((lower_az - az_mean) / self.az_step)), n_up)
+        while az_mean + n_low * self.az_step >= lower_az:
+            n_low -= 1
+        while n_low + 1 < n_up and \
+                az_mean + (n_low + 1) * self.az_step < lower_az:
+            n_low += 1
+        self.n_low = n_low
+
+        ## Triangle wave of period 2 * (n_up - n_low) samples,
+        ## and phase of the first sample.
+        self.period = 2 * (n_up - n_low)
+        self.phase = -n_low
+
+        ## Time step, as accumulated in run_one_scan
+        self.firstmjd = date_to_mjd(ephem.Date(start_date))
+        self.mjd_step = (self.firstmjd + ephem.second / sampling_freq) - \
+            self.firstmjd
+
+        ## Pad scans 10 seconds on either side
+        self.time_padding = 10.0 / 86400.0
+
+    def _indices(self, start, stop):
+        """ Sample indices between start and stop (default: all samples) """
+        if stop is None:
+            stop = self.num_pts
+        return np.arange(start, min(stop, self.num_pts))
+
+    def azimuth(self, start=0, stop=None):
+        """
+        Azimuth of the samples start to stop - 1 (radian).
+
+        Examples
+        ----------
+        >>> scan = ScanningStrategy(sampling_freq=1.)
+        >>> ces = scan.describe_scan(0)
+        >>> az = ces.azimuth(0, 4) * radToDeg
+        >>> print(np.round(az, 3).tolist())
+        [144.226, 144.688, 145.15, 145.612]
+        """
+        index = (self._indices(start, stop) + self.phase) % self.period
+        n = self.n_low + np.where(
+            index <= self.period // 2, index, self.period - index)
+        return (self.az_mean + n * self.az_step) * np.pi / 180
+
+    def elevation(self, start=0, stop=None):
+        """ Elevation of the samples start to stop - 1 (radian) """
+        return np.ones(len(self._indices(start, stop))) * self.el * \
+            np.pi / 180
+
+    def clock_utc(self, start=0, stop=None):
+        """ Date of the samples start to stop - 1 (MJD) """
+        return self.firstmjd + self._indices(start, stop) * self.mjd_step
+
+    def radec(self, start=0, stop=None):
+        """
+        Boresight RA and Dec of the samples start to stop - 1 (radian).
+        They are computed as in run_one_scan with language=python
+        (see radec_of_scan), whatever the language.
+        """
+        index = self._indices(start, stop)
+
+        location = ephem.Observer()
+        location.long, location.lat, location.elevation = self.location
+
+        ## Dates of the samples as seen by ephem in run_one_scan
+        step = ephem.second / self.sampling_freq
+        date_1 = self.start_date + step
+        date_step = (date_1 + step) - date_1
+        dates = date_1 + (index - 1) * date_step
+        dates[index == 0] = date_1 - step
+
+        return radec_of_scan(location, dates, self.azimuth(start, stop),
+                             self.el * np.pi / 180.)
+
+    def __getitem__(self, key):
+        """
+        Entries of the scan_file dictionary of run_one_scan.
+        Arrays are evaluated for all samples.
+        """
+        if key == 'azimuth':
+            return self.azimuth()
+        elif key == 'elevation':
+            return self.elevation()
+        elif key == 'clock-utc':
+            return self.clock_utc()
+        elif key == 'RA':
+            return self.radec()[0]
+        elif key == 'Dec':
+            return self.radec()[1]
+        elif key == 'nts':
+            return self.num_pts
+        elif key == 'firstmjd':
+            return self.firstmjd - self.time_padding
+        elif key == 'lastmjd':
+            return self.clock_utc(self.num_pts - 1)[0] + self.time_padding
+        elif key == 'sample_rate':
+            return self.sampling_freq
+        elif key in ['nces', 'CES', 'sky_speed', 'boresight_angle']:
+            return getattr(self, key)
+        raise KeyError(key)
+
+class EncoderScanSource():
+    """ Scans replayed from recorded telescope encoder data """
+    def __init__(self, path, window_size=1000000, max_gap=10.,
+                 telescope_longitude='-67:46.816',
+                 telescope_latitude='-22:56.396', telescope_elevation=5200.,
+                 ra_mid=0., dec_mid=-57.5,
+                 ut1utc_fn='s4cmb/data/ut1utc.ephem', language='python',
+                 scan_cache_size=2, boresight_angle=0.):
+        """
+        The encoder data (azimuth, elevation and time of each sample)
+        are stored in chunk files (see write_encoder_chunks), read in
+        time order. The stream is cut into windows of at most window_size
+        samples, and a new window is started at each gap in the data.
+        Each window is a scan, with the same entries as the scans of
+        ScanningStrategy, and can be used instead of ScanningStrategy
+        in TimeOrderedDataPairDiff: only the window being processed
+        is read from the disk.
+
+        Parameters
+        ----------
+        path : string or list of string
+            Folder containing the chunk files (.npy files, read in
+            alphabetical order), or list of chunk files.
+        window_size : int, optional
+            Maximum number of samples per window (i.e. per scan).
+        max_gap : float, optional
+            Maximum time between two consecutive samples of the same
+            window, in second.
+        telescope_longitude : string, optional
+            Longitute (angle) of the telescope. String form: 0:00:00.0.
+        telescope_latitude : string, optional
+            Latitude (angle) of the telescope. String form: 0:00:00.0.
+        telescope_elevation : float, optional
+            Height above sea level (in meter).
+        ra_mid : float, optional
+            RA of the center of the observed patch (degree).
+        dec_mid : float, optional
+            Dec of the center of the observed patch (degree).
+        ut1utc_fn : string, optional
+            File containing time correction to UTC.
+            This is not used here, but pass to the pointing module later on.
+        language : string, optional
+            Language used for core computations (see ScanningStrategy).
+            The boresight RA/Dec of the scans are only computed for
+            language=python.
+        scan_cache_size : int, optional
+            Maximum number of scans kept in memory by get_scan.
+        boresight_angle : float, optional
+            Rotation of the focal plane around the boresight (degree).
+
+        Examples
+        ----------
+        >>> import shutil
+        >>> scan = ScanningStrategy(sampling_freq=1., nces=3,
+        ...     language='fortran')
+        >>> scan.run()
+        >>> path = tempfile.mkdtemp()
+        >>> files = write_encoder_chunks(path,
+        ...     [scan.scan0['azimuth'], scan.scan2['azimuth']],
+        ...     [scan.scan0['elevation'], scan.scan2['elevation']],
+        ...     [scan.scan0['clock-utc'], scan.scan2['clock-utc']],
+        ...     chunk_size=5000)
+        >>> len(files)
+        7
+
+        The two CES are separated by a gap (CES are observed on different
+        days), and cut in windows of 8000 samples at most
+        >>> source = EncoderScanSource(path, window_size=8000,
+        ...     language='fortran')
+        >>> print(source.nces, [int(n) for n in source.ces_num_pts])
+        5 [8000, 8000, 1499, 8000, 6400]
+        >>> scan_file = source.get_scan(3)
+        >>> assert np.all(scan_file['clock-utc'] ==
+        ...     scan.scan2['clock-utc'][:8000])
+        >>> print(scan_file['CES'], scan_file['nts'],
+        ...     round(scan_file['sample_rate'], 6))
+        3 8000 1.0
+
+        The scans can be simulated as the ones of ScanningStrategy
+        >>> from s4cmb.tod import load_fake_instrument
+        >>> from s4cmb.tod import TimeOrderedDataPairDiff
+        >>> inst, _, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, source, sky_in, CESnumber=2)
+        >>> print(tod.nsamples)
+        1499
+        >>> shutil.rmtree(path)
+        """
+        self.window_size = int(window_size)
+        self.max_gap = max_gap
+        self.ra_mid = ra_mid
+        self.dec_mid = dec_mid
+        self.ut1utc_fn = ut1utc_fn
+        self.language = language
+        self.telescope_longitude = telescope_longitude
+        self.telescope_latitude = telescope_latitude
+        self.telescope_elevation = telescope_elevation
+        self.scan_cache_size = scan_cache_size
+        self.scan_cache = OrderedDict()
+        self.boresight_angle = boresight_angle
+
+        if isinstance(path, str):
+            self.chunk_files = [
+                os.path.join(path, fn) for fn in sorted(os.listdir(path))
+                if fn.endswith('.npy')]
+        else:
+            self.chunk_files = list(path)
+
+        assert len(self.chunk_files) > 0, \
+            ValueError("No encoder chunk files found in {}".format(path))
+
+        self.telescope_location = ephem.Observer()
+        self.telescope_location.long = telescope_longitude
+        self.telescope_location.lat = telescope_latitude
+        self.telescope_location.elevation = telescope_elevation
+
+        self.index_chunks()
+
+    def index_chunks(self):
+        """
+        Read the time of the samples (chunk by chunk), and define the
+        windows: `ces_first_sample` and `ces_num_pts` are the global index
+        of the first sample and the number of samples of each window.
+        """
+        ## Global index of the first sample of each chunk
+        self.chunk_offsets = [0]
+        breaks = [0]
+        last_mjd = None
+        for fn in self.chunk_files:
+            chunk = np.load(fn, mmap_mode='r')
+            assert chunk.ndim == 2 and chunk.shape[0] == 3, \
+                ValueError("Encoder chunks must be arrays of size (3, n)")
+            mjd = np.asarray(chunk[2])
+
+            ## Gaps within the chunk and with the previous chunk
+            gaps = np.where(np.diff(mjd) * 86400. > self.max_gap)[0] + 1
+            if last_mjd is not None and len(mjd) > 0 and \
+                    (mjd[0] - last_mjd) * 86400. > self.max_gap:
+                gaps = np.append(0, gaps)
+            breaks.extend((gaps + self.chunk_offsets[-1]).tolist())
+
+            if len(mjd) > 0:
+                last_mjd = mjd[-1]
+            self.chunk_offsets.append(self.chunk_offsets[-1] + len(mjd))
+        breaks.append(self.chunk_offsets[-1])
+
+        ## Contiguous segments, cut in windows of at most window_size
+        first = []
+        for start, stop in zip(breaks[:-1], breaks[1:]):
+            first.extend(range(start, stop, self.window_size))
+        self.ces_first_sample = np.array(first, dtype=np.int64)
+        self.ces_num_pts = np.diff(
+            np.append(self.ces_first_sample, self.chunk_offsets[-1]))
+        self.nces = len(self.ces_first_sample)
+
+    def read_samples(self, start, stop):
+        """
+        Read the encoder data of the samples start to stop - 1.
+        Samples within a single chunk are returned as memory-mapped
+        (read-only) arrays, otherwise the chunks are concatenated.
+
+        Parameters
+        ----------
+        start : int
+            Global index of the first sample.
+        stop : int
+            Global index of the last sample + 1.
+
+        Returns
+        ----------
+        az : 1d array
+            Azimuth of the samples (radian).
+        el : 1d array
+            Elevation of the samples (radian).
+        mjd : 1d array
+            Time of the samples (MJD).
+        """
+        pieces = []
+        for k, fn in enumerate(self.chunk_files):
+            lo = max(start, self.chunk_offsets[k])
+            hi = min(stop, self.chunk_offsets[k + 1])
+            if lo < hi:
+                chunk = np.load(fn, mmap_mode='r')
+                pieces.append(chunk[:, lo - self.chunk_offsets[k]:
+                                    hi - self.chunk_offsets[k]])
+
+        if len(pieces) == 1:
+            return pieces[0][0], pieces[0][1], pieces[0][2]
+        data = np.concatenate(pieces, axis=1)
+        return data[0], data[1], data[2]
+
+    def get_scan(self, scan_number):
+        """
+        Return one window of the encoder data, with the same entries as
+        the scans of ScanningStrategy (see run_one_scan). Only the
+        scan_cache_size most recently used windows are kept in memory.
+
+        Parameters
+        ----------
+        scan_number : int
+            Index of the window (between 0 and nces - 1).
+
+        Returns
+        ----------
+        scan_file : dictionary
+            The outputs of the scan.
+        """
+        assert 0 <= scan_number < self.nces, \
+            ValueError("The scan index must be between 0 and {}.".format(
+                self.nces - 1))
+
+        if scan_number in self.scan_cache:
+            scan_file = self.scan_cache.pop(scan_number)
+            self.scan_cache[scan_number] = scan_file
+            return scan_file
+
+        start = self.ces_first_sample[scan_number]
+        az, el, mjd = self.read_samples(
+            start, start + self.ces_num_pts[scan_number])
+
+        ## Pad scans 10 seconds on either side
+        time_padding = 10.0 / 86400.0
+
+        scan_file = {}
+        scan_file['nces'] = self.nces
+        scan_file['CES'] = scan_number
+        scan_file['firstmjd'] = mjd[0] - time_padding
+        scan_file['lastmjd'] = mjd[-1] + time_padding
+
+        ## Estimated from the data
+        if len(mjd) > 1:
+            dt = np.median(np.diff(mjd)) * 86400.
+            scan_file['sample_rate'] = 1. / dt
+            scan_file['sky_speed'] = np.median(
+                np.abs(np.diff(az)) * np.cos(el[1:])) * radToDeg / dt
+        else:
+            scan_file['sample_rate'] = 0.
+            scan_file['sky_speed'] = 0.
+
+        scan_file['azimuth'] = az
+        scan_file['elevation'] = el
+        scan_file['clock-utc'] = mjd
+
+        ## Boresight RA/Dec (only used for visualisation), assuming
+        ## a constant elevation scan at the median elevation of the window
+        if resolve_language('run_one_scan', self.language) == 'python':
+            scan_file['RA'], scan_file['Dec'] = radec_of_scan(
+                self.telescope_location, mjd - 15019.5, az,
+                float(np.median(el)))
+        else:
+            scan_file['RA'] = np.zeros(len(mjd))
+            scan_file['Dec'] = np.zeros(len(mjd))
+
+        scan_file['nts'] = len(mjd)
+        scan_file['boresight_angle'] = self.boresight_angle
+
+        ## Drop the least recently used windows
+        self.scan_cache[scan_number] = scan_file
+        while len(self.scan_cache) > max(self.scan_cache_size, 1):
+            self.scan_cache.popitem(last=False)
+
+        return scan_file
+
+    def iter_scans(self, ces=None):
+        """
+        Iterate over windows, read one at a time (see get_scan).
+
+        Parameters
+        ----------
+        ces : list of int, optional
+            Index of the windows. Default is all.
+
+        Returns
+        ----------
+        scan_file : dictionary
+            The outputs of the scan, one window at a time.
+        """
+        if ces is None:
+            ces = range(self.nces)
+        for scan_number in ces:
+            yield self.get_scan(scan_number)
+
+    def __getattr__(self, name):
+        """
+        Compatibility with the attributes scan<i> of ScanningStrategy.
+        """
+        if name.startswith('scan') and name[4:].isdigit() and \
+                int(name[4:]) < self.__dict__.get('nces', 0):
+            return self.get_scan(int(name[4:]))
+        raise AttributeError(name)
+
+def write_encoder_chunks(path, az, el, mjd, chunk_size=1000000):
+    """
+    Write encoder data in chunk files readable by EncoderScanSource:
+    arrays of size (3, n) containing azimuth (radian), elevation (radian),
+    and time (MJD) of the samples, stored in .npy files.
+
+    Parameters
+    ----------
+    path : string
+        Folder where to write the chunk files (created if needed).
+    az : 1d array or list of 1d arrays
+        Azimuth of the samples (radian).
+    el : 1d array or list of 1d arrays
+        Elevation of the samples (radian).
+    mjd : 1d array or list of 1d arrays
+        Time of the samples (MJD), in increasing order.
+    chunk_size : int, optional
+        Number of samples per chunk file.
+
+    Returns
+    ----------
+    files : list of string
+        Names of the chunk files.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    data = np.array([np.concatenate(x) if isinstance(x, (list, tuple))
+                     else np.asarray(x) for x in [az, el, mjd]])
+    files = []
+    for k, start in enumerate(range(0, data.shape[1], chunk_size)):
+        fn = os.path.join(path, 'chunk_{:06d}.npy'.format(k))
+        np.save(fn, data[:, start: start + chunk_size])
+        files.append(fn)
+    return files
+
+class ScheduleTable():
+    """ Schedule of observations stored in array-backed columns """
+    def __init__(self, columns, site=None, center=None):
+        """
+        Table of CES, one row per CES, with the columns of
+        SCHEDULE_COLUMNS:
+        * patch: name of the observed patch.
+        * elevation: elevation of the scan (degree).
+        * az_min, az_max: azimuth bounds of the patch (degree).
+        * begin_LST, end_LST: local sidereal time window (radian).
+        * date: MJD from which the CES is observed (the scan starts at the
+          first begin_LST after this date, i.e. within one sidereal day),
+          or NaN to follow the previous CES.
+        * boresight_angle: rotation of the focal plane around the
+          boresight (degree).
+        The table can be read from a text file (see read_schedule), and
+        stored on disk in binary format (see save), in which case the
+        columns are memory-mapped when loaded (see load_schedule): only the
+        requested rows are read from the disk.
+
+        Parameters
+        ----------
+        columns : dictionary
+            Values of the columns. Only elevation, az_min, az_max,
+            begin_LST and end_LST are required. LST can be given as
+            strings (HH:MM:SS) or in radian.
+        site : tuple, optional
+            Site of observation (longitude, latitude, height), as in
+            ScanningStrategy. Default is None (defined by ScanningStrategy).
+        center : tuple, optional
+            Center of the observed region (RA, Dec) in degree.
+            Default is None (defined by ScanningStrategy).
+
+        Examples
+        ----------
+        >>> table = ScheduleTable({'elevation': [30., 50., 60.],
+        ...     'az_min': [134., 162., 162.], 'az_max': [154., 197., 197.],
+        ...     'begin_LST': ['17:07:54.84', '22:00:21.76', '22:00:21.76'],
+        ...     'end_LST': ['22:00:21.76', '02:01:01.19', '02:01:01.19'],
+        ...     'patch': ['wide', 'deep', 'deep']})
+        >>> print(len(table), table['elevation'].tolist())
+        3 [30.0, 50.0, 60.0]
+        >>> print(table.select(patch='deep').tolist(),
+        ...     table.select(elevation=(40., 55.)).tolist())
+        [1, 2] [1]
+        """
+        nrows = len(columns['elevation'])
+        self.site = site
+        self.center = center
+
+        self.columns = {}
+        for name in SCHEDULE_COLUMNS:
+            if name in columns:
+                values = columns[name]
+            elif name == 'patch':
+                values = [''] * nrows
+            elif name == 'date':
+                values = np.ones(nrows) * np.nan
+            elif name == 'boresight_angle':
+                values = np.zeros(nrows)
+            else:
+                raise ValueError(
+                    "The column {} of the schedule is missing".format(name))
+
+            if name in ['begin_LST', 'end_LST'] and not (
+                    isinstance(values, np.ndarray) and
+                    values.dtype.kind == 'f'):
+                values = [float(ephem.hours(v)) for v in values]
+
+            if isinstance(values, np.ndarray):
+                ## Do not read memory-mapped columns
+                self.columns[name] = values
+            elif name == 'patch':
+                self.columns[name] = np.array(values, dtype=str)
+            else:
+                self.columns[name] = np.array(values, dtype=np.float64)
+
+            assert len(self.columns[name]) == nrows, \
+                ValueError("All columns must have the same length")
+
+        ## Sorted order of the columns (see select)
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.columns['elevation'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def order(self, name):
+        """
+        Indices sorting the column `name` (computed once).
+        Rows with NaN values are not included.
+
+        Parameters
+        ----------
+        name : string
+            Name of the column.
+
+        Returns
+        ----------
+        order : 1d array of int
+            Indices of the rows by increasing value.
+        """
+        if name not in self.orders:
+            values = np.asarray(self.columns[name])
+            order = np.argsort(values, kind='mergesort')
+            if values.dtype.kind == 'f':
+                order = order[~np.isnan(values[order])]
+            self.orders[name] = order
+        return self.orders[name]
+
+    def select(self, patch=None, elevation=None, date=None):
+        """
+        Indices of the CES matching all the criteria. The search is done
+        with the sorted order of the columns (a binary search per
+        criterion): only a few values of each column are read.
+
+        Parameters
+        ----------
+        patch : string, optional
+            Name of the observed patch.
+        elevation : tuple of float, optional
+            Range (min, max) of elevation (degree).
+        date : tuple, optional
+            Range (min, max) of the date column, in MJD or in any format
+            understood by ephem.Date (e.g. '2013/1/1'). The CES itself
+            starts within one sidereal day after its date.
+
+        Returns
+        ----------
+        indices : 1d array of int
+            Sorted indices of the CES.
+
+        Examples
+        ----------
+        >>> table = ScheduleTable({'elevation': [30., 50., 60.],
+        ...     'az_min': [134., 162., 162.], 'az_max': [154., 197., 197.],
+        ...     'begin_LST': [4.48, 5.76, 5.76], 'end_LST': [5.76, 0.52, 0.52],
+        ...     'date': [56293., 56294., 56660.]})
+        >>> print(table.select(date=('2013/1/1', '2013/12/31')).tolist())
+        [0, 1]
+        >>> print(table.select(date=(56294., 56700.), elevation=(55., 90.)))
+        [2]
+        """
+        if date is not None:
+            date = [date_to_mjd(ephem.Date(v)) if isinstance(v, str)
+                    else v for v in date]
+        if patch is not None:
+            patch = (patch, patch)
+
+        indices = np.arange(len(self))
+        for name, bounds in zip(['patch', 'elevation', 'date'],
+                                [patch, elevation, date]):
+            if bounds is None:
+                continue
+            order = self.order(name)
+            sorted_values = _SortedView(self.columns[name], order)
+            start = bisect.bisect_left(sorted_values, bounds[0])
+            stop = bisect.bisect_right(sorted_values, bounds[1])
+            indices = np.intersect1d(indices, order[start:stop])
+        return indices
+
+    def partition(self, rank, size, indices=None):
+        """
+        Share CES between processes: each process gets one CES every
+        `size` CES (in time order).
+        All the shared CES must have a date: a CES without date starts
+        after the previous CES of the table, which is not the same in a
+        subset. To share undated CES, run the strategy of the full table
+        on each process with run(ces=range(rank, nces, size)).
+
+        Parameters
+        ----------
+        rank : int
+            Index of the process.
+        size : int
+            Number of processes.
+        indices : 1d array of int, optional
+            CES to share (see select). Default is all.
+
+        Returns
+        ----------
+        table : ScheduleTable
+            The CES of the process (see subset).
+
+        Raises
+        ----------
+        ValueError if one of the shared CES has no date.
+
+        Examples
+        ----------
+        >>> table = ScheduleTable({'elevation': np.arange(10.),
+        ...     'az_min': np.zeros(10), 'az_max': np.ones(10),
+        ...     'begin_LST': np.zeros(10), 'end_LST': np.ones(10),
+        ...     'date': 56293. + np.arange(10.)})
+        >>> print(table.partition(1, 4)['elevation'].tolist())
+        [1.0, 5.0, 9.0]
+
+        Undated CES cannot be shared
+        >>> table = ScheduleTable({'elevation': np.arange(10.),
+        ...     'az_min': np.zeros(10), 'az_max': np.ones(10),
+        ...     'begin_LST': np.zeros(10), 'end_LST': np.ones(10)})
+        >>> part = table.partition(1, 4) # doctest: +NORMALIZE_WHITESPACE
+        Traceback (most recent call last):
+         ...
+        ValueError: Only CES with a date can be shared between processes.
+        Use run(ces=range(rank, nces, size)) with the full table instead.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if not np.all(np.isfinite(self.columns['date'][indices])):
+            raise ValueError(
+                "Only CES with a date can be shared between processes. " +
+                "Use run(ces=range(rank, nces, size)) with the full " +
+                "table instead.")
+
+        return self.subset(indices[rank::size])
+
+    def subset(self, indices):
+        """
+        New table with only some rows. Only these rows are read.
+
+        Parameters
+        ----------
+        indices : 1d array of int
+            Indices of the CES.
+
+        Returns
+        ----------
+        table : ScheduleTable
+            Table with the CES of indices.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return ScheduleTable(
+            {name: np.array(self.columns[name][indices])
+             for name in SCHEDULE_COLUMNS},
+            site=self.site, center=self.center)
+
+    def checksum(self):
+        """
+        Hash of the content of the table.
+
+        Returns
+        ----------
+        key : string
+            Hexadecimal digest identifying the table.
+        """
+        h = hashlib.sha1()
+        h.update(repr((self.site, self.center)).encode())
+        for name in SCHEDULE_COLUMNS:
+            h.update(np.ascontiguousarray(self.columns[name]).tobytes())
+        return h.hexdigest()
+
+    def save(self, path):
+        """
+        Store the table in a folder: one .npy file per column, the sorted
+        order of the columns used by select, and the site and center in a
+        pickle file.
+
+        Parameters
+        ----------
+        path : string
+            Folder where to write the table (created if needed).
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for name in SCHEDULE_COLUMNS:
+            np.save(os.path.join(path, '{}.npy'.format(name)),
+                    self.columns[name])
+        for name in ['patch', 'elevation', 'date']:
+            np.save(os.path.join(path, '{}.order.npy'.format(name)),
+                    self.order(name))
+        with open(os.path.join(path, 'metadata.pkl'), 'wb') as f:
+            pickle.dump({'site': self.site, 'center': self.center}, f,
+                        protocol=2)
+
+class _SortedView():
+    """
+    Sorted view of a column for the binary search of ScheduleTable.select:
+    values are read on access, so that memory-mapped columns are not
+    read entirely.
+    """
+    def __init__(self, values, order):
+        self.values = values
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        return self.values[self.order[index]]
+
+def read_schedule(fn):
+    """
+    Read a schedule from a text file. Lines starting with # are comments,
+    except for the header lines:
+    * `# site: longitude latitude height` (optional, see ScanningStrategy).
+    * `# center: RA Dec` (optional, in degree).
+    * `# columns: name1 name2 ...` names of the columns (see ScheduleTable).
+    Then one line per CES, with values separated by spaces.
+    Dates are in the format YYYY/M/D (one word), or MJD.
+
+    Parameters
+    ----------
+    fn : string
+        Name of the text file.
+
+    Returns
+    ----------
+    table : ScheduleTable
+        The schedule.
+
+    Examples
+    ----------
+    >>> fn = os.path.join(tempfile.mkdtemp(), 'schedule.txt')
+    >>> with open(fn, 'w') as f:
+    ...     _ = f.write('# site: -67:46.816 -22:56.396 5200.\\n')
+    ...     _ = f.write('# columns: patch elevation az_min az_max ' +
+    ...         'begin_LST end_LST date\\n')
+    ...     _ = f.write('deep 30.0 134.2263 154.2263 ' +
+    ...         '17:07:54.84 22:00:21.76 2013/1/1\\n')
+    ...     _ = f.write('deep 45.5226 162.3532 197.3532 ' +
+    ...         '22:00:21.76 02:01:01.19 2013/1/2\\n')
+    >>> table = read_schedule(fn)
+    >>> print(len(table), table.site, table['date'].tolist())
+    2 ('-67:46.816', '-22:56.396', 5200.0) [56293.0, 56294.0]
+    """
+    site = None
+    center = None
+    names = None
+    rows = []
+    with open(fn, 'r') as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 0:
+                continue
+            elif words[0] == '#' and len(words) > 1:
+                if words[1] == 'site:':
+                    site = (words[2], words[3], float(words[4]))
+                elif words[1] == 'center:':
+                    center = (float(words[2]), float(words[3]))
+                elif words[1] == 'columns:':
+                    names = words[2:]
+            elif not words[0].startswith('#'):
+                rows.append(words)
+
+    assert names is not None, \
+        ValueError("The schedule file must have a `# columns:` line")
+
+    columns = {name: [row[i] for row in rows]
+               for i, name in enumerate(names)}
+    for name in ['elevation', 'az_min', 'az_max', 'boresight_angle']:
+        if name in columns:
+            columns[name] = [float(v) for v in columns[name]]
+    if 'date' in columns:
+        columns['date'] = [
+            float(v) if '/' not in v else date_to_mjd(ephem.Date(v))
+            for v in columns['date']]
+
+    return ScheduleTable(columns, site=site, center=center)
+
+def load_schedule(path):
+    """
+    Load a schedule stored with ScheduleTable.save. Columns are memory-mapped
+    (read-only).
+
+    Parameters
+    ----------
+    path : string
+        Folder containing the table.
+
+    Returns
+    ----------
+    table : ScheduleTable
+        The schedule.
+
+    Examples
+    ----------
+    >>> import shutil
+    >>> table = ScheduleTable({'elevation': np.arange(10.),
+    ...     'az_min': np.zeros(10), 'az_max': np.ones(10),
+    ...     'begin_LST': np.zeros(10), 'end_LST': np.ones(10)},
+    ...     site=('-67:46.816', '-22:56.396', 5200.))
+    >>> path = tempfile.mkdtemp()
+    >>> table.save(path)
+    >>> table2 = load_schedule(path)
+    >>> print(isinstance(table2['elevation'], np.memmap), table2.site[2])
+    True 5200.0
+    >>> print(table2.select(elevation=(2.5, 4.5)).tolist())
+    [3, 4]
+    >>> print(table2.checksum() == table.checksum())
+    True
+    >>> shutil.rmtree(path)
+    """
+    with open(os.path.join(path, 'metadata.pkl'), 'rb') as f:
+        metadata = pickle.load(f)
+
+    columns = {name: np.load(os.path.join(path, '{}.npy'.format(name)),
+                             mmap_mode='r')
+               for name in SCHEDULE_COLUMNS
+               if os.path.isfile(os.path.join(path, '{}.npy'.format(name)))}
+    table = ScheduleTable(columns, **metadata)
+
+    for name in ['patch', 'elevation', 'date']:
+        fn = os.path.join(path, '{}.order.npy'.format(name))
+        if os.path.isfile(fn):
+            table.orders[name] = np.load(fn, mmap_mode='r')
+    return table
+
 def convolve_focalplane(bore_nhits, nbolos,
-                        fp_radius_amin, boost, language='C'):
+                        fp_radius_amin, boost, language='C', method='pixel'):
     """
     Given a nHits and bore_cos and bore_sin map,
     perform the focal plane convolution.
     Original author: Neil Goeckner-Wald.
     Modifications by Julien Peloton.
 
+    The focal plane is a disc of detectors, and each boresight hit
+    gives hits to all the pixels seen by the focal plane.
+    Two methods are available:
+        * pixel: the focal plane is described by a set of offsets on a
+            grid (twice finer than the pixels). All hit pixels are shifted
+            at once for each offset, and hits are accumulated with
+            np.bincount. The cost scales as the number of hit pixels
+            times the number of offsets (i.e. (fp_radius / resolution)**2).
+        * harmonic: the map is convolved with a top-hat disc of radius
+            fp_radius_amin in harmonic space (see disc_window). The cost
+            depends only on nside, and this is the method to use at high
+            resolution. The convolution rings at the edges of the
+            survey (including small negative values).
+    Both methods conserve the total number of hits
+    (nbolos * boost per boresight hit), up to the accuracy of the
+    spherical harmonic transform for the harmonic one.
+
     Parameters
     ----------
     bore_nhits : 1D array
         number of hits for the reference detector.
-    bore_cos : 1D array
-        cumulative cos**2 for the reference detector.
-    bore_sin : 1D array
-        cumulative sin**2 for the reference detector.
-    bore_cs : 1D array
-        cumulative cos*sin for the reference detector.
     nbolos : int
         total number of bolometers desired.
     fp_radius_amin : float
@@ -545,21 +2121,46 @@ def convolve_focalplane(bore_nhits, nbolos,
         boost factor to artificially increase the number of hits.
         It doesn't change the shape of the survey (just the amplitude).
     language : string, optional
-        Language to use to perform core computation: C or fortran.
-        Default is C (compiled on-the-fly via weave). To use fortran,
-        you need to compile the source (see the Makefile provided).
+        Not used anymore (the computation is done with numpy and healpy
+        for all languages). Kept for backward compatibility.
+    method : string, optional
+        pixel (default) or harmonic. See above.
 
     Returns
     ----------
     focalplane_nhits : 1D array
         Number of hits for the all the detectors.
 
+    Examples
+    ----------
+    >>> nside = 64
+    >>> bore_nhits = np.zeros(12 * nside**2)
+    >>> bore_nhits[hp.ang2pix(nside, np.pi / 2., 0.)] = 10.
+    >>> fp_nhits = convolve_focalplane(bore_nhits, 100, 300., 1.)
+    >>> print(round(np.sum(fp_nhits), 6), np.sum(fp_nhits > 0))
+    1000.0 103
+    >>> fp_nhits = convolve_focalplane(bore_nhits, 100, 300., 1.,
+    ...     method='harmonic')
+    >>> print(abs(np.sum(fp_nhits) - 1000.) < 1.)
+    True
     """
+    assert method in ['pixel', 'harmonic'], \
+        ValueError("method must be pixel or harmonic.")
+
+    # Resolution of our healpix map
+    nside = hp.npix2nside(bore_nhits.shape[0])
+
+    if method == 'harmonic':
+        ## Top-hat disc, normalised to conserve the number of hits
+        window = disc_window(fp_radius_amin / 60. / radToDeg, 3 * nside - 1)
+        focalplane_nhits = hp.smoothing(
+            np.asarray(bore_nhits, dtype=float), beam_window=window,
+            verbose=False)
+        return focalplane_nhits * nbolos * boost
+
     # Now we want to make the focalplane maps
     focalplane_nhits = np.zeros(bore_nhits.shape)
 
-    # Resolution of our healpix map
-    nside = hp.npix2nside(focalplane_nhits.shape[0])
     resol_amin = hp.nside2resol(nside, arcmin=True)
     fp_rad_bins = int(fp_radius_amin * 2. / resol_amin)
     fp_diam_bins = (fp_rad_bins * 2) + 1
@@ -581,49 +2182,273 @@ def convolve_focalplane(bore_nhits, nbolos,
         (y_fp[fp_map].astype(float) * fp_radius_amin) / (
             fp_rad_bins * 60. * (180. / (np.pi))))
 
-    pixels_global = np.array(np.where(bore_nhits != 0)[0], dtype=int)
-    for n in pixels_global:
-        n = int(n)
+    ## Boresight pixels
+    pixels_global = np.where(bore_nhits != 0)[0]
+    (theta_bore, phi_bore) = hp.pix2ang(nside, pixels_global)
+    weights = bore_nhits[pixels_global] * bolo_per_pix * boost
 
+    ## Offsets are processed by blocks of ~4 millions of pixels
+    nblock = max(2**22 // max(len(pixels_global), 1), 1)
+    for start in range(0, len(dRA), nblock):
         # Compute pointing offsets
-        (theta_bore, phi_bore) = hp.pix2ang(nside, n)
-        phi = phi_bore + dRA * np.sin(theta_bore)
-        theta = theta_bore + dDec
-
-        pixels = hp.ang2pix(nside, theta, phi)
-        npix_loc = len(pixels)
-
-        ## Necessary because the values in pixels aren't necessarily unique
-        ## This is a poor design choice and should probably be fixed
-
-        ## language = C or language = fortran are not yet supported
-        ## because they are not returning RA and Dec. So for the moment
-        ## only language == python is considered.
-        ## TODO Compute RA and Dec in C and Fortran.
-        if language in ['python', 'C']:
-            c_code = r"""
-            int i, pix;
-            for (i=0;i<npix_loc;i++)
-            {
-                pix = pixels[i];
-                focalplane_nhits[pix] += bore_nhits[n] * \
-                bolo_per_pix * boost;
-            }
-            """
-
-            weave.inline(c_code, [
-                'bore_nhits',
-                'focalplane_nhits',
-                'pixels', 'bolo_per_pix',
-                'npix_loc', 'n', 'boost'], verbose=0)
+        phi = phi_bore[None, :] + \
+            dRA[start: start + nblock, None] * np.sin(theta_bore)[None, :]
+        theta = theta_bore[None, :] + dDec[start: start + nblock, None]
 
-        elif language == 'fortran':
-            scanning_strategy_f.convolve_focalplane_f(
-                bore_nhits, focalplane_nhits, pixels,
-                bolo_per_pix, boost, npix_loc)
+        ## The values in pixels aren't necessarily unique
+        pixels = hp.ang2pix(nside, theta.flatten(), phi.flatten())
+        focalplane_nhits += np.bincount(
+            pixels, weights=np.tile(weights, len(theta)),
+            minlength=len(focalplane_nhits))
 
     return focalplane_nhits
 
+def disc_window(radius, lmax):
+    """
+    Harmonic window function of a top-hat disc:
+    b_l = (P_{l-1}(cos r) - P_{l+1}(cos r)) / ((2l + 1) (1 - cos r)),
+    with b_0 = 1 (i.e. the convolution conserves the integral).
+
+    Parameters
+    ----------
+    radius : float
+        Radius of the disc in radian.
+    lmax : int
+        Maximum multipole.
+
+    Returns
+    ----------
+    window : 1d array
+        b_l for l = 0 to lmax.
+
+    Examples
+    ----------
+    >>> window = disc_window(np.pi / 180., 1000)
+    >>> print(window[0], round(window[100], 4), round(window[1000], 4))
+    1.0 0.6617 -0.0183
+    """
+    x = np.cos(radius)
+
+    ## Legendre polynomials up to lmax + 1
+    pl = np.zeros(lmax + 2)
+    pl[0] = 1.
+    if lmax > 0:
+        pl[1] = x
+    for ell in range(1, lmax + 1):
+        pl[ell + 1] = ((2 * ell + 1) * x * pl[ell] -
+                       ell * pl[ell - 1]) / (ell + 1)
+
+    ell = np.arange(1, lmax + 1)
+    window = np.ones(lmax + 1)
+    window[1:] = (pl[ell - 1] - pl[ell + 1]) / ((2 * ell + 1) * (1 - x))
+
+    return window
+
+def azimuth_sweep(num_pts, running_az, upper_az, lower_az,
+                  az_speed, az_dir, sampling_freq):
+    """
+    Azimuth of the telescope going back and forth between
+    lower_az and upper_az at constant speed. This is the loop of
+    run_one_scan_f written with whole arrays: the sweep is built one
+    leg (i.e. one direction) at a time using cumulative sums, so that
+    the values are exactly the ones of the sample-by-sample loop.
+
+    Parameters
+    ----------
+    num_pts : int
+        Number of samples.
+    running_az : float
+        Azimuth of the first sample (degree).
+    upper_az : float
+        Upper bound of the sweep (degree). The direction changes
+        once the azimuth is above it.
+    lower_az : float
+        Lower bound of the sweep (degree). The direction changes
+        once the azimuth is below it.
+    az_speed : float
+        Azimuth speed (degree/s).
+    az_dir : float
+        Initial direction of the sweep (1. or -1.).
+    sampling_freq : float
+        Sampling frequency (Hz).
+
+    Returns
+    ----------
+    az : 1d array
+        Azimuth of the samples (degree).
+    running_az : float
+        Azimuth of the next sample.
+    az_dir : float
+        Direction of the sweep for the next sample.
+
+    Examples
+    ----------
+    >>> az, running_az, az_dir = azimuth_sweep(6, 0., 2., 0., 1., 1., 1.)
+    >>> print(az, running_az, az_dir)
+    [ 0.  1.  2.  3.  2.  1.] 0.0 -1.0
+
+    Starting outside the bounds
+    >>> az, running_az, az_dir = azimuth_sweep(6, 4., 2., 0., 1., 1., 1.)
+    >>> print(az)
+    [ 4.  3.  2.  1.  0. -1.]
+    """
+    az = np.zeros(num_pts)
+    if az_speed == 0:
+        leg = num_pts
+    else:
+        leg = int(np.ceil(
+            abs(upper_az - lower_az) * sampling_freq / az_speed)) + 2
+
+    t = 0
+    while t < num_pts:
+        steps = np.ones(min(leg, num_pts - t)) * (
+            az_speed * az_dir / sampling_freq)
+        steps[0] = running_az
+        values = np.cumsum(steps)
+
+        ## Case to change the direction of the scan
+        if az_dir > 0:
+            turn = values > upper_az
+        else:
+            turn = values < lower_az
+
+        if np.any(turn):
+            nleg = np.argmax(turn) + 1
+            az_dir = -az_dir
+        else:
+            nleg = len(values)
+
+        az[t: t + nleg] = values[:nleg]
+        running_az = values[nleg - 1] + az_speed * az_dir / sampling_freq
+        t += nleg
+
+    return az, running_az, az_dir
+
+def radec_of_scan(location, dates, az, el, az_knot=0.5, time_knot=600.):
+    """
+    Boresight RA/Dec of a constant elevation scan, as returned by
+    `location.radec_of` for each sample. Calling ephem for each sample
+    is slow, so ephem is only evaluated on a grid of azimuths
+    (spacing az_knot) and dates (spacing time_knot). RA minus the local
+    sidereal time and Dec are smooth functions of the azimuth
+    (cubic interpolation) and almost constant in time
+    (linear interpolation). The error is below 0.1 arcsec for the
+    default grid.
+
+    Parameters
+    ----------
+    location : ephem.Observer
+        The site of observation. Its date is left unchanged.
+    dates : 1d array
+        Dates of the samples in ephem format.
+    az : 1d array
+        Azimuth of the samples (radian).
+    el : float
+        Elevation of the scan (radian).
+    az_knot : float, optional
+        Spacing of the azimuth grid in degree.
+    time_knot : float, optional
+        Spacing of the time grid in second.
+
+    Returns
+    ----------
+    ra : 1d array
+        Right ascension of the samples (radian).
+    dec : 1d array
+        Declination of the samples (radian).
+
+    Examples
+    ----------
+    >>> scan = ScanningStrategy()
+    >>> location = scan.telescope_location
+    >>> dates = float(location.date) + np.arange(1000) / 86400.
+    >>> az = np.linspace(2.5, 3.5, 1000)
+    >>> ra, dec = radec_of_scan(location, dates, az, 0.8)
+
+    Compare with ephem
+    >>> location.date = dates[500]
+    >>> ra0, dec0 = location.radec_of(az[500], 0.8)
+    >>> err = np.hypot((ra[500] - ra0) * np.cos(dec0), dec[500] - dec0)
+    >>> assert err * radToDeg * 3600 < 0.1
+    """
+    date_orig = location.date
+
+    ## Grid with one more knot on each side for the cubic interpolation
+    daz = az_knot / radToDeg
+    naz = int(np.ceil((np.max(az) - np.min(az)) / daz)) + 4
+    az_knots = np.min(az) + daz * np.arange(-1, naz - 1)
+
+    dt = time_knot * ephem.second
+    nt = int(np.ceil((np.max(dates) - np.min(dates)) / dt)) + 2
+    t_knots = np.min(dates) + dt * np.arange(nt)
+
+    lst = np.zeros(nt)
+    ra_lst = np.zeros((nt, naz))
+    dec_knots = np.zeros((nt, naz))
+    for j, date in enumerate(t_knots):
+        location.date = date
+        lst[j] = location.sidereal_time()
+        for i, az_i in enumerate(az_knots):
+            ra_i, dec_knots[j, i] = location.radec_of(az_i, el)
+            ra_lst[j, i] = ra_i - lst[j]
+    location.date = date_orig
+
+    ## Avoid jumps of 2pi in the grid
+    ra_lst = (ra_lst - ra_lst[0, 0] + np.pi) % (2 * np.pi) - \
+        np.pi + ra_lst[0, 0]
+    lst = np.unwrap(lst)
+
+    ## Linear interpolation in time
+    x = (dates - t_knots[0]) / dt
+    j = np.clip(np.floor(x).astype(int), 0, nt - 2)
+    w = x - j
+
+    ## Cubic (Catmull-Rom) interpolation in azimuth
+    y = (az - az_knots[0]) / daz
+    i = np.clip(np.floor(y).astype(int), 1, naz - 3)
+    s = y - i
+    coeffs = [
+        (-s**3 + 2 * s**2 - s) / 2.,
+        (3 * s**3 - 5 * s**2 + 2) / 2.,
+        (-3 * s**3 + 4 * s**2 + s) / 2.,
+        (s**3 - s**2) / 2.]
+
+    def interpolate(grid):
+        out = np.zeros_like(s)
+        for k, c in enumerate(coeffs):
+            out += c * ((1 - w) * grid[j, i - 1 + k] +
+                        w * grid[j + 1, i - 1 + k])
+        return out
+
+    ra = (interpolate(ra_lst) + (1 - w) * lst[j] + w * lst[j + 1]) % \
+        (2 * np.pi)
+    dec = interpolate(dec_knots)
+
+    return ra, dec
+
+def _run_one_scan_worker(args):
+    """
+    Generate one CES in a separate process (see ScanningStrategy.run).
+    ephem objects cannot be pickled, so the scanning strategy is
+    instantiated again from its parameters.
+
+    Parameters
+    ----------
+    args : tuple
+        (parameters of ScanningStrategy, scan_number, start_date, silent).
+
+    Returns
+    ----------
+    scan_file : dictionary
+        The outputs of the scan.
+    """
+    kwargs, scan_number, start_date, silent = args
+    scan = ScanningStrategy(**kwargs)
+    scan_file = {}
+    scan.run_one_scan(scan_file, scan_number, silent=silent,
+                      start_date=start_date)
+    return scan_file
+
 ## Here are a bunch of routines to handle dates...
 
 def date_to_mjd(date):
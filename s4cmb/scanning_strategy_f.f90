@@ -34,36 +34,6 @@ contains
 
     end subroutine
 
-    subroutine convolve_focalplane_f(bore_nhits, focalplane_nhits,&
-    pixels, bolo_per_pix, npix_loc, boost)
-        implicit none
-        ! Given a number of hits map perform the focal plane convolution.
-        ! Original author (python routine): Neil Goeckner-Wald.
-        ! Modifications by Julien Peloton (including fortran interface).
-
-        integer, parameter       :: I4B = 4
-        integer, parameter       :: DP = 8
-        real(DP), parameter      :: pi = 3.141592
-
-        ! F2PY params
-        integer(I4B), intent(in) :: npix_loc
-        integer(I4B), intent(in) :: pixels(0: npix_loc - 1)
-        real(DP), intent(in)     :: bore_nhits
-        real(DP), intent(in)     :: bolo_per_pix, boost
-        real(DP), intent(inout)  :: focalplane_nhits(0: npix_loc - 1)
-
-        ! LOCAL
-        integer(I4B)             :: i, pix
-
-        ! Loop
-        do i=0, npix_loc - 1
-            pix = pixels(i)
-            focalplane_nhits(pix) = focalplane_nhits(pix) + &
-            bore_nhits * bolo_per_pix * boost
-        enddo
-
-    end subroutine
-
     subroutine run_one_scan_f(pb_az_array, pb_mjd_array, running_az, &
         upper_az, lower_az, az_speed, pb_az_dir, second, sampling_freq, num_pts)
         implicit none
@@ -0,0 +1,423 @@
+#!/usr/bin/python
+"""
+Module to search for scanning strategies: coverage metrics (fsky,
+uniformity of hits, and cross-linking of polarisation angles) are
+forecasted for candidate lists of CES using only the boresight pointing
+(see ScanningStrategy.describe_scan) and the focal plane convolution
+(see convolve_focalplane), without simulating TOD.
+
+A candidate is a list of CES, each described by the same quantities
+as in ScanningStrategy.define_boundary_of_scan:
+(elevation, az_min, az_max, begin_LST, end_LST).
+
+Author: Julien Peloton, j.peloton@sussex.ac.uk
+"""
+from __future__ import division, absolute_import, print_function
+
+import os
+import hashlib
+import tempfile
+import multiprocessing
+import cPickle as pickle
+
+import numpy as np
+import healpy as hp
+
+from s4cmb.scanning_strategy import ScanningStrategy
+from s4cmb.scanning_strategy import convolve_focalplane
+
+## Metrics already computed, keyed by candidate key (shared by all
+## ScheduleSearch instances of the process).
+_METRICS = {}
+
+class ScheduleSearch():
+    """ Class to evaluate coverage metrics of candidate scanning strategies """
+    def __init__(self, nside=128, nbolos=6000, fp_radius_amin=60.,
+                 method='pixel', threshold=0., cache_dir=None, nproc=1,
+                 start_date='2013/1/1 00:00:00',
+                 telescope_longitude='-67:46.816',
+                 telescope_latitude='-22:56.396', telescope_elevation=5200.,
+                 sampling_freq=1., sky_speed=0.4):
+        """
+        Parameters
+        ----------
+        nside : int, optional
+            Resolution of the hit maps.
+        nbolos : int, optional
+            Number of bolometers in the focal plane.
+        fp_radius_amin : float, optional
+            Radius of the focal plane on the sky in arcmin.
+        method : string, optional
+            Method for the focal plane convolution: pixel (default) or
+            harmonic (faster at high resolution, when the focal plane
+            covers many pixels). See convolve_focalplane.
+        threshold : float, optional
+            A pixel is observed if its number of hits is above
+            threshold times the maximum number of hits. Default is 0.
+            Use e.g. 1e-3 with the harmonic method, to discard the ringing
+            of the convolution.
+        cache_dir : string, optional
+            Folder where metrics are stored, and loaded from instead of
+            being computed again. Default is None (metrics are only
+            kept in memory).
+        nproc : int, optional
+            Number of processes used to evaluate candidates.
+        start_date : string, optional
+            Starting date for observations. The format is: YYYY/M/D HH:MM:SS.
+        telescope_longitude : string, optional
+            Longitute (angle) of the telescope. String form: 0:00:00.0.
+        telescope_latitude : string, optional
+            Latitude (angle) of the telescope. String form: 0:00:00.0.
+        telescope_elevation : float, optional
+            Height above sea level (in meter).
+        sampling_freq : float, optional
+            Sampling frequency of the boresight pointing in Hz. The metrics
+            do not need a high sampling frequency. Default is 1 Hz.
+        sky_speed : float, optional
+            Azimuth speed of the telescope in deg/s.
+        """
+        self.nside = nside
+        self.nbolos = nbolos
+        self.fp_radius_amin = fp_radius_amin
+        self.method = method
+        self.threshold = threshold
+        self.cache_dir = cache_dir
+        self.nproc = nproc
+
+        ## Parameters of the ScanningStrategy for all candidates
+        self.scan_kwargs = {
+            'start_date': start_date,
+            'telescope_longitude': telescope_longitude,
+            'telescope_latitude': telescope_latitude,
+            'telescope_elevation': telescope_elevation,
+            'sampling_freq': sampling_freq,
+            'sky_speed': sky_speed}
+
+    def settings(self):
+        """
+        Parameters of the instance (to instantiate it again in
+        other processes).
+
+        Returns
+        ----------
+        settings : dictionary
+        """
+        settings = dict(self.scan_kwargs)
+        settings.update({
+            'nside': self.nside, 'nbolos': self.nbolos,
+            'fp_radius_amin': self.fp_radius_amin, 'method': self.method,
+            'threshold': self.threshold, 'cache_dir': self.cache_dir,
+            'nproc': 1})
+        return settings
+
+    def candidate_key(self, candidate):
+        """
+        Hash of a candidate and of all the parameters used to evaluate it.
+
+        Parameters
+        ----------
+        candidate : list of tuple
+            List of CES (elevation, az_min, az_max, begin_LST, end_LST).
+
+        Returns
+        ----------
+        key : string
+            Hexadecimal digest identifying the evaluation.
+
+        Examples
+        ----------
+        >>> search = ScheduleSearch()
+        >>> candidate = [
+        ...     (30., 134.2263, 154.2263, '17:07:54.84', '22:00:21.76')]
+        >>> key1 = search.candidate_key(candidate)
+        >>> key1 == ScheduleSearch(nside=64).candidate_key(candidate)
+        False
+        """
+        settings = self.settings()
+        settings.pop('cache_dir')
+        settings.pop('nproc')
+        candidate = [(float(el), float(az_min), float(az_max),
+                      str(begin_LST), str(end_LST))
+                     for el, az_min, az_max, begin_LST, end_LST in candidate]
+
+        h = hashlib.sha1()
+        h.update(repr((sorted(settings.items()), candidate)).encode())
+        return h.hexdigest()
+
+    def get_scanning_strategy(self, candidate):
+        """
+        Scanning strategy observing the CES of a candidate.
+
+        Parameters
+        ----------
+        candidate : list of tuple
+            List of CES (elevation, az_min, az_max, begin_LST, end_LST).
+
+        Returns
+        ----------
+        scan : ScanningStrategy instance
+        """
+        scan = ScanningStrategy(nces=len(candidate), **self.scan_kwargs)
+        scan.elevation, scan.az_min, scan.az_max, \
+            scan.begin_LST, scan.end_LST = [
+                list(values) for values in zip(*candidate)]
+        return scan
+
+    def boresight_maps(self, candidate):
+        """
+        Number of hits, and sum of cos(2 psi) and sin(2 psi) (psi is the
+        parallactic angle) per pixel for the boresight of a candidate.
+
+        Parameters
+        ----------
+        candidate : list of tuple
+            List of CES (elevation, az_min, az_max, begin_LST, end_LST).
+
+        Returns
+        ----------
+        nhit : 1d array
+            Number of hits per pixel.
+        cos2 : 1d array
+            Sum of cos(2 psi) per pixel.
+        sin2 : 1d array
+            Sum of sin(2 psi) per pixel.
+        """
+        npix = hp.nside2npix(self.nside)
+        nhit = np.zeros(npix)
+        cos2 = np.zeros(npix)
+        sin2 = np.zeros(npix)
+
+        scan = self.get_scanning_strategy(candidate)
+        lat = float(scan.telescope_location.lat)
+        for scan_number in range(scan.nces):
+            ces = scan.describe_scan(scan_number)
+            ra, dec = ces.radec()
+            psi = parallactic_angle(ces.azimuth(), ces.el * np.pi / 180., lat)
+
+            pix = hp.ang2pix(self.nside, np.pi / 2. - dec, ra)
+            nhit += np.bincount(pix, minlength=npix)
+            cos2 += np.bincount(pix, weights=np.cos(2 * psi), minlength=npix)
+            sin2 += np.bincount(pix, weights=np.sin(2 * psi), minlength=npix)
+
+        return nhit, cos2, sin2
+
+    def evaluate(self, candidate):
+        """
+        Coverage metrics of a candidate (see coverage_metrics).
+        Results are cached in memory, and in cache_dir if set.
+
+        Parameters
+        ----------
+        candidate : list of tuple
+            List of CES (elevation, az_min, az_max, begin_LST, end_LST).
+
+        Returns
+        ----------
+        metrics : dictionary
+            fsky, uniformity and crosslinking.
+
+        Examples
+        ----------
+        >>> search = ScheduleSearch(nside=64, sampling_freq=0.2)
+        >>> candidate = [
+        ...     (30., 134.2263, 154.2263, '17:07:54.84', '22:00:21.76')]
+        >>> metrics = search.evaluate(candidate)
+        >>> print(sorted(metrics.keys()))
+        ['crosslinking', 'fsky', 'uniformity']
+        >>> print(round(metrics['fsky'], 4), round(metrics['crosslinking'], 4))
+        0.0258 0.9999
+
+        Second call is free
+        >>> search.evaluate(candidate) is metrics
+        True
+        """
+        key = self.candidate_key(candidate)
+        if key in _METRICS:
+            return _METRICS[key]
+
+        fn = None
+        if self.cache_dir is not None:
+            fn = os.path.join(self.cache_dir, '{}.pkl'.format(key))
+            if os.path.isfile(fn):
+                with open(fn, 'rb') as f:
+                    _METRICS[key] = pickle.load(f)
+                return _METRICS[key]
+
+        ## Boresight maps convolved by the focal plane
+        maps = [convolve_focalplane(
+            m, self.nbolos, self.fp_radius_amin, 1., method=self.method)
+            for m in self.boresight_maps(candidate)]
+        metrics = coverage_metrics(*maps, threshold=self.threshold)
+
+        if fn is not None:
+            save_metrics(fn, metrics)
+        _METRICS[key] = metrics
+
+        return metrics
+
+    def evaluate_many(self, candidates):
+        """
+        Coverage metrics of several candidates. Candidates not yet
+        evaluated are distributed over nproc processes.
+
+        Parameters
+        ----------
+        candidates : list of list of tuple
+            List of candidates.
+
+        Returns
+        ----------
+        metrics : list of dictionary
+            Metrics of each candidate (see evaluate).
+
+        Examples
+        ----------
+        >>> search = ScheduleSearch(nside=64, sampling_freq=0.2, nproc=2)
+        >>> ces = [(30., 134.2263, 154.2263, '17:07:54.84', '22:00:21.76'),
+        ...     (45.5226, 162.3532, 197.3532, '22:00:21.76', '02:01:01.19')]
+        >>> metrics = search.evaluate_many([ces[:1], ces])
+        >>> print(metrics[1]['fsky'] > metrics[0]['fsky'])
+        True
+        >>> print(metrics[1]['crosslinking'] < metrics[0]['crosslinking'])
+        True
+        """
+        keys = [self.candidate_key(candidate) for candidate in candidates]
+        todo = [candidate for key, candidate in zip(keys, candidates)
+                if key not in _METRICS]
+
+        if self.nproc > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(self.nproc)
+            results = pool.map(
+                _evaluate_worker,
+                [(self.settings(), candidate) for candidate in todo])
+            pool.close()
+            pool.join()
+            for candidate, metrics in zip(todo, results):
+                _METRICS[self.candidate_key(candidate)] = metrics
+
+        return [self.evaluate(candidate) for candidate in candidates]
+
+def parallactic_angle(az, el, lat):
+    """
+    Parallactic angle of the boresight (same convention as
+    slalib sla_pa).
+
+    Parameters
+    ----------
+    az : 1d array
+        Azimuth (radian).
+    el : float or 1d array
+        Elevation (radian).
+    lat : float
+        Latitude of the telescope (radian).
+
+    Returns
+    ----------
+    psi : 1d array
+        Parallactic angle (radian).
+
+    Examples
+    ----------
+    >>> psi = parallactic_angle(np.array([0.3, 2.5]), 0.7, -0.4)
+    >>> print(np.round(psi, 4).tolist())
+    [-2.8366, -1.2592]
+    """
+    return np.arctan2(
+        -np.sin(az) * np.cos(lat),
+        np.cos(el) * np.sin(lat) - np.sin(el) * np.cos(lat) * np.cos(az))
+
+def coverage_metrics(nhit, cos2, sin2, threshold=0.):
+    """
+    Coverage metrics from the hit maps of the focal plane.
+
+    Parameters
+    ----------
+    nhit : 1d array
+        Number of hits per pixel.
+    cos2 : 1d array
+        Sum of cos(2 psi) per pixel.
+    sin2 : 1d array
+        Sum of sin(2 psi) per pixel.
+    threshold : float, optional
+        A pixel is observed if its number of hits is above
+        threshold times the maximum number of hits. Default is 0.
+
+    Returns
+    ----------
+    metrics : dictionary
+        * fsky: fraction of the sky observed.
+        * uniformity: (sum n)**2 / (npix_obs * sum n**2), where n is the
+            number of hits in observed pixels. 1 for uniform coverage.
+        * crosslinking: hit-weighted mean of |<exp(2i psi)>| over observed
+            pixels. 0 for perfect cross-linking, and 1 if the pixels are
+            seen with one angle only.
+
+    Examples
+    ----------
+    >>> nhit = np.array([0., 2., 2., 4.])
+    >>> cos2 = np.array([0., 2., 0., 0.])
+    >>> sin2 = np.array([0., 0., 0., 4.])
+    >>> metrics = coverage_metrics(nhit, cos2, sin2)
+    >>> print(metrics['fsky'], round(metrics['uniformity'], 6),
+    ...     metrics['crosslinking'])
+    0.75 0.888889 0.75
+    """
+    observed = nhit > threshold * np.max(nhit)
+    n = nhit[observed]
+
+    fsky = np.sum(observed) / len(nhit)
+    uniformity = np.sum(n)**2 / (len(n) * np.sum(n**2))
+    h2 = np.hypot(cos2[observed], sin2[observed]) / n
+    crosslinking = np.sum(n * h2) / np.sum(n)
+
+    return {'fsky': fsky, 'uniformity': uniformity,
+            'crosslinking': crosslinking}
+
+def save_metrics(fn, metrics):
+    """
+    Store metrics in a pickle file. The file is first written
+    in a temporary file which is then renamed, so that concurrent
+    processes never see partial files.
+
+    Parameters
+    ----------
+    fn : string
+        Name of the file.
+    metrics : dictionary
+        Metrics of a candidate.
+    """
+    folder = os.path.dirname(fn)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            ## Someone else created it in the meantime
+            pass
+
+    fd, tmp = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(metrics, f, protocol=2)
+    os.rename(tmp, fn)
+
+def _evaluate_worker(args):
+    """
+    Evaluate one candidate in a separate process
+    (see ScheduleSearch.evaluate_many).
+
+    Parameters
+    ----------
+    args : tuple
+        (parameters of ScheduleSearch, candidate).
+
+    Returns
+    ----------
+    metrics : dictionary
+        Metrics of the candidate.
+    """
+    settings, candidate = args
+    return ScheduleSearch(**settings).evaluate(candidate)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
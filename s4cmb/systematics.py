@@ -8,7 +8,12 @@ from __future__ import division, absolute_import, print_function
 
 import numpy as np
 
-from s4cmb.systematics_f import systematics_f
+from s4cmb.backends import LazyModule
+from s4cmb.backends import resolve_language
+
+## Backends are imported on first use (see backends.py)
+systematics_f = LazyModule('systematics_f')
+numba_kernels = LazyModule('numba_kernels')
 
 arcsecond2rad = np.pi / 180. / 3600.
 arcmin2rad = np.pi / 180. / 60.
@@ -60,8 +65,9 @@ def inject_crosstalk_inside_SQUID(bolo_data, squid_ids, bolo_ids,
         If not None, return a new array of timestreams with the modifications.
         Modify bolo_data directly otherwise. Default is None.
     language : string, optional
-        Language to perform computations to be chosen in ['python', 'fortran'].
-        Default is python. [fortran is very slow...]
+        Language to perform computations to be chosen in
+        ['python', 'fortran', 'numba']. Default is python.
+        [fortran is very slow...]
 
     Example
     ----------
@@ -109,6 +115,7 @@ def inject_crosstalk_inside_SQUID(bolo_data, squid_ids, bolo_ids,
     state = np.random.RandomState(seed)
     cross_amp = state.normal(mu, sigma, len(bolo_data))
 
+    language = resolve_language('crosstalk', language)
     if language == 'python':
         for sq in combs:
             for ch, i in combs[sq]:
@@ -129,6 +136,15 @@ def inject_crosstalk_inside_SQUID(bolo_data, squid_ids, bolo_ids,
                 radius, cross_amp, beta,
                 len(local_indices), len(bolo_data), len(bolo_data[0]))
 
+    elif language == 'numba':
+        tsout = np.ascontiguousarray(tsout, dtype=np.float64)
+        for sq in combs:
+            local_indices = np.array(combs[sq]).flatten()[:: 2]
+            global_indices = np.array(combs[sq]).flatten()[1:: 2]
+            numba_kernels.inject_crosstalk_inside_squid_numba(
+                tsout, local_indices, global_indices,
+                radius, cross_amp, beta)
+
     if new_array is not None:
         new_array[:] = tsout
     else:
@@ -315,15 +331,31 @@ def modify_pointing_parameters(values, errors):
     ----------
     values : 1d array
         Array containing values of the pointing parameters in degree.
-    errors : 1d array
+    errors : 1d or 2d array
         Array containing values of the pointing parameter errors in degree.
+        Either one set of size nparams, or K sets of errors in an array of
+        size (K, nparams).
 
     Returns
     ----------
-    values_mod : 1d array
-        Array containing modified values of the pointing parameters in degree.
+    values_mod : list or 2d array
+        List containing modified values of the pointing parameters in degree.
+        If errors is 2d, array of size (K, nparams) whose K sets can be
+        fed at once to Pointing.apply_pointing_model.
 
+    Examples
+    ----------
+    >>> values = np.array([1., 2.])
+    >>> values_mod = modify_pointing_parameters(values, np.array([0.1, 0.2]))
+    >>> print(type(values_mod).__name__, np.array(values_mod))
+    list [ 1.1  2.2]
+    >>> errors = np.array([[0.1, 0.2], [0.3, 0.4], [0.5, 0.6]])
+    >>> print(modify_pointing_parameters(values, errors).shape)
+    (3, 2)
     """
+    if np.ndim(errors) == 2:
+        return np.asarray(values) + np.asarray(errors)
+
     values_mod = [p + err for p, err in zip(values, errors)]
     return values_mod
 
@@ -18,10 +18,16 @@ from numpy.fft import fft, fftfreq, fftshift
 
 from s4cmb.detector_pointing import Pointing
 from s4cmb.detector_pointing import radec2thetaphi
+from s4cmb.detector_pointing import quat_angular_distance
 from s4cmb import input_sky
-from s4cmb.tod_f import tod_f
+from s4cmb.backends import LazyModule
+from s4cmb.backends import resolve_language
 from s4cmb.xpure import qu_weight_mineig
 
+## Backends are imported on first use (see backends.py)
+tod_f = LazyModule('tod_f')
+numba_kernels = LazyModule('numba_kernels')
+
 d2r = np.pi / 180.0
 am2rad = np.pi / 180. / 60.
 
@@ -31,7 +37,8 @@ class TimeOrderedDataPairDiff():
                  CESnumber, projection='healpix',
                  nside_out=None, pixel_size=None, width=20.,
                  array_noise_level=None, array_noise_seed=487587,
-                 mapping_perpair=False):
+                 mapping_perpair=False, pointing_cache_dir=None,
+                 streaming=False, pointing_language='python'):
         """
         C'est parti!
 
@@ -74,12 +81,30 @@ class TimeOrderedDataPairDiff():
             If True, assume that you want to process pairs of bolometers
             one-by-one, that is pairs are uncorrelated. Default is False (and
             should be False unless you know what you are doing).
+        pointing_cache_dir : string, optional
+            If not None, folder used to cache the boresight pointing on disk
+            (see Pointing). Useful when the same CES is processed several
+            times (MPI ranks, Monte Carlo realisations, reruns).
+            Default is None (no cache).
+        streaming : bool, optional
+            If True, the (npair, nsamples) arrays used by map2tod and
+            tod2map (pointing matrix, modulation factors and masks) are
+            not allocated: the scan is meant to be processed by chunks
+            with map2tod2map. Default is False.
+        pointing_language : string, optional
+            Language used to go from az/el to RA/Dec/PA for the boresight
+            (see Pointing): python (slalib called sample-by-sample, the
+            reference), or fortran/numba/C for the batched astrometry.
+            Default is python.
         """
         ## Initialise args
         self.hardware = hardware
         self.scanning_strategy = scanning_strategy
         self.HealpixFitsMap = HealpixFitsMap
         self.mapping_perpair = mapping_perpair
+        self.pointing_cache_dir = pointing_cache_dir
+        self.streaming = streaming
+        self.pointing_language = pointing_language
         self.width = width
         self.projection = projection
         assert self.projection in ['healpix', 'flat'], \
@@ -94,8 +119,7 @@ class TimeOrderedDataPairDiff():
             ))
 
         ## Initialise internal parameters
-        self.scan = getattr(self.scanning_strategy, 'scan{}'.format(
-            self.CESnumber))
+        self.scan = self.scanning_strategy.get_scan(self.CESnumber)
         self.nsamples = self.scan['nts']
         self.npair = self.hardware.focal_plane.npair
         self.pair_list = np.reshape(
@@ -115,14 +139,19 @@ class TimeOrderedDataPairDiff():
 
         ## Initialise pointing matrix, that is the matrix to go from time
         ## to map domain, for all pairs of detectors.
-        if not self.mapping_perpair:
+        if self.streaming:
+            self.point_matrix = None
+        elif not self.mapping_perpair:
             self.point_matrix = np.zeros(
                 (self.npair, self.nsamples), dtype=np.int32)
         else:
             self.point_matrix = np.zeros((1, self.nsamples), dtype=np.int32)
 
         ## Initialise the mask for timestreams
-        self.wafermask_pixel = self.get_timestream_masks()
+        if self.streaming:
+            self.wafermask_pixel = None
+        else:
+            self.wafermask_pixel = self.get_timestream_masks()
 
         ## Get observed pixels in the input map
         if nside_out is None:
@@ -160,7 +189,7 @@ class TimeOrderedDataPairDiff():
     def get_angles(self):
         """
         Retrieve polarisation angles: intrinsic (focal plane) and HWP angles,
-        and initialise total polarisation angle.
+        and initialise the factors of the polarisation modulation.
         """
         self.hwpangle = self.hardware.half_wave_plate.compute_HWP_angles(
             sample_rate=self.scan['sample_rate'],
@@ -168,23 +197,54 @@ class TimeOrderedDataPairDiff():
 
         self.intrinsic_polangle = self.hardware.focal_plane.bolo_polangle
 
-        ## Will contain the total polarisation angles for all bolometers
-        ## That is PA + intrinsic + 2 * HWP
-        if not self.mapping_perpair:
-            self.pol_angs = np.zeros((self.npair, self.nsamples))
+        ## The modulation cos/sin(2 * (PA + intrinsic + 2 * HWP)) is built
+        ## with angle addition from cos/sin of 4 * HWP (once per CES),
+        ## of 2 * intrinsic (constant per detector) and of 2 * PA.
+        self.cos4hwp = np.cos(4.0 * self.hwpangle)
+        self.sin4hwp = np.sin(4.0 * self.hwpangle)
+
+        ## Will contain cos/sin of 2 * PA for the top bolometers,
+        ## and cos/sin of 2 * intrinsic of the stored bolometers.
+        nrow = 1 if self.mapping_perpair else self.npair
+        if self.streaming:
+            self.cos2pa = self.sin2pa = None
         else:
-            self.pol_angs = np.zeros((1, self.nsamples))
-
-    def get_timestream_masks(self):
+            self.cos2pa = np.ones((nrow, self.nsamples), dtype=np.float64)
+            self.sin2pa = np.zeros((nrow, self.nsamples), dtype=np.float64)
+        ang_pix = (90.0 - np.asarray(
+            self.intrinsic_polangle, dtype=np.float64)[0:2 * nrow:2]) * d2r
+        self.cos2polangle = np.cos(2.0 * ang_pix)
+        self.sin2polangle = np.sin(2.0 * ang_pix)
+
+    def get_timestream_masks(self, start=0, stop=None, pairs=None):
         """
         Define the masks for all the timestreams.
         1 if the time sample should be included, 0 otherwise.
         Set to ones for the moment.
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first sample. Default is 0.
+        stop : int, optional
+            Index of the last sample (excluded). Default is nsamples.
+        pairs : 1d array of int, optional
+            Indices of the pairs. Default is all pairs (or the current
+            pair if mapping_perpair).
+
+        Returns
+        ----------
+        masks : ndarray
+            Array of size (npair, stop - start).
         """
-        if not self.mapping_perpair:
-            return np.ones((self.npair, self.nsamples), dtype=int)
+        if stop is None:
+            stop = self.nsamples
+        if pairs is not None:
+            return np.ones((len(pairs), stop - start), dtype=int)
+        elif not self.mapping_perpair:
+            return np.ones((self.npair, stop - start), dtype=int)
         else:
-            return np.ones((1, self.nsamples), dtype=int)
+            return np.ones((1, stop - start), dtype=int)
 
     def get_obspix(self, width, ra_src, dec_src):
         """
@@ -336,10 +396,48 @@ class TimeOrderedDataPairDiff():
         rotate the input map while for flat we true center of the patch.
         This is to avoid projection artifact by operating a rotation
         of the coordinates to (0, 0) in flat projection (scan around equator).
+
+        The rotation of the focal plane around the boresight for the CES
+        (see ScanningStrategy) only enters in the detector pointing, so
+        several angles can be simulated with the same boresight pointing.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> d = tod.map2tod(0)
+        >>> tod.pointing.boresight_angle = np.pi
+        >>> d_180 = tod.map2tod(0)
+        >>> print(np.allclose(d, d_180))
+        False
+
+        Galactic input maps are only handled in the pointing for healpix
+        projection (the flat projection is centred on the equatorial patch)
+        >>> sky_in.ext_map_gal = True
+        >>> tod_flat = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=1, projection='flat')
+        >>> print(tod_flat.pointing.coord)
+        C
+        >>> sky_in.ext_map_gal = False
+
+        The batched astrometry agrees with the reference (slalib) pointing
+        well below one arcsecond.
+        >>> tod_f = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1,
+        ...     pointing_language='fortran')
+        >>> err = quat_angular_distance(tod_f.pointing.q, tod.pointing.q)
+        >>> assert np.max(err) < 1. / 3600. * d2r
         """
         lat = float(
             self.scanning_strategy.telescope_location.lat) * 180. / np.pi
 
+        ## Galactic input maps: the boresight pointing comes out in galactic
+        ## coordinates. In flat projection, the scan is re-centred with the
+        ## equatorial (ra_mid, dec_mid), so the frame is left equatorial.
+        if self.projection == 'healpix' and self.HealpixFitsMap.ext_map_gal:
+            coord = 'G'
+        else:
+            coord = 'C'
+
         if self.projection == 'healpix':
             ra_src = 0.0
             dec_src = 0.0
@@ -348,17 +446,10 @@ class TimeOrderedDataPairDiff():
             dec_src = self.scanning_strategy.dec_mid * np.pi / 180.
 
             ## Perform a rotation of the input to put the point
-            ## (ra_src, dec_src) at (0, 0).
-            r = hp.Rotator(rot=[ra_src, self.scanning_strategy.dec_mid])
-            theta, phi = hp.pix2ang(self.HealpixFitsMap.nside,
-                                    range(12 * self.HealpixFitsMap.nside**2))
-            t, p = r(theta, phi, inv=True)
-            pix = hp.ang2pix(self.HealpixFitsMap.nside, t, p)
-
-            ## Apply the rotation to our maps
-            self.HealpixFitsMap.I = self.HealpixFitsMap.I[pix]
-            self.HealpixFitsMap.Q = self.HealpixFitsMap.Q[pix]
-            self.HealpixFitsMap.U = self.HealpixFitsMap.U[pix]
+            ## (ra_src, dec_src) at (0, 0). The rotation is cached, and
+            ## always applied to the unrotated maps.
+            self.HealpixFitsMap.rotate_maps(
+                [ra_src, self.scanning_strategy.dec_mid])
 
         self.pointing = Pointing(
             az_enc=self.scan['azimuth'],
@@ -367,7 +458,11 @@ class TimeOrderedDataPairDiff():
             value_params=self.hardware.pointing_model.value_params,
             allowed_params=self.hardware.pointing_model.allowed_params,
             ut1utc_fn=self.scanning_strategy.ut1utc_fn,
-            lat=lat, ra_src=ra_src, dec_src=dec_src)
+            lat=lat, ra_src=ra_src, dec_src=dec_src,
+            language=self.pointing_language,
+            cache_dir=self.pointing_cache_dir,
+            coord=coord,
+            boresight_angle=self.scan['boresight_angle'])
 
     def compute_simpolangle(self, ch, parallactic_angle, do_demodulation=False,
                             polangle_err=False):
@@ -417,7 +512,93 @@ class TimeOrderedDataPairDiff():
 
         return pol_ang
 
-    def map2tod(self, ch):
+    def compute_modulation(self, ch, cos2pa, sin2pa):
+        """
+        Compute cos and sin of twice the full polarisation angle (see
+        compute_simpolangle) of channel ch, without evaluating the angle.
+        The intrinsic and HWP parts are added to 2 * PA with angle
+        addition identities, using the trigonometric factors of 4 * HWP
+        computed once per CES.
+
+        Parameters
+        ----------
+        ch : int
+            Channel index in the focal plane.
+        cos2pa : 1d array
+            cos(2 * PA) for detector ch.
+        sin2pa : 1d array
+            sin(2 * PA) for detector ch.
+
+        Returns
+        ----------
+        cos2pol, sin2pol : 1d arrays
+            cos and sin of 2 * (PA + intrinsic + 2 * HWP).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> pa = np.linspace(-np.pi, np.pi, tod.nsamples)
+        >>> c, s = tod.compute_modulation(1, np.cos(2 * pa), np.sin(2 * pa))
+        >>> angles = tod.compute_simpolangle(1, pa)
+        >>> assert np.allclose(c, np.cos(2 * angles))
+        >>> assert np.allclose(s, np.sin(2 * angles))
+        """
+        ang_pix = (90.0 - self.intrinsic_polangle[ch]) * d2r
+        cos2ang = np.cos(2.0 * ang_pix)
+        sin2ang = np.sin(2.0 * ang_pix)
+
+        ## cos/sin(2 * intrinsic + 4 * HWP)
+        c = cos2ang * self.cos4hwp - sin2ang * self.sin4hwp
+        s = sin2ang * self.cos4hwp + cos2ang * self.sin4hwp
+
+        return cos2pa * c - sin2pa * s, sin2pa * c + cos2pa * s
+
+    def get_detector_pointing(self, chs):
+        """
+        Compute the pointing (RA/Dec/PA) of several channels at once.
+        The result can be passed to map2tod to avoid recomputing the
+        pointing channel by channel.
+
+        Parameters
+        ----------
+        chs : list of int
+            Channel indices in the focal plane.
+
+        Returns
+        ----------
+        ra, dec, pa : ndarray
+            Arrays of size (len(chs), nsamples).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> ra, dec, pa = tod.get_detector_pointing([0, 1])
+        >>> d = tod.map2tod(0, radecpa=(ra[0], dec[0], pa[0]))
+        >>> print(round(d[0], 3)) #doctest: +NORMALIZE_WHITESPACE
+        -42.874
+        """
+        return self.pointing.offset_detectors(
+            self.xpos[chs], self.ypos[chs])
+
+    def check_not_streaming(self):
+        """
+        map2tod and tod2map store (or read) the pointing matrix and the
+        modulation factors of the whole scan, which are not allocated
+        with streaming=True.
+
+        Raises
+        ----------
+        ValueError if the TOD is in streaming mode.
+        """
+        if self.streaming:
+            raise ValueError(
+                "The pointing matrix and modulation factors of the whole " +
+                "scan are not allocated with streaming=True. " +
+                "Use map2tod2map instead.")
+
+    def map2tod(self, ch, radecpa=None):
         """
         Scan the input sky maps to generate timestream for channel ch.
         /!\ this is currently the bottleneck in computation. Need to speed
@@ -427,6 +608,10 @@ class TimeOrderedDataPairDiff():
         ----------
         ch : int
             Channel index in the focal plane.
+        radecpa : tuple of 1d arrays, optional
+            Pre-computed (ra, dec, pa) for the channel ch
+            (see get_detector_pointing). If None, the pointing is computed
+            here.
 
         Returns
         ----------
@@ -442,11 +627,114 @@ class TimeOrderedDataPairDiff():
         >>> print(round(d[0], 3)) #doctest: +NORMALIZE_WHITESPACE
         -42.874
         """
-        ## Use bolometer beam offsets.
-        azd, eld = self.xpos[ch], self.ypos[ch]
+        if radecpa is None:
+            ## Use bolometer beam offsets.
+            azd, eld = self.xpos[ch], self.ypos[ch]
+
+            ## Compute pointing for detector ch
+            ra, dec, pa = self.pointing.offset_detector(azd, eld)
+        else:
+            ra, dec, pa = radecpa
 
-        ## Compute pointing for detector ch
-        ra, dec, pa = self.pointing.offset_detector(azd, eld)
+        return self.map2tod_shared([ch], ra, dec, pa)[0]
+
+    def map2tod_pair(self, ip, radecpa=None):
+        """
+        Scan the input sky maps to generate the timestreams of the two
+        bolometers of the pair ip. If their beam offsets coincide (that
+        is unless they have been modified, see systematics), the pointing,
+        the pixel indices and the I/Q/U values are computed once for the
+        pair. Otherwise, this is map2tod for each bolometer.
+
+        Parameters
+        ----------
+        ip : int
+            Pair index in the focal plane (channels 2 * ip and 2 * ip + 1).
+        radecpa : tuple of 1d arrays, optional
+            Pre-computed (ra, dec, pa) for the top bolometer
+            (see get_detector_pointing). Only used if the pointing is
+            shared within the pair.
+
+        Returns
+        ----------
+        ts_top, ts_bottom : 1d arrays
+            The timestreams for the top and bottom bolometers (same as
+            map2tod).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> top, bottom = tod.map2tod_pair(0)
+        >>> assert np.allclose(top, tod.map2tod(0))
+        >>> assert np.allclose(bottom, tod.map2tod(1))
+        """
+        top, bottom = 2 * ip, 2 * ip + 1
+        if not self.shared_pointing([top, bottom])[0]:
+            return self.map2tod(top), self.map2tod(bottom)
+
+        if radecpa is None:
+            ra, dec, pa = self.pointing.offset_detector(
+                self.xpos[top], self.ypos[top])
+        else:
+            ra, dec, pa = radecpa
+
+        return self.map2tod_shared([top, bottom], ra, dec, pa)
+
+    def shared_pointing(self, chs):
+        """
+        Find the channels which have the same pointing as the next
+        channel in the list, that is top bolometers followed by their
+        bottom bolometer with coincident beam offsets.
+
+        Parameters
+        ----------
+        chs : list of int
+            Channel indices in the focal plane.
+
+        Returns
+        ----------
+        shared : 1d array of bool
+            shared[i] is True if chs[i + 1] can use the pointing of chs[i].
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> print(tod.shared_pointing([0, 1, 2, 4, 5]))
+        [ True False False  True False]
+        """
+        chs = np.asarray(chs, dtype=int)
+        shared = np.zeros(len(chs), dtype=bool)
+        if len(chs) < 2:
+            return shared
+
+        top, bottom = chs[:-1], chs[1:]
+        shared[:-1] = (top % 2 == 0) * (bottom == top + 1) * \
+            (self.xpos[top] == self.xpos[bottom]) * \
+            (self.ypos[top] == self.ypos[bottom])
+        return shared
+
+    def map2tod_shared(self, chs, ra, dec, pa):
+        """
+        Scan the input sky maps to generate the timestreams of channels
+        with the same pointing. The pixel indices, the I/Q/U values and
+        the trigonometric factors of the parallactic angle are computed
+        once for all channels.
+
+        Parameters
+        ----------
+        chs : list of int
+            Channel indices in the focal plane.
+        ra, dec, pa : 1d arrays
+            Pointing of the channels.
+
+        Returns
+        ----------
+        ts : list of 1d arrays
+            The timestreams for the channels chs (see map2tod).
+        """
+        self.check_not_streaming()
 
         ## Retrieve corresponding pixels on the sky, and their index locally.
         if self.projection == 'flat':
@@ -461,43 +749,232 @@ class TimeOrderedDataPairDiff():
         elif self.projection == 'healpix':
             index_global, index_local = build_pointing_matrix(
                 ra, dec, self.HealpixFitsMap.nside, obspix=self.obspix,
-                cut_outliers=True, ext_map_gal=self.HealpixFitsMap.ext_map_gal,
-                projection=self.projection)
+                cut_outliers=True, projection=self.projection)
+
+        do_pol = self.HealpixFitsMap.do_pol
+        I = self.HealpixFitsMap.I[index_global]
+        if do_pol:
+            Q = self.HealpixFitsMap.Q[index_global]
+            U = self.HealpixFitsMap.U[index_global]
+            cos2pa = np.cos(2 * pa)
+            sin2pa = np.sin(2 * pa)
+
+        ts = []
+        for ch in chs:
+            ## Store list of hit pixels and modulation factors
+            ## only for top bolometers
+            if ch % 2 == 0:
+                row = 0 if self.mapping_perpair else int(ch/2)
+                self.point_matrix[row] = index_local
+                if do_pol:
+                    self.cos2pa[row] = cos2pa
+                    self.sin2pa[row] = sin2pa
+                    ang_pix = (90.0 - self.intrinsic_polangle[ch]) * d2r
+                    self.cos2polangle[row] = np.cos(2.0 * ang_pix)
+                    self.sin2polangle[row] = np.sin(2.0 * ang_pix)
+
+            ## Gain mode. Not yet implemented, but this is the place!
+            norm = self.gain[ch]
+
+            ## Noise simulation
+            if self.noise_generator is not None:
+                noise = self.noise_generator.simulate_noise_one_detector(ch)
+            else:
+                noise = 0.0
+
+            if do_pol:
+                cos2pol, sin2pol = self.compute_modulation(
+                    ch, cos2pa, sin2pa)
+                ts.append((I + Q * cos2pol + U * sin2pol + noise) * norm)
+            else:
+                ts.append(norm * (I + noise))
 
-        ## Store list of hit pixels only for top bolometers
-        if ch % 2 == 0 and not self.mapping_perpair:
-            self.point_matrix[int(ch/2)] = index_local
-        elif ch % 2 == 0 and self.mapping_perpair:
-            self.point_matrix[0] = index_local
+        return ts
 
-        ## Gain mode. Not yet implemented, but this is the place!
-        norm = self.gain[ch]
+    def map2tod_alldet(self, out=None, chs=None, language=None):
+        """
+        Scan the input sky maps for several channels at once, and write
+        the timestreams in a (preallocated) buffer. With a compiled
+        language, everything done by map2tod (detector pointing, pixel
+        indices, I/Q/U, polarisation modulation, gain and noise) is
+        computed in one pass over the samples, without intermediate
+        timelines. The pointing and the I/Q/U values are computed once
+        for pairs with coincident beam offsets (see map2tod_pair).
+        As for map2tod, the pixel indices and the modulation
+        factors of the top bolometers are stored for tod2map.
 
-        ## Noise simulation
-        if self.noise_generator is not None:
-            noise = self.noise_generator.simulate_noise_one_detector(ch)
-        else:
-            noise = 0.0
+        Parameters
+        ----------
+        out : ndarray, optional
+            Buffer of size (len(chs), nsamples) (float64, C-ordered) where
+            to write the timestreams. Its content is overwritten.
+            If None, a new array is created.
+        chs : list of int, optional
+            Channel indices in the focal plane. Default is all channels.
+        language : string, optional
+            fortran, numba or python (map2tod for each channel, with the
+            pointing computed for groups of channels). Default is the
+            language of the scanning strategy.
+
+        Returns
+        ----------
+        out : ndarray
+            The timestreams (same as map2tod), of size (len(chs), nsamples).
 
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> d = np.zeros((2 * tod.npair, tod.nsamples))
+        >>> _ = tod.map2tod_alldet(out=d, language='fortran')
+        >>> print(round(d[0][0], 3)) #doctest: +NORMALIZE_WHITESPACE
+        -42.874
+
+        Same as map2tod
+        >>> d_ref = np.array([tod.map2tod(det) for det in range(2 * tod.npair)])
+        >>> for language in ['fortran', 'numba', 'python']:
+        ...     d = tod.map2tod_alldet(language=language)
+        ...     assert np.allclose(d, d_ref)
+        """
+        self.check_not_streaming()
+
+        if chs is None:
+            chs = np.arange(2 * self.npair)
+        chs = np.asarray(chs, dtype=int)
+
+        if out is None:
+            out = np.zeros((len(chs), self.nsamples))
+        assert out.shape == (len(chs), self.nsamples), \
+            ValueError("The buffer must be of size {}".format(
+                (len(chs), self.nsamples)))
+        assert out.dtype == np.float64 and out.flags['C_CONTIGUOUS'], \
+            ValueError("The buffer must be a C-ordered float64 array")
+
+        if language is None:
+            language = self.scanning_strategy.language
+        language = resolve_language('map2tod', language)
+
+        ## Bottom bolometers with the same pointing as their top bolometer
+        ## (previous channel) do not compute it again.
+        shared = self.shared_pointing(chs)
+
+        if language == 'python':
+            ## Pointing computed for groups of channels
+            lead = np.flatnonzero(~np.append(False, shared[:-1]))
+            for start in range(0, len(lead), 64):
+                group = lead[start: start + 64]
+                ra, dec, pa = self.get_detector_pointing(chs[group])
+                for k, i in enumerate(group):
+                    n = 2 if shared[i] else 1
+                    out[i: i + n] = self.map2tod_shared(
+                        chs[i: i + n], ra[k], dec[k], pa[k])
+            return out
+
+        ## The kernel adds the sky signal to the noise
+        for i, ch in enumerate(chs):
+            if self.noise_generator is not None:
+                out[i] = self.noise_generator.simulate_noise_one_detector(ch)
+            else:
+                out[i] = 0.0
+
+        ## Rows of point_matrix and cos2pa/sin2pa for the top bolometers
+        store = np.where(
+            chs % 2 == 0, 0 if self.mapping_perpair else chs // 2,
+            -1).astype(np.int32)
+
+        self.map2tod_window(
+            chs, out, store, self.point_matrix, self.cos2pa, self.sin2pa,
+            language=language)
+
+        ## Intrinsic polarisation angle of the stored bolometers
         if self.HealpixFitsMap.do_pol:
-            pol_ang = self.compute_simpolangle(ch, pa,
-                                               do_demodulation=False,
-                                               polangle_err=False)
-
-            ## Store list polangle only for top bolometers
-            if ch % 2 == 0 and not self.mapping_perpair:
-                self.pol_angs[int(ch/2)] = pol_ang
-            elif ch % 2 == 0 and self.mapping_perpair:
-                self.pol_angs[0] = pol_ang
-
-            return (self.HealpixFitsMap.I[index_global] +
-                    self.HealpixFitsMap.Q[index_global] * np.cos(2 * pol_ang) +
-                    self.HealpixFitsMap.U[index_global] *
-                    np.sin(2 * pol_ang) + noise) * norm
-        else:
-            return norm * (self.HealpixFitsMap.I[index_global] + noise)
+            top = store >= 0
+            ang_pix = (90.0 - np.asarray(
+                self.intrinsic_polangle)[chs[top]]) * d2r
+            self.cos2polangle[store[top]] = np.cos(2.0 * ang_pix)
+            self.sin2polangle[store[top]] = np.sin(2.0 * ang_pix)
+
+        return out
+
+    def map2tod_window(self, chs, out, store, point_matrix, cos2pa, sin2pa,
+                       start=0, language='fortran'):
+        """
+        Compiled part of map2tod_alldet, for the samples
+        [start, start + out.shape[1]) of the scan. The pixel indices and
+        cos/sin(2 PA) of the channels are written in the given arrays
+        (of the same length as the window) at the rows `store`.
 
-    def tod2map(self, waferts, output_maps):
+        Parameters
+        ----------
+        chs : 1d array of int
+            Channel indices in the focal plane.
+        out : ndarray
+            C-ordered float64 array of size (len(chs), nt). It contains
+            the noise on input (or zeros), and the timestreams on output.
+        store : 1d array of int
+            For each channel, row of point_matrix, cos2pa and sin2pa where
+            to store its pixel indices and cos/sin(2 PA), or -1.
+        point_matrix : ndarray
+            C-ordered int32 array of size (nrow, nt).
+        cos2pa, sin2pa : ndarray
+            C-ordered float64 arrays of size (nrow, nt).
+        start : int, optional
+            Index of the first sample of the window. Default is 0.
+        language : string, optional
+            fortran or numba. Default is fortran.
+        """
+        nt = out.shape[1]
+        shared = self.shared_pointing(chs)
+        store = np.asarray(store, dtype=np.int32)
+
+        q = np.ascontiguousarray(
+            self.pointing.q[start: start + nt], dtype=np.float64)
+        qpix = self.pointing.detector_quaternions(
+            self.xpos[chs], self.ypos[chs])
+        ang_pix = (90.0 - np.asarray(self.intrinsic_polangle)[chs]) * d2r
+        cos2ang = np.cos(2.0 * ang_pix)
+        sin2ang = np.sin(2.0 * ang_pix)
+        cos4hwp = np.ascontiguousarray(
+            self.cos4hwp[start: start + nt], dtype=np.float64)
+        sin4hwp = np.ascontiguousarray(
+            self.sin4hwp[start: start + nt], dtype=np.float64)
+        norm = np.asarray(self.gain, dtype=np.float64)[chs]
+
+        do_pol = self.HealpixFitsMap.do_pol
+        mapi = np.asarray(self.HealpixFitsMap.I, dtype=np.float64)
+        mapq = np.asarray(self.HealpixFitsMap.Q, dtype=np.float64) \
+            if do_pol else mapi
+        mapu = np.asarray(self.HealpixFitsMap.U, dtype=np.float64) \
+            if do_pol else mapi
+
+        flat = self.projection == 'flat'
+        if flat:
+            obspix = np.zeros(1, dtype=np.int32)
+        else:
+            obspix = np.asarray(self.obspix, dtype=np.int32)
+        xmin = ymin = -self.width / 2. * np.pi / 180.
+        npix_per_row = int(np.sqrt(self.npixsky))
+
+        if language == 'fortran':
+            tod_f.map2tod_alldet_f(
+                q.reshape(-1), qpix.flatten(), cos2ang, sin2ang,
+                cos4hwp, sin4hwp, norm, mapi, mapq, mapu, obspix, store,
+                shared.astype(np.int32), self.HealpixFitsMap.nside,
+                int(flat), xmin, ymin, self.pixel_size, npix_per_row,
+                int(do_pol),
+                out.reshape(-1), point_matrix.reshape(-1),
+                cos2pa.reshape(-1), sin2pa.reshape(-1),
+                nstore=point_matrix.shape[0], nt=nt,
+                ndet=len(chs), nskypix=len(mapi), nobspix=len(obspix))
+        elif language == 'numba':
+            numba_kernels.map2tod_alldet_numba(
+                q, qpix, cos2ang, sin2ang, cos4hwp, sin4hwp, norm,
+                mapi, mapq, mapu, obspix, store, shared,
+                self.HealpixFitsMap.nside, flat, xmin, ymin,
+                self.pixel_size, npix_per_row, do_pol, out,
+                point_matrix, cos2pa, sin2pa)
+
+    def tod2map(self, waferts, output_maps, language=None, nthreads=1):
         """
         Project time-ordered data into sky maps for the whole array.
         Maps are updated on-the-fly. Massive speed-up thanks to the
@@ -510,6 +987,19 @@ class TimeOrderedDataPairDiff():
         output_maps : OutputSkyMap instance
             Instance of OutputSkyMap which contains the sky maps. The
             coaddition of data is done on-the-fly directly.
+        language : string, optional
+            fortran or numba. Default is the language of the scanning
+            strategy (fortran if python).
+        nthreads : int, optional
+            Number of threads. If larger than 1, the pairs are split in
+            nthreads blocks projected in parallel into private maps (one
+            copy of the maps per thread), which are then added to the
+            output maps in the order of the blocks: for a given nthreads,
+            the result does not depend on the scheduling of the threads.
+            The fortran kernel is threaded if tod_f is compiled with
+            OpenMP (see the Makefile). The numba kernel uses at most
+            nthreads threads of its pool (NUMBA_NUM_THREADS, all the cores
+            by default). Default is 1.
 
         Examples
         ----------
@@ -535,6 +1025,13 @@ class TimeOrderedDataPairDiff():
         >>> assert np.allclose(sky_out[0][mask], sky_in.Q[mask])
         >>> assert np.allclose(sky_out[1][mask], sky_in.U[mask])
 
+        Threaded projection: same maps, up to the order of the sums
+        >>> m4 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> for language in ['fortran', 'numba']:
+        ...     tod.tod2map(d, m4, language=language, nthreads=4)
+        >>> assert np.allclose(m4.dc, 2 * m.dc) and np.all(m4.nhit == 2 * m.nhit)
+
         FLAT: Test the routines MAP -> TOD -> MAP.
         >>> inst, scan, sky_in = load_fake_instrument()
         >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
@@ -560,6 +1057,8 @@ class TimeOrderedDataPairDiff():
         >>> assert (mean_output - mean_input)/mean_output * 100 < 1.0
 
         """
+        self.check_not_streaming()
+
         nbolofp = waferts.shape[0]
         npixfp = nbolofp / 2
         nt = int(waferts.shape[1])
@@ -568,27 +1067,204 @@ class TimeOrderedDataPairDiff():
         assert npixfp == self.point_matrix.shape[0]
         assert nt == self.point_matrix.shape[1]
 
-        assert npixfp == self.pol_angs.shape[0]
-        assert nt == self.pol_angs.shape[1]
+        assert npixfp == self.cos2pa.shape[0]
+        assert nt == self.cos2pa.shape[1]
 
         assert npixfp == self.diff_weight.shape[0]
         assert npixfp == self.sum_weight.shape[0]
 
-        point_matrix = self.point_matrix.flatten()
-        pol_angs = self.pol_angs.flatten()
-        waferts = waferts.flatten()
-        diff_weight = self.diff_weight.flatten()
-        sum_weight = self.sum_weight.flatten()
-        wafermask_pixel = self.wafermask_pixel.flatten()
-
-        tod_f.tod2map_alldet_f(output_maps.d, output_maps.w, output_maps.dc,
-                               output_maps.ds, output_maps.cc, output_maps.cs,
-                               output_maps.ss, output_maps.nhit,
-                               point_matrix, pol_angs, waferts,
-                               diff_weight, sum_weight, nt,
-                               wafermask_pixel, npixfp, self.npixsky)
-        # Garbage collector guard
-        wafermask_pixel
+        ## No python version of this kernel: fortran by default.
+        if language is None:
+            language = self.scanning_strategy.language
+        if language != 'numba':
+            language = 'fortran'
+        language = resolve_language('tod2map', language)
+
+        self.tod2map_window(
+            np.ascontiguousarray(waferts, dtype=np.float64), output_maps,
+            self.point_matrix, self.cos2pa, self.sin2pa,
+            self.cos2polangle, self.sin2polangle,
+            self.diff_weight.flatten(), self.sum_weight.flatten(),
+            self.wafermask_pixel, language=language, nthreads=nthreads)
+
+    def tod2map_window(self, waferts, output_maps, point_matrix, cos2pa,
+                       sin2pa, cos2polangle, sin2polangle, diff_weight,
+                       sum_weight, wafermask_pixel, start=0,
+                       language='fortran', nthreads=1):
+        """
+        Compiled part of tod2map, for the samples
+        [start, start + waferts.shape[1]) of the scan, with the pointing
+        and modulation arrays of the pairs given explicitly
+        (see map2tod_window).
+
+        Parameters
+        ----------
+        waferts : ndarray
+            C-ordered float64 array of timestreams of size (2 * npair, nt),
+            with top and bottom bolometers of each pair in consecutive rows.
+        output_maps : OutputSkyMap instance
+            Instance of OutputSkyMap which contains the sky maps.
+        point_matrix : ndarray
+            int32 array of size (npair, nt).
+        cos2pa, sin2pa : ndarray
+            float64 arrays of size (npair, nt).
+        cos2polangle, sin2polangle : 1d array
+            cos/sin of twice the intrinsic polarisation angle of the top
+            bolometers (size npair).
+        diff_weight, sum_weight : 1d array
+            Weights of the pairs (size npair).
+        wafermask_pixel : ndarray
+            Array of size (npair, nt), 1 if the time sample should be
+            included, 0 otherwise.
+        start : int, optional
+            Index of the first sample of the window. Default is 0.
+        language : string, optional
+            fortran or numba. Default is fortran.
+        nthreads : int, optional
+            Number of threads (see tod2map). Default is 1.
+        """
+        npair, nt = point_matrix.shape
+        cos4hwp = np.ascontiguousarray(
+            self.cos4hwp[start: start + nt], dtype=np.float64)
+        sin4hwp = np.ascontiguousarray(
+            self.sin4hwp[start: start + nt], dtype=np.float64)
+        wafermask_pixel = np.ascontiguousarray(
+            wafermask_pixel, dtype=np.int32).reshape(-1)
+        cos2polangle = np.asarray(cos2polangle, dtype=np.float64)
+        sin2polangle = np.asarray(sin2polangle, dtype=np.float64)
+        diff_weight = np.asarray(diff_weight, dtype=np.float64)
+        sum_weight = np.asarray(sum_weight, dtype=np.float64)
+
+        maps = [output_maps.d, output_maps.w, output_maps.dc,
+                output_maps.ds, output_maps.cc, output_maps.cs,
+                output_maps.ss, output_maps.nhit]
+        args = [point_matrix.reshape(-1), cos2pa.reshape(-1),
+                sin2pa.reshape(-1), cos2polangle, sin2polangle,
+                cos4hwp, sin4hwp, waferts.reshape(-1),
+                diff_weight, sum_weight]
+
+        if language == 'fortran' and nthreads > 1:
+            tod_f.tod2map_alldet_threads_f(
+                *(maps + args), npix=npair, nt=nt,
+                wafermask_pixel=wafermask_pixel, nskypix=self.npixsky,
+                nthreads=nthreads)
+        elif language == 'fortran':
+            tod_f.tod2map_alldet_f(
+                *(maps + args), npix=npair, nt=nt,
+                wafermask_pixel=wafermask_pixel, nskypix=self.npixsky)
+        elif language == 'numba' and nthreads > 1:
+            numba_kernels.tod2map_alldet_threads_numba(
+                *(maps + args + [npair, nt, wafermask_pixel, nthreads]))
+        elif language == 'numba':
+            numba_kernels.tod2map_alldet_numba(
+                *(maps + args + [npair, nt, wafermask_pixel]))
+
+    def map2tod2map(self, output_maps, chunk_size=2**16,
+                    npair_per_chunk=None, language=None, nthreads=1):
+        """
+        Scan the input sky maps and project the timestreams into the
+        output sky maps (map2tod_alldet followed by tod2map), by chunks of
+        chunk_size samples and npair_per_chunk pairs. The timestreams,
+        pointing matrix, modulation factors and masks are allocated for
+        one chunk only, so that the memory depends on the size of the
+        chunks, and not on the length of the scan (use streaming=True
+        so that they are not allocated for the whole scan either).
+        The noise of each detector is drawn chunk after chunk from its
+        own random state, and the output maps are the same as without
+        chunks.
+
+        Parameters
+        ----------
+        output_maps : OutputSkyMap instance
+            Instance of OutputSkyMap which contains the sky maps. The
+            coaddition of data is done on-the-fly directly.
+        chunk_size : int, optional
+            Number of time samples per chunk. Default is 2**16.
+        npair_per_chunk : int, optional
+            Number of pairs per chunk. Default is all pairs.
+        language : string, optional
+            fortran or numba. Default is the language of the scanning
+            strategy (fortran if python).
+        nthreads : int, optional
+            Number of threads for the projection (see tod2map).
+            Default is 1.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     array_noise_level=10., streaming=True)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.map2tod2map(m, chunk_size=1000, npair_per_chunk=3)
+        >>> print(tod.point_matrix)
+        None
+
+        The whole scan cannot be scanned at once in streaming mode
+        >>> d = tod.map2tod(0) # doctest: +NORMALIZE_WHITESPACE
+        Traceback (most recent call last):
+         ...
+        ValueError: The pointing matrix and modulation factors of the whole
+        scan are not allocated with streaming=True. Use map2tod2map instead.
+
+        Same maps as with the whole scan at once
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     array_noise_level=10.)
+        >>> m_ref = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(tod.map2tod_alldet(language='fortran'), m_ref)
+        >>> for k in ['d', 'w', 'dc', 'ds', 'cc', 'cs', 'ss', 'nhit']:
+        ...     assert np.allclose(getattr(m, k), getattr(m_ref, k))
+        """
+        ## No python version of the kernels: fortran by default.
+        if language is None:
+            language = self.scanning_strategy.language
+        if language != 'numba':
+            language = 'fortran'
+        language = resolve_language('tod2map', language)
+
+        if npair_per_chunk is None:
+            npair_per_chunk = self.npair
+
+        for first in range(0, self.npair, npair_per_chunk):
+            pairs = np.arange(first, min(first + npair_per_chunk, self.npair))
+            chs = np.arange(2 * pairs[0], 2 * pairs[-1] + 2)
+
+            ## Parameters of the pairs, constant over the scan
+            rows = pairs if not self.mapping_perpair else 0 * pairs
+            diff_weight = np.asarray(self.diff_weight).flatten()[rows]
+            sum_weight = np.asarray(self.sum_weight).flatten()[rows]
+            ang_pix = (90.0 - np.asarray(
+                self.intrinsic_polangle)[chs[::2]]) * d2r
+            cos2polangle = np.cos(2.0 * ang_pix)
+            sin2polangle = np.sin(2.0 * ang_pix)
+            store = np.where(
+                chs % 2 == 0, (chs - chs[0]) // 2, -1).astype(np.int32)
+
+            for start in range(0, self.nsamples, chunk_size):
+                nt = min(chunk_size, self.nsamples - start)
+
+                ## The kernel adds the sky signal to the noise
+                out = np.zeros((len(chs), nt))
+                if self.noise_generator is not None:
+                    for i, ch in enumerate(chs):
+                        out[i] = self.noise_generator.simulate_noise_chunk(
+                            ch, nt)
+
+                point_matrix = np.zeros((len(pairs), nt), dtype=np.int32)
+                cos2pa = np.ones((len(pairs), nt), dtype=np.float64)
+                sin2pa = np.zeros((len(pairs), nt), dtype=np.float64)
+                masks = self.get_timestream_masks(
+                    start, start + nt, pairs=pairs)
+
+                self.map2tod_window(
+                    chs, out, store, point_matrix, cos2pa, sin2pa,
+                    start=start, language=language)
+                self.tod2map_window(
+                    out, output_maps, point_matrix, cos2pa, sin2pa,
+                    cos2polangle, sin2polangle, diff_weight, sum_weight,
+                    masks, start=start, language=language,
+                    nthreads=nthreads)
 
 class WhiteNoiseGenerator():
     """ Class to handle white noise """
@@ -625,6 +1301,10 @@ class WhiteNoiseGenerator():
         state = np.random.RandomState(self.array_noise_seed)
         self.noise_seeds = state.randint(0, 1e6, size=self.ndetectors)
 
+        ## Random states of the detectors being simulated chunk by chunk,
+        ## and number of samples already drawn.
+        self.noise_states = {}
+
     def simulate_noise_one_detector(self, ch):
         """
         Simulate noise on-the-fly for one detector.
@@ -652,6 +1332,47 @@ class WhiteNoiseGenerator():
 
         return self.detector_noise_level * vec
 
+    def simulate_noise_chunk(self, ch, size):
+        """
+        Simulate the next `size` samples of noise for one detector.
+        The random state of the detector is kept between calls (and
+        released once ntimesamples samples have been drawn), so that
+        consecutive chunks give the same noise as
+        simulate_noise_one_detector.
+
+        Parameters
+        ----------
+        ch : int
+            Index of the detector in the array.
+        size : int
+            Number of samples.
+
+        Returns
+        ----------
+        vec : 1d array
+            Vector of noise of size `size`.
+
+        Examples
+        ----------
+        >>> wn = WhiteNoiseGenerator(3000., 2, 4, array_noise_seed=493875)
+        >>> ts = np.concatenate([wn.simulate_noise_chunk(0, 3),
+        ...     wn.simulate_noise_chunk(0, 1)])
+        >>> assert np.all(ts == wn.simulate_noise_one_detector(0))
+        >>> print(len(wn.noise_states))
+        0
+        """
+        if ch not in self.noise_states:
+            self.noise_states[ch] = [
+                np.random.RandomState(self.noise_seeds[ch]), 0]
+        state = self.noise_states[ch]
+        vec = state[0].normal(size=size)
+
+        state[1] += size
+        if state[1] >= self.ntimesamples:
+            self.noise_states.pop(ch)
+
+        return self.detector_noise_level * vec
+
 
 def psdts(ts, sample_rate, NFFT=4096):
     '''
@@ -1250,6 +1971,8 @@ def build_pointing_matrix(ra, dec, nside, projection='healpix',
     ext_map_gal : bool, optional
         If True, perform a rotation of the RA/Dec coordinate to Galactic
         coordinates prior to compute healpix indices. Defaut is False.
+        Note that TimeOrderedDataPairDiff does not use it: the rotation
+        is already included in the pointing (see Pointing, coord).
 
     Returns
     ----------
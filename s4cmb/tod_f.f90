@@ -7,10 +7,260 @@ module tod_f
 
 contains
 
+    function ang2pix_ring_f(nside, theta, phi) result(ipix)
+        implicit none
+        ! Index of the healpix pixel (RING scheme) containing the
+        ! direction (theta, phi). Same algorithm as healpy (ang2pix).
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: I8B = 8
+        integer, parameter       :: DP = 8
+        real(DP), parameter      :: inv_halfpi = 0.6366197723675813430755350534900574d0
+        real(DP), parameter      :: pi = 3.141592653589793238462643383279502884197d0
+
+        integer(I4B), intent(in) :: nside
+        real(DP), intent(in)     :: theta, phi
+        integer(I4B)             :: ipix
+
+        integer(I8B)             :: ns, nl4, ncap, npix, jp, jm, ir, ip, t1, kshift
+        real(DP)                 :: z, za, tt, tp, tmp, temp1, temp2, sth
+
+        ns = nside
+        nl4 = 4 * ns
+        ncap = 2 * ns * (ns - 1)
+        npix = 12 * ns * ns
+
+        z = cos(theta)
+        za = abs(z)
+
+        ! fmodulo(phi / (pi / 2), 4)
+        tt = phi * inv_halfpi
+        if (tt .ge. 0.0d0) then
+            if (tt .ge. 4.0d0) tt = mod(tt, 4.0d0)
+        else
+            tt = mod(tt, 4.0d0) + 4.0d0
+            if (tt .eq. 4.0d0) tt = 0.0d0
+        endif
+
+        if (za .le. 2.0d0 / 3.0d0) then
+            ! Equatorial region
+            temp1 = ns * (0.5d0 + tt)
+            temp2 = ns * z * 0.75d0
+            jp = int(temp1 - temp2, I8B)
+            jm = int(temp1 + temp2, I8B)
+            ir = ns + 1 + jp - jm
+            kshift = 1 - iand(ir, 1_I8B)
+            t1 = jp + jm - ns + kshift + 1 + nl4 + nl4
+            ip = modulo(t1 / 2, nl4)
+            ipix = int(ncap + (ir - 1) * nl4 + ip, I4B)
+        else
+            ! Polar caps
+            tp = tt - int(tt)
+            if ((theta .lt. 0.01d0) .or. (theta .gt. pi - 0.01d0)) then
+                sth = sin(theta)
+                if (za .lt. 0.99d0) then
+                    tmp = ns * sqrt(3.0d0 * (1.0d0 - za))
+                else
+                    tmp = ns * sth / sqrt((1.0d0 + za) / 3.0d0)
+                endif
+            else
+                tmp = ns * sqrt(3.0d0 * (1.0d0 - za))
+            endif
+            jp = int(tp * tmp, I8B)
+            jm = int((1.0d0 - tp) * tmp, I8B)
+            ir = jp + jm + 1
+            ip = int(tt * ir, I8B)
+            if (ip .ge. 4 * ir) ip = ip - 4 * ir
+            if (z .gt. 0.0d0) then
+                ipix = int(2 * ir * (ir - 1) + ip, I4B)
+            else
+                ipix = int(npix - 2 * ir * (ir + 1) + ip, I4B)
+            endif
+        endif
+
+    end function
+
+    subroutine map2tod_alldet_f(q, qpix, cos2ang, sin2ang, cos4hwp, sin4hwp, &
+    norm, mapi, mapq, mapu, obspix, store, shared, nside, flat, xmin, ymin, &
+    pixel_size, npix_per_row, do_pol, out, point_matrix, cos2pa, sin2pa, &
+    nt, ndet, nskypix, nobspix, nstore)
+        implicit none
+        ! Scan the sky maps for many detectors, in one pass per sample:
+        ! detector pointing from the boresight quaternions q and the
+        ! detector offset quaternions qpix, pixel index (healpix RING, and
+        ! index in the output patch), I/Q/U gather, polarisation
+        ! modulation and gain. out contains the noise on input (or zeros),
+        ! and the timestreams on output. The modulation is built with angle
+        ! addition from cos/sin(2 PA) (taken from the quaternion, without
+        ! computing PA), cos/sin(2 intrinsic) and cos/sin(4 HWP).
+        !
+        ! Parameters
+        ! ----------
+        ! q : 1d array
+        !     Boresight quaternions (flattened array of size 4 * nt).
+        ! qpix : 1d array
+        !     Detector offset quaternions (flattened array of size 4 * ndet).
+        ! cos2ang, sin2ang : 1d array
+        !     cos/sin of twice the intrinsic polarisation angle of the
+        !     detectors (size ndet).
+        ! cos4hwp, sin4hwp : 1d array
+        !     cos/sin of four times the HWP angle (size nt).
+        ! norm : 1d array
+        !     Gain of the detectors (size ndet).
+        ! mapi, mapq, mapu : 1d array
+        !     Input sky maps (size nskypix).
+        ! obspix : 1d array
+        !     Sorted indices of the observed pixels (healpix projection).
+        ! store : 1d array
+        !     Row of point_matrix and cos2pa/sin2pa where to store the pixel
+        !     indices and cos/sin(2 PA) of each detector, or -1.
+        ! shared : 1d array
+        !     1 if the next detector has the same offset quaternion (its
+        !     pointing, pixel and cos/sin(2 PA) are then computed once),
+        !     0 otherwise.
+        ! flat : int
+        !     1 for the flat projection, 0 for healpix.
+        !
+        ! Returns
+        ! ----------
+        ! out : 1d array
+        !     Timestreams, flattened array of size ndet * nt.
+        ! point_matrix, cos2pa, sin2pa : 1d array
+        !     Flattened arrays of size nstore * nt.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        real(DP), parameter      :: halfpi = 1.570796326794896619231321691639751442d0
+
+        ! F2PY params
+        integer(I4B), intent(in) :: nt, ndet, nskypix, nobspix, nstore
+        integer(I4B), intent(in) :: nside, flat, npix_per_row, do_pol
+        real(DP), intent(in)     :: xmin, ymin, pixel_size
+        real(DP), intent(in)     :: q(0 : 4 * nt - 1)
+        real(DP), intent(in)     :: qpix(0 : 4 * ndet - 1)
+        real(DP), intent(in)     :: cos2ang(0 : ndet - 1), sin2ang(0 : ndet - 1)
+        real(DP), intent(in)     :: norm(0 : ndet - 1)
+        real(DP), intent(in)     :: cos4hwp(0 : nt - 1), sin4hwp(0 : nt - 1)
+        real(DP), intent(in)     :: mapi(0 : nskypix - 1)
+        real(DP), intent(in)     :: mapq(0 : nskypix - 1)
+        real(DP), intent(in)     :: mapu(0 : nskypix - 1)
+        integer(I4B), intent(in) :: obspix(0 : nobspix - 1)
+        integer(I4B), intent(in) :: store(0 : ndet - 1), shared(0 : ndet - 1)
+        real(DP), intent(inout)  :: out(0 : ndet * nt - 1)
+        integer(I4B), intent(inout) :: point_matrix(0 : nstore * nt - 1)
+        real(DP), intent(inout)  :: cos2pa(0 : nstore * nt - 1)
+        real(DP), intent(inout)  :: sin2pa(0 : nstore * nt - 1)
+
+        ! LOCAL
+        integer(I4B)             :: t, det, k, ng, ipix, ilocal, ix, iy, lo, hi, mid
+        real(DP)                 :: px, py, pz, pw, qx, qy, qz, qw
+        real(DP)                 :: sx, sy, sz, sw
+        real(DP)                 :: ra, dec, pa_x, pa_y, r2, c2pa, s2pa, c, s
+
+        det = 0
+        do while (det .lt. ndet)
+            ! Number of detectors with this pointing
+            ng = 1 + shared(det)
+            qx = qpix(4 * det)
+            qy = qpix(4 * det + 1)
+            qz = qpix(4 * det + 2)
+            qw = qpix(4 * det + 3)
+            do t=0, nt - 1
+                px = q(4 * t)
+                py = q(4 * t + 1)
+                pz = q(4 * t + 2)
+                pw = q(4 * t + 3)
+
+                ! Detector pointing (see offset_detectors_f)
+                sw = pw * qw - (px * qx + py * qy + pz * qz)
+                sx = pw * qx + px * qw + py * qz - pz * qy
+                sy = pw * qy + py * qw + pz * qx - px * qz
+                sz = pw * qz + pz * qw + px * qy - py * qx
+
+                dec = -asin(2.0d0 * (sw * sy - sz * sx))
+                ra = atan2(2.0d0 * (sw * sz + sx * sy), &
+                    1.0d0 - 2.0d0 * (sy * sy + sz * sz))
+
+                ! Pixel in the input map, and in the output patch
+                ipix = ang2pix_ring_f(nside, halfpi - dec, ra)
+                if (flat .eq. 1) then
+                    ix = int((ra - (xmin - pixel_size / 2.0d0)) / pixel_size)
+                    iy = int((sin(dec) - (ymin - pixel_size / 2.0d0)) / pixel_size)
+                    if (ix .lt. 0 .or. ix .ge. npix_per_row .or. &
+                        iy .lt. 0 .or. iy .ge. npix_per_row) then
+                        ilocal = -1
+                    else
+                        ilocal = ix * npix_per_row + iy
+                    endif
+                else
+                    ! Binary search in the observed pixels
+                    lo = 0
+                    hi = nobspix
+                    do while (lo .lt. hi)
+                        mid = (lo + hi) / 2
+                        if (obspix(mid) .lt. ipix) then
+                            lo = mid + 1
+                        else
+                            hi = mid
+                        endif
+                    enddo
+                    ilocal = -1
+                    if (lo .lt. nobspix) then
+                        if (obspix(lo) .eq. ipix) ilocal = lo
+                    endif
+                endif
+
+                if (do_pol .eq. 1) then
+                    ! PA = -atan2(pa_y, pa_x)
+                    pa_y = 2.0d0 * (sw * sx + sy * sz)
+                    pa_x = 1.0d0 - 2.0d0 * (sx * sx + sy * sy)
+                    r2 = pa_x * pa_x + pa_y * pa_y
+                    if (r2 .gt. 0.0d0) then
+                        c2pa = (pa_x * pa_x - pa_y * pa_y) / r2
+                        s2pa = -2.0d0 * pa_x * pa_y / r2
+                    else
+                        c2pa = 1.0d0
+                        s2pa = 0.0d0
+                    endif
+                endif
+
+                do k=det, det + ng - 1
+                    if (do_pol .eq. 1) then
+                        ! cos/sin(2 intrinsic + 4 HWP)
+                        c = cos2ang(k) * cos4hwp(t) - sin2ang(k) * sin4hwp(t)
+                        s = sin2ang(k) * cos4hwp(t) + cos2ang(k) * sin4hwp(t)
+
+                        out(t + k * nt) = (mapi(ipix) + &
+                            mapq(ipix) * (c2pa * c - s2pa * s) + &
+                            mapu(ipix) * (s2pa * c + c2pa * s) + &
+                            out(t + k * nt)) * norm(k)
+                    else
+                        out(t + k * nt) = norm(k) * &
+                            (mapi(ipix) + out(t + k * nt))
+                    endif
+
+                    if (store(k) .ge. 0) then
+                        point_matrix(t + store(k) * nt) = ilocal
+                        if (do_pol .eq. 1) then
+                            cos2pa(t + store(k) * nt) = c2pa
+                            sin2pa(t + store(k) * nt) = s2pa
+                        endif
+                    endif
+                enddo
+            enddo
+            det = det + ng
+        enddo
+
+    end subroutine
+
     subroutine tod2map_alldet_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
-    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafercos2pa, wafersin2pa, cos2ang, sin2ang, cos4hwp, sin4hwp, waferts, &
+    diff_weight, sum_weight, npix, nt, wafermask_pixel, nskypix)
         implicit none
+        ! The polarisation modulation of each pair is built with angle
+        ! addition from cos/sin(2 PA) (wafercos2pa, wafersin2pa),
+        ! cos/sin(2 intrinsic) of the top bolometer (cos2ang,
+        ! sin2ang) and cos/sin(4 HWP) (cos4hwp, sin4hwp).
 
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
@@ -19,7 +269,10 @@ contains
         integer(I4B), intent(in) :: npix, nt, nskypix
         integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
         integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
-        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: wafercos2pa(0:npix*nt - 1), wafersin2pa(0:npix*nt - 1)
+        real(DP), intent(in)     :: cos2ang(0:npix - 1), sin2ang(0:npix - 1)
+        real(DP), intent(in)     :: cos4hwp(0:nt - 1), sin4hwp(0:nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*2 - 1)
         real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
 
         real(DP), intent(inout)  :: d(0:nskypix - 1), w(0:nskypix - 1), dc(0:nskypix - 1)
@@ -29,7 +282,7 @@ contains
 
         integer(I4B)             :: i, j, ipix, pixel
         integer(I4B)             :: ict, icb
-        real(DP)                 :: sum, diff, c, s
+        real(DP)                 :: sum, diff, c, s, c0, s0
 
         do j=0, npix - 1
             do i=0, nt - 1
@@ -42,8 +295,10 @@ contains
 
                     sum = 0.5*(waferts(ict) + waferts(icb))
                     diff = 0.5*(waferts(ict) - waferts(icb))
-                    c = cos(2.0*waferpa(ipix))
-                    s = sin(2.0*waferpa(ipix))
+                    c0 = cos2ang(j) * cos4hwp(i) - sin2ang(j) * sin4hwp(i)
+                    s0 = sin2ang(j) * cos4hwp(i) + cos2ang(j) * sin4hwp(i)
+                    c = wafercos2pa(ipix) * c0 - wafersin2pa(ipix) * s0
+                    s = wafersin2pa(ipix) * c0 + wafercos2pa(ipix) * s0
 
                     nhit(pixel) = nhit(pixel) + 1
                     w(pixel) = w(pixel) + sum_weight(j)
@@ -60,6 +315,93 @@ contains
 
     end subroutine
 
+    subroutine tod2map_alldet_threads_f(d, w, dc, ds, cc, cs, ss, nhit, &
+    waferi1d, wafercos2pa, wafersin2pa, cos2ang, sin2ang, cos4hwp, sin4hwp, &
+    waferts, diff_weight, sum_weight, npix, nt, wafermask_pixel, nskypix, &
+    nthreads)
+        implicit none
+        ! Same as tod2map_alldet_f, with the pairs split in nthreads blocks
+        ! projected in parallel (OpenMP) into private maps. The private maps
+        ! are then added to the output maps block after block, so that the
+        ! result does not depend on the scheduling of the threads (nor on
+        ! OpenMP being available: without it the blocks run one after the
+        ! other).
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: wafercos2pa(0:npix*nt - 1), wafersin2pa(0:npix*nt - 1)
+        real(DP), intent(in)     :: cos2ang(0:npix - 1), sin2ang(0:npix - 1)
+        real(DP), intent(in)     :: cos4hwp(0:nt - 1), sin4hwp(0:nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix - 1), w(0:nskypix - 1), dc(0:nskypix - 1)
+        real(DP), intent(inout)  :: ds(0:nskypix - 1), cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: b, i, j0, j1
+        real(DP), allocatable    :: bd(:, :), bw(:, :), bdc(:, :), bds(:, :)
+        real(DP), allocatable    :: bcc(:, :), bcs(:, :), bss(:, :)
+        integer(I4B), allocatable :: bnhit(:, :)
+
+        allocate(bd(0:nskypix - 1, 0:nthreads - 1), bw(0:nskypix - 1, 0:nthreads - 1))
+        allocate(bdc(0:nskypix - 1, 0:nthreads - 1), bds(0:nskypix - 1, 0:nthreads - 1))
+        allocate(bcc(0:nskypix - 1, 0:nthreads - 1), bcs(0:nskypix - 1, 0:nthreads - 1))
+        allocate(bss(0:nskypix - 1, 0:nthreads - 1), bnhit(0:nskypix - 1, 0:nthreads - 1))
+
+        !$omp parallel do num_threads(nthreads) private(b, j0, j1) schedule(static, 1)
+        do b=0, nthreads - 1
+            bd(:, b) = 0.0d0
+            bw(:, b) = 0.0d0
+            bdc(:, b) = 0.0d0
+            bds(:, b) = 0.0d0
+            bcc(:, b) = 0.0d0
+            bcs(:, b) = 0.0d0
+            bss(:, b) = 0.0d0
+            bnhit(:, b) = 0
+
+            ! Pairs j0 to j1 - 1
+            j0 = int((int(b, 8) * npix) / nthreads)
+            j1 = int((int(b + 1, 8) * npix) / nthreads)
+            if (j1 .gt. j0) then
+                call tod2map_alldet_f(bd(:, b), bw(:, b), bdc(:, b), &
+                    bds(:, b), bcc(:, b), bcs(:, b), bss(:, b), bnhit(:, b), &
+                    waferi1d(j0 * nt : j1 * nt - 1), &
+                    wafercos2pa(j0 * nt : j1 * nt - 1), &
+                    wafersin2pa(j0 * nt : j1 * nt - 1), &
+                    cos2ang(j0 : j1 - 1), sin2ang(j0 : j1 - 1), &
+                    cos4hwp, sin4hwp, waferts(2 * j0 * nt : 2 * j1 * nt - 1), &
+                    diff_weight(j0 : j1 - 1), sum_weight(j0 : j1 - 1), &
+                    j1 - j0, nt, wafermask_pixel(j0 * nt : j1 * nt - 1), nskypix)
+            endif
+        enddo
+        !$omp end parallel do
+
+        ! Reduction, always in the order of the blocks
+        !$omp parallel do num_threads(nthreads) private(i, b)
+        do i=0, nskypix - 1
+            do b=0, nthreads - 1
+                d(i) = d(i) + bd(i, b)
+                w(i) = w(i) + bw(i, b)
+                dc(i) = dc(i) + bdc(i, b)
+                ds(i) = ds(i) + bds(i, b)
+                cc(i) = cc(i) + bcc(i, b)
+                cs(i) = cs(i) + bcs(i, b)
+                ss(i) = ss(i) + bss(i, b)
+                nhit(i) = nhit(i) + bnhit(i, b)
+            enddo
+        enddo
+        !$omp end parallel do
+
+        deallocate(bd, bw, bdc, bds, bcc, bcs, bss, bnhit)
+
+    end subroutine
+
     subroutine polarized_coadd_hwp_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
     waferpa, waferts, weight4, weight0, nch, nt, &
     wafermask_pixel, nts, nces, nskypix)
@@ -28,8 +28,8 @@ def configuration(parent_package='', top_path=None):
                          libraries=[], f2py_options=[],
                          extra_f90_compile_args=[
                              '-ffixed-line-length-1000',
-                             '-O3'],
-                         extra_compile_args=[''], extra_link_args=[''],)
+                             '-O3', '-fopenmp'],
+                         extra_compile_args=[''], extra_link_args=['-lgomp'],)
     config.add_extension('systematics_f',
                          sources=['s4cmb/systematics_f.f90'],
                          libraries=[], f2py_options=[],